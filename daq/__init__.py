@@ -1,2 +1,25 @@
 __version__="0.1"
 from .daq import *
+from .payload import *
+from .integrity import *
+from .writer import *
+from .publisher import *
+from .schedule import *
+from .arrival import *
+from .stream import *
+from .shard import *
+from .metrics import *
+from .pacing import *
+from .trace import *
+from .container import *
+from .compress import *
+from .encoding import *
+from .transport import *
+from .monitor import *
+from .campaign import *
+from .control import *
+from .shaping import *
+from .backpressure import *
+from .layout import *
+from .ring import *
+from .profiling import *
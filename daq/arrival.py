@@ -0,0 +1,110 @@
+#
+# daq/arrival.py
+#
+# Arrival models of the STFs: the distribution of the intervals between consecutive STFs.
+# Each schedule entry may carry its own model, and the intervals are drawn in NumPy batches
+# covering a whole segment of the schedule, rather than with one RNG call per STF.
+
+
+import numpy as np
+
+# ---
+MODELS      = ('fixed', 'uniform', 'poisson', 'exponential', 'bursty')
+MAX_BATCH   = 1 << 20   # the upper limit on the number of intervals drawn at once
+
+
+###################################################################################
+class Arrival:
+    ''' The arrival model of the STFs, defined by a dictionary, one of:
+        - {'model': 'fixed',    'interval': 0.1}          (or 'rate' in Hz)
+        - {'model': 'uniform',  'low': 1.0, 'high': 2.0}
+        - {'model': 'poisson',  'rate': 100}              (exponential intervals, or 'interval' for the mean)
+        - {'model': 'bursty',   'rate': 1000, 'burst': 50, 'gap': 2.0}
+
+        In the bursty model STFs come in bursts of the given number, at the given rate (Poisson),
+        separated by pauses drawn from an exponential distribution with the mean 'gap' seconds.
+    '''
+    def __init__(self, spec):
+        self.spec   = dict(spec)
+        self.model  = self.spec.get('model', 'uniform')
+        if self.model == 'exponential': self.model = 'poisson'
+
+        if self.model not in MODELS:
+            raise ValueError(f'''Unknown arrival model {self.model}, must be one of {MODELS}''')
+
+        if self.model in ('fixed', 'poisson', 'bursty'):
+            if 'rate' in self.spec:
+                self.interval = 1.0/float(self.spec['rate'])
+            elif 'interval' in self.spec:
+                self.interval = float(self.spec['interval'])
+            else:
+                raise ValueError(f'''The {self.model} arrival model needs either a rate or an interval''')
+            if self.interval <= 0.0:
+                raise ValueError(f'''The interval of the {self.model} arrival model must be positive''')
+        else:
+            self.low    = float(self.spec['low'])
+            self.high   = float(self.spec['high'])
+            if not 0.0 <= self.low <= self.high:
+                raise ValueError(f'''The uniform arrival model needs 0 <= low <= high, got {self.low} and {self.high}''')
+
+        if self.model == 'bursty':
+            self.burst  = int(self.spec.get('burst', 10))
+            self.gap    = float(self.spec.get('gap', 1.0))
+            if self.burst < 1 or self.gap < 0.0:
+                raise ValueError(f'''The bursty arrival model needs burst >= 1 and gap >= 0, got {self.burst} and {self.gap}''')
+
+        if not self.mean() > 0.0: # the simulated time would not advance
+            raise ValueError(f'''The mean interval of the {self.model} arrival model must be positive, got {self.mean()}''')
+
+        self.count  = 0 # the number of intervals drawn so far, to keep the phase of the bursts
+
+    # ---
+    @classmethod
+    def uniform(cls, low, high):
+        return cls({'model': 'uniform', 'low': low, 'high': high})
+
+    # ---
+    def mean(self):
+        ''' The mean interval between STFs, seconds '''
+        if self.model == 'uniform':
+            return 0.5*(self.low + self.high)
+        if self.model == 'bursty':
+            return self.interval + self.gap/self.burst
+        return self.interval
+
+    # ---
+    def batch_size(self, duration):
+        '''
+        The number of intervals to draw to cover a segment of the given duration, with a margin.
+        '''
+        mean = self.mean()
+        if mean <= 0.0 or not np.isfinite(duration): return MAX_BATCH
+        return int(min(MAX_BATCH, max(16, 1.1*duration/mean + 16)))
+
+    # ---
+    def draw(self, rng, n):
+        '''
+        Draw n intervals between STFs, returns a NumPy array.
+        '''
+        if self.model == 'fixed':
+            x = np.full(n, self.interval)
+        elif self.model == 'uniform':
+            x = rng.uniform(self.low, self.high, n)
+        else:
+            x = rng.exponential(self.interval, n)
+
+        if self.model == 'bursty':
+            # Add a pause after every "burst" STFs, keeping the phase across the batches
+            ends = np.nonzero((self.count + np.arange(1, n+1)) % self.burst == 0)[0]
+            x[ends] += rng.exponential(self.gap, len(ends))
+
+        self.count += n
+        return x
+
+    # ---
+    def __str__(self):
+        return f'''Arrival: {self.spec}'''
+
+    # ---
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,166 @@
+#
+# daq/backpressure.py
+#
+# Closed-loop backpressure: instead of emitting the STFs open loop, the DAQ follows the feedback
+# of the downstream consumers and holds back when they fall behind, as a real DAQ with a full
+# buffer would. The feedback messages come over MQ or a local socket (see control.py):
+#
+#   {"msg_type": "stf_ack", "agent": "...", "run_id": ..., "count": N}   the consumer has processed N STFs of the run
+#   {"msg_type": "stf_ack", "agent": "...", "run_id": ..., "filename": "..."}   the STF processed (or "seq", in the ring)
+#   {"msg_type": "consumer_lag", "agent": "...", "run_id": ..., "lag": N}       the backlog of the consumer, in STFs
+#
+# An acknowledgment of a single STF counts once per consumer, so that a redelivered message does not
+# put the consumer ahead of the producer. A message without a valid count, lag, filename or seq is
+# counted as rejected and otherwise ignored.
+# The lag of a consumer is either the one it reports, or the number of STFs generated and not yet
+# acknowledged by it; the slowest consumer sets the lag of the chain. Only the consumers heard from
+# count, and the messages of other runs are ignored.
+
+
+import threading, time
+
+# ---
+FEEDBACK    = ('stf_ack', 'consumer_lag')
+BP_MODES    = ('pause', 'throttle')
+
+
+###################################################################################
+class Backpressure:
+    ''' Throttles the STF generators on the lag of the consumers, with hysteresis:
+
+        - pause:    when the lag reaches "high", the generators stop until it is down to "low"
+        - throttle: between "low" and "high" the intervals between the STFs are stretched by
+                    (high - low)/(high - lag), i.e. the rate goes down linearly to zero at "high",
+                    beyond which the generators stop as in the pause mode
+
+        While stopped, the generators poll the lag every "poll" (simulated) seconds; in the virtual
+        time mode the poll also waits on the wall clock, in which the consumers run. The time spent
+        stopped and the delay added by the throttling are recorded, see stats().
+    '''
+    def __init__(self, high, low=None, mode='pause', poll=0.01, verbose=False):
+        if mode not in BP_MODES:
+            raise ValueError(f'''Unknown backpressure mode {mode}, must be one of {BP_MODES}''')
+        self.high       = int(high)
+        self.low        = int(low) if low is not None else self.high//2
+        if not 0 <= self.low < self.high:
+            raise ValueError(f'''The resume threshold {self.low} must be below the backpressure threshold {self.high}''')
+        self.mode       = mode
+        self.poll       = poll
+        self.verbose    = verbose
+        self.lock       = threading.Lock()
+        self.reset()
+
+    # ---
+    def reset(self, run_id=None):
+        ''' Forget the consumers and the counters, at the start of a run '''
+        with self.lock:
+            self.run_id     = run_id
+            self.acked      = {}        # the number of STFs acknowledged, by consumer
+            self.seen       = {}        # the STFs acknowledged one by one (filename or seq), by consumer
+            self.reported   = {}        # the lag reported, by consumer
+        self.paused     = False
+        self.since      = 0.0           # the simulated time of the start of the current pause
+        self.pauses     = 0
+        self.paused_time= 0.0           # the total time stopped, simulated seconds
+        self.delayed    = 0.0           # the total delay added to the STF intervals by the throttling, simulated seconds
+        self.max_lag    = 0
+        self.messages   = 0             # the number of the feedback messages taken into account
+        self.duplicates = 0             # the acknowledgments of STFs already acknowledged
+        self.rejected   = 0             # the malformed feedback messages
+
+    # ---
+    def feedback(self, message):
+        '''
+        Take in a feedback message of a consumer, called from the thread receiving it.
+        '''
+        if self.run_id is not None and message.get('run_id', self.run_id) != self.run_id: return # from another run
+        agent   = message.get('agent', '')
+        lag     = count = key = None
+        try:
+            if message.get('msg_type') == 'consumer_lag':
+                lag     = int(message['lag'])
+                if lag < 0: raise ValueError(f'''negative lag {lag}''')
+            elif 'count' in message:
+                count   = int(message['count'])
+                if count < 0: raise ValueError(f'''negative count {count}''')
+            else:
+                key     = message.get('filename', message.get('seq'))
+                if key is None: raise ValueError('neither a count, a filename nor a seq')
+        except (KeyError, ValueError, TypeError) as e:
+            with self.lock: self.rejected += 1
+            if self.verbose: print(f'''*** Backpressure: rejected the feedback {message}: {e} ***''')
+            return
+
+        with self.lock:
+            self.messages += 1
+            if lag is not None:
+                self.reported[agent] = lag
+            elif count is not None:
+                self.acked[agent] = max(self.acked.get(agent, 0), count)
+            else:
+                seen = self.seen.setdefault(agent, set())
+                if key in seen:
+                    self.duplicates += 1
+                    return
+                seen.add(key)
+                self.acked[agent] = self.acked.get(agent, 0) + 1
+
+    # ---
+    def lag(self, sent):
+        ''' The lag of the slowest consumer, given the number of STFs generated '''
+        with self.lock:
+            lags = list(self.reported.values()) + [sent - n for n in self.acked.values()]
+        lag = max(lags) if lags else 0
+        if lag > self.max_lag: self.max_lag = lag
+        return lag
+
+    # ---
+    def level(self, sent, now):
+        '''
+        The fraction of the nominal rate to generate at, from 0 (stopped) to 1 (open loop).
+        '''
+        lag = self.lag(sent)
+        if self.paused:
+            if lag > self.low: return 0.0
+            self.paused         = False
+            self.paused_time   += now - self.since
+            if self.verbose: print(f'''*** Backpressure: resuming at {now:.3f}s, lag {lag} ***''')
+        if lag >= self.high:
+            self.paused, self.since = True, now
+            self.pauses        += 1
+            if self.verbose: print(f'''*** Backpressure: pausing at {now:.3f}s, lag {lag} ***''')
+            return 0.0
+        if self.mode == 'throttle' and lag > self.low:
+            return (self.high - lag)/(self.high - self.low)
+        return 1.0
+
+    # ---
+    def wait(self, env, realtime):
+        '''
+        Wait one poll while stopped, a SimPy event to yield.
+        '''
+        if not realtime: time.sleep(self.poll) # let the consumers catch up on the wall clock
+        return env.timeout(self.poll)
+
+    # ---
+    def close(self, now):
+        ''' Account for the pause in progress, at the end of the run '''
+        if self.paused:
+            self.paused         = False
+            self.paused_time   += now - self.since
+
+    # ---
+    def stats(self):
+        return {
+            'mode':         self.mode,
+            'high':         self.high,
+            'low':          self.low,
+            'consumers':    len(set(self.acked) | set(self.reported)),
+            'messages':     self.messages,
+            'duplicates':   self.duplicates,
+            'rejected':     self.rejected,
+            'max_lag':      self.max_lag,
+            'pauses':       self.pauses,
+            'paused_time':  round(self.paused_time, 6),
+            'delayed':      round(self.delayed, 6),
+        }
@@ -0,0 +1,165 @@
+#
+# daq/campaign.py
+#
+# Campaigns: a list of runs executed back to back by one DAQ instance, in one process, each run
+# with its own schedule, duration, gap and run conditions. The MQ connection, the monitor session,
+# the publisher and the compiled schedules are reused, and the run numbers are leased ahead of time,
+# so the runs of a long soak test do not pay any reinitialization.
+
+
+import threading, collections, random, time, yaml
+
+
+###################################################################################
+class RunNumbers:
+    ''' A lease of run numbers. The numbers come from the fetch callable (e.g. the monitor) and are kept
+        in a local pool, refilled from a background thread to "block" numbers ahead, so the start of a run
+        does not wait for the monitor. Without the fetch callable (the test mode), the numbers are allocated
+        locally and sequentially, from a random base.
+
+        The numbers left in the pool at the end of the campaign are not used.
+    '''
+    def __init__(self, fetch=None, block=8, start=None, verbose=False):
+        self.fetch      = fetch
+        self.block      = block
+        self.verbose    = verbose
+        self.pool       = collections.deque()
+        self.lock       = threading.Condition()
+        self.filling    = False
+        self.error      = None      # the last failure of the background refill
+        self.counter    = start if start is not None else random.randint(1, 1000)
+        self.fetched    = 0         # the number of requests to the monitor
+        self.waited     = 0.0       # the time next() spent waiting for the monitor, seconds
+        if self.fetch: self.refill()
+
+    # ---
+    def next(self):
+        if self.fetch is None:
+            with self.lock:
+                number, self.counter = self.counter, self.counter + 1
+            return number
+
+        self.refill()
+        t = time.perf_counter()
+        with self.lock: # if the lease ran out, wait for the refill, which keeps the numbers in order
+            while not self.pool:
+                if not self.filling:
+                    raise RuntimeError(f'''Failed to lease run numbers: {self.error}''')
+                self.lock.wait()
+            number = self.pool.popleft()
+        self.waited += time.perf_counter() - t
+        self.refill()
+        return number
+
+    # ---
+    def refill(self):
+        ''' Top up the pool in the background, unless it is already being done '''
+        with self.lock:
+            if self.filling or len(self.pool) >= self.block: return
+            self.filling = True
+        threading.Thread(target=self.fill, name='run-numbers', daemon=True).start()
+
+    # ---
+    def fill(self):
+        try:
+            while len(self.pool) < self.block:
+                number = self.fetch()
+                self.fetched += 1
+                with self.lock:
+                    self.pool.append(number)
+                    self.lock.notify_all()
+        except Exception as e:
+            self.error = e
+            print(f'''Warning: failure leasing run numbers: {e}''')
+        finally:
+            with self.lock:
+                self.filling = False
+                self.lock.notify_all()
+        if self.verbose: print(f'''*** Leased run numbers: {list(self.pool)} ***''')
+
+
+###################################################################################
+class Campaign:
+    ''' Runs a list of runs on one DAQ. Each run is a dictionary with the optional keys:
+
+        - schedule:     the schedule (YAML), by default that of the DAQ
+        - until:        the duration of the run, by default that given to the DAQ, else the end of the schedule
+                        (of the trace, when replaying one)
+        - gap:          the pause after the run, seconds (wall clock, scaled by the factor; none in virtual time)
+        - conditions:   the run conditions, sent in the "run imminent" message
+        - low, high:    the limits of the default arrival model
+        - repeat:       the number of times to run it, 1 by default
+
+        The keys of the "defaults" dictionary of the campaign file apply to all the runs.
+    '''
+    KEYS = ('schedule', 'until', 'gap', 'conditions', 'low', 'high', 'repeat')
+
+    def __init__(self, daq, runs, block=8, verbose=False):
+        self.daq        = daq
+        self.runs       = [dict(run) for run in runs for _ in range(int(run.get('repeat', 1)))]
+        self.verbose    = verbose
+        self.results    = []
+        self.base       = {'schedule': daq.schedule_f, 'until': daq.duration, 'low': daq.low, 'high': daq.high, 'conditions': daq.conditions}
+        for run in self.runs:
+            unknown = set(run) - set(self.KEYS)
+            if unknown: raise ValueError(f'''Unknown keys in the definition of a run: {sorted(unknown)}''')
+
+        daq.run_numbers = RunNumbers(None if daq.test else daq.fetch_run_number, block=block, verbose=verbose)
+
+    # ---
+    @classmethod
+    def from_yaml(cls, daq, filename, **kwargs):
+        '''
+        Create the campaign from a YAML file: either a list of runs, or a dictionary
+        with the "runs" list and the "defaults", see config/campaign.yml for an example.
+        '''
+        with open(filename, 'r') as f: spec = yaml.safe_load(f)
+        if isinstance(spec, list): spec = {'runs': spec}
+        defaults = spec.get('defaults') or {}
+        return cls(daq, [dict(defaults, **run) for run in spec.get('runs') or []], **kwargs)
+
+    # ---
+    def configure(self, run):
+        ''' Set up the DAQ for the next run '''
+        daq                 = self.daq
+        run                 = dict(self.base, **run) # what a run does not define is as given to the DAQ
+        previous            = (daq.schedule_f, daq.until, daq.low, daq.high)
+        daq.schedule_f      = run['schedule']
+        daq.until           = run['until']
+        daq.low             = run['low']
+        daq.high            = run['high']
+        try:
+            daq.read_schedule() # the compiled schedule is cached, see schedule.py
+        except Exception:
+            daq.schedule_f, daq.until, daq.low, daq.high = previous # the DAQ stays as it was
+            raise
+        daq.conditions      = dict(run['conditions'])
+
+    # ---
+    def run(self):
+        daq = self.daq
+        for i, run in enumerate(self.runs):
+            t = time.perf_counter()
+            self.configure(run)
+            daq.run()
+            elapsed = time.perf_counter() - t
+
+            result = {'run_id': daq.run_id, 'schedule': daq.schedule_f, 'until': daq.until, 'stfs': daq.Nstf,
+                      'elapsed': round(elapsed, 3), 'startup': round(daq.startup_time, 6)}
+            self.results.append(result)
+            if self.verbose: print(f'''*** Campaign run {i+1}/{len(self.runs)}: {result} ***''')
+
+            gap = run.get('gap', 0)
+            if gap and daq.realtime and i < len(self.runs) - 1: time.sleep(gap*daq.factor)
+
+        return self.results
+
+    # ---
+    def stats(self):
+        return {
+            'runs':         len(self.results),
+            'stfs':         sum(r['stfs'] for r in self.results),
+            'startup_avg':  round(sum(r['startup'] for r in self.results)/len(self.results), 6) if self.results else 0.0,
+            'leased':       self.daq.run_numbers.fetched,
+            'lease_wait':   round(self.daq.run_numbers.waited, 6),
+        }
@@ -0,0 +1,83 @@
+#
+# daq/compress.py
+#
+# Compression of the STF bodies, to trade CPU for bandwidth as the real DAQ chain will.
+# zlib is always available, zstd and lz4 only if the optional packages are installed.
+# The compression runs in the threads of the writer pool: zlib, zstandard and lz4 all
+# release the GIL while compressing, so the threads do compress in parallel.
+
+
+import zlib, time
+
+try:
+    import zstandard # optional, only needed for the zstd codec
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame # optional, only needed for the lz4 codec
+except ImportError:
+    lz4frame = None
+
+# ---
+CODECS = ('zlib', 'zstd', 'lz4')
+LEVELS = {'zlib': 1, 'zstd': 3, 'lz4': 0} # the default compression levels, favouring speed
+
+
+###################################################################################
+class Codec:
+    ''' A compression codec, e.g. Codec('zstd', 3) or Codec.parse('zlib:6').
+
+        The body of an STF is compressed chunk by chunk (see compress()), so a payload is never
+        held in memory uncompressed; the compressed bytes are what goes to the file (or container),
+        and what the checksum is computed on.
+    '''
+    def __init__(self, name='zlib', level=None):
+        if name not in CODECS:
+            raise ValueError(f'''Unknown codec {name}, must be one of {CODECS}''')
+        if name == 'zstd' and zstandard is None:
+            raise ValueError('The zstd codec requires the zstandard package, which is not installed')
+        if name == 'lz4' and lz4frame is None:
+            raise ValueError('The lz4 codec requires the lz4 package, which is not installed')
+
+        self.name   = name
+        self.level  = LEVELS[name] if level is None else int(level)
+
+    # ---
+    @classmethod
+    def parse(cls, spec):
+        ''' Create the codec from a string "name" or "name:level" '''
+        name, _, level = spec.partition(':')
+        return cls(name, level or None)
+
+    # ---
+    def compress(self, chunks):
+        '''
+        Compress an iterable of chunks. Returns the compressed bytes, the raw size and the time spent, seconds.
+        '''
+        t, raw, out = time.perf_counter(), 0, []
+        if self.name == 'zlib':
+            c = zlib.compressobj(self.level)
+        elif self.name == 'zstd':
+            c = zstandard.ZstdCompressor(level=self.level).compressobj()
+        else:
+            c = lz4frame.LZ4FrameCompressor(compression_level=self.level)
+            out.append(c.begin())
+
+        for chunk in chunks:
+            raw += len(chunk)
+            out.append(c.compress(chunk))
+        out.append(c.flush())
+        return b''.join(out), raw, time.perf_counter() - t
+
+    # ---
+    def decompress(self, data):
+        if self.name == 'zlib':
+            return zlib.decompress(data)
+        if self.name == 'zstd':
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        return lz4frame.decompress(data)
+
+    # ---
+    def __str__(self):
+        return f'''{self.name}:{self.level}'''
@@ -0,0 +1,144 @@
+#
+# daq/container.py
+#
+# Packed output: instead of a file per STF, the STFs of a run are appended to rolling container
+# files of a configurable size, and an append-only binary index locates each of them. Long runs
+# then create a handful of large files rather than hundreds of thousands of inodes.
+#
+# In the run folder:
+#   - <prefix>.NNNN.pack: the containers, the STFs back to back without any framing
+#   - <prefix>.index:     fixed-size records (INDEX): filename, container number, offset, length, Adler-32
+
+
+import numpy as np
+import threading, os
+
+# ---
+INDEX = np.dtype([
+    ('filename',    'S32'),     # the (logical) filename of the STF, as announced in the MQ messages
+    ('container',   '<u4'),     # the number of the container
+    ('offset',      '<u8'),     # the offset of the STF in the container
+    ('length',      '<u8'),     # the size of the STF
+    ('adler32',     '<u4'),     # the Adler-32 checksum of the STF
+])
+
+
+###################################################################################
+class Slot:
+    ''' A file-like object writing to a reserved range of a container, see Container.reserve() '''
+    def __init__(self, fd, offset):
+        self.fd     = fd
+        self.offset = offset
+
+    def write(self, data):
+        ''' Write all of the data, over as many calls as needed: a single pwrite may be short (at most ~2 GiB on Linux) '''
+        view    = memoryview(data).cast('B')
+        n       = len(view)
+        while view:
+            k = os.pwrite(self.fd, view, self.offset)
+            if k == 0: raise OSError(f'''No progress writing to the container at offset {self.offset}''')
+            self.offset += k
+            view         = view[k:]
+        return n
+
+
+###################################################################################
+class Container:
+    ''' The rolling containers and the index of one run.
+
+        The space for each STF is reserved under a lock, and the data itself is written outside of it,
+        at the reserved offset, so the threads of the writer pool still write in parallel. A container
+        is closed once it is full and all the writes into it are complete. If "sync" is set, the data
+        and the index record of each STF are synced to disk before it is announced.
+    '''
+    def __init__(self, folder, prefix, max_size=1<<30, sync=False):
+        self.folder     = folder
+        self.prefix     = prefix
+        self.max_size   = max_size
+        self.sync       = sync
+        self.lock       = threading.Lock()
+        self.files      = {}        # the open containers: number -> [fd, the number of writes in progress]
+        self.current    = -1        # the number of the container being filled
+        self.size       = 0         # its size so far, including the reserved space
+        self.count      = 0         # the number of STFs in all the containers
+        self.index      = open(os.path.join(folder, f'''{prefix}.index'''), 'ab')
+
+    # ---
+    def container_name(self, k):
+        return f'''{self.prefix}.{k:04d}.pack'''
+
+    # ---
+    def roll(self):
+        self.current   += 1
+        self.size       = 0
+        fd = os.open(os.path.join(self.folder, self.container_name(self.current)), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.files[self.current] = [fd, 0]
+        self.release(self.current - 1, done=False)
+
+    # ---
+    def release(self, k, done=True):
+        ''' Mark a write into the container k as complete, and close the container if it is no longer needed '''
+        entry = self.files.get(k)
+        if entry is None: return
+        if done: entry[1] -= 1
+        if entry[1] == 0 and k != self.current:
+            os.close(entry[0])
+            del self.files[k]
+
+    # ---
+    def reserve(self, length):
+        '''
+        Reserve the space for an STF of the given length, rolling over to a new container if needed.
+        Returns the container number, the offset and a file-like object to write the STF through.
+        '''
+        with self.lock:
+            if self.current < 0 or (self.size > 0 and self.size + length > self.max_size): self.roll()
+            k, offset   = self.current, self.size
+            self.size  += length
+            self.files[k][1] += 1
+            return k, offset, Slot(self.files[k][0], offset)
+
+    # ---
+    def commit(self, filename, k, offset, length, adler32):
+        '''
+        Complete the write of an STF: append its record to the index.
+        '''
+        r = np.zeros(1, dtype=INDEX)
+        r['filename'], r['container'], r['offset'], r['length'], r['adler32'] = filename.encode(), k, offset, length, adler32
+        if self.sync: os.fsync(self.files[k][0]) # still open, the write is in progress
+        with self.lock:
+            self.index.write(r.tobytes())
+            if self.sync:
+                self.index.flush()
+                os.fsync(self.index.fileno())
+            self.count += 1
+            self.release(k)
+
+    # ---
+    def close(self):
+        with self.lock:
+            for fd, _ in self.files.values(): os.close(fd)
+            self.files = {}
+            self.index.close()
+
+    # ---
+    def stats(self):
+        return {'containers': self.current + 1, 'stfs': self.count}
+
+
+# ---
+def read_index(filename):
+    '''
+    Read the index of a run, returns a NumPy structured array (INDEX).
+    '''
+    return np.fromfile(filename, dtype=INDEX)
+
+
+# ---
+def read_stf(folder, prefix, entry):
+    '''
+    Read the data of the STF described by an entry of the index.
+    '''
+    with open(os.path.join(folder, f'''{prefix}.{int(entry['container']):04d}.pack'''), 'rb') as f:
+        f.seek(int(entry['offset']))
+        return f.read(int(entry['length']))
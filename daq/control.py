@@ -0,0 +1,276 @@
+#
+# daq/control.py
+#
+# The daemon mode: the DAQ stays up with its connections, compiled schedules and run number
+# lease warm, and does the runs on demand, as told by the control messages (JSON):
+#
+#   {"msg_type": "control", "command": "start", "schedule": ..., "until": ..., "conditions": {...}}
+#   {"msg_type": "control", "command": "stop"}         end the run now, as at the end of the schedule
+#   {"msg_type": "control", "command": "abort"}        the same, with "status": "aborted" in the end_run message
+#   {"msg_type": "control", "command": "status"}       reply with the state of the daemon and the timing stats
+#   {"msg_type": "control", "command": "shutdown"}     exit the daemon, after the run in progress
+#   {"msg_type": "control", "command": "shape", ...}   change the load during the run, see shaping.py
+#
+# The parameters of a start command are those of a run of a campaign (schedule, until, conditions,
+# low, high, see campaign.py), what is not given is as given to the DAQ. A message with "agent" set
+# is only for the agent of that name. Each command gets a "control_reply" message, with the "req_id"
+# of the command; the reply to a start command is sent once the run has started, and the shape
+# commands are accepted from then on.
+#
+# The control messages come either from the broker (the Receiver of mq_comms, the replies are sent
+# as the other messages of the DAQ), or from a local socket ("socket:HOST:PORT" or "socket:PATH"),
+# as JSONL, with the replies sent back on the same connection. The Listener below is also used for
+# the feedback of the consumers, see backpressure.py: the DAQ dispatches the messages by their type.
+
+
+import threading, queue, socketserver, json, os, time
+
+from .campaign import Campaign
+from .schedule import Schedule
+from .shaping  import SHAPES
+
+# ---
+COMMANDS    = ('start', 'stop', 'abort', 'status', 'shutdown', 'shape')
+RUN_KEYS    = ('schedule', 'until', 'conditions', 'low', 'high') # the parameters of the start command
+
+
+###################################################################################
+class MessageHandler(socketserver.StreamRequestHandler):
+    ''' A connection of the local socket: a JSON message per line, the replies are written back '''
+    def handle(self):
+        lock = threading.Lock() # the reply to a start command comes from the thread doing the runs
+        def reply(msg):
+            with lock:
+                self.wfile.write((json.dumps(msg) + '\n').encode())
+                self.wfile.flush()
+
+        for line in self.rfile:
+            if not line.strip(): continue
+            try:
+                message = json.loads(line)
+            except Exception as e:
+                reply({'msg_type': 'control_reply', 'status': 'error', 'error': f'''Invalid message: {e}'''})
+                continue
+            self.server.daq.dispatch(message, reply)
+
+class TCPMessageServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+class UnixMessageServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads      = True
+
+
+###################################################################################
+class Listener:
+    ''' Receives the messages addressed to the DAQ (control, feedback of the consumers) from the
+        broker ("stomp", via the Receiver of mq_comms) or from a local socket ("socket:HOST:PORT" or
+        "socket:PATH"), and hands them to DAQ.dispatch() in the threads of the Receiver or of the socket.
+    '''
+    def __init__(self, daq, source='stomp', verbose=False):
+        self.daq        = daq
+        self.source     = source
+        self.verbose    = verbose
+        self.receiver   = None
+        self.server     = None
+
+    # ---
+    def open(self):
+        kind, _, arg = self.source.partition(':')
+        if kind == 'stomp':
+            from mq_comms import Receiver # the broker is only needed for this source
+            self.receiver = Receiver(verbose=self.verbose, client_id=self.daq.agent_name, processor=self.daq.on_message)
+            self.receiver.connect()
+        elif kind == 'socket':
+            if not arg: raise ValueError('The socket needs an address, e.g. socket:localhost:61620 or socket:/tmp/daq-control.sock')
+            if ':' in arg:
+                host, port  = arg.rsplit(':', 1)
+                self.server = TCPMessageServer((host or 'localhost', int(port)), MessageHandler)
+            else:
+                if os.path.exists(arg): os.unlink(arg) # left over by a previous process
+                self.server = UnixMessageServer(arg, MessageHandler)
+            self.server.daq = self.daq
+            threading.Thread(target=self.server.serve_forever, name='daq-listener', daemon=True).start()
+        else:
+            raise ValueError(f'''Unknown source of the messages {self.source}, must be stomp or socket:ADDRESS''')
+
+    # ---
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            if isinstance(self.server, UnixMessageServer): os.unlink(self.source.partition(':')[2])
+            self.server = None
+        if self.receiver:
+            self.receiver.disconnect()
+            self.receiver = None
+
+
+###################################################################################
+class Controller:
+    ''' Handles the control messages of the daemon mode, see the header of this file. The commands
+        arrive in the threads of the Receiver or of the control socket; the runs are done in the thread
+        calling serve(), one at a time, and are stopped via the halt event of the DAQ.
+    '''
+    def __init__(self, daq, source='stomp', block=8, verbose=False):
+        self.daq        = daq
+        self.source     = source        # where the control messages come from: stomp, socket:HOST:PORT or socket:PATH
+        self.verbose    = verbose
+        self.campaign   = Campaign(daq, [], block=block, verbose=verbose) # the set-up of the runs, and the run number lease
+        self.commands   = queue.Queue() # the accepted start commands
+        self.lock       = threading.Lock()
+        self.busy       = False         # a run is requested or in progress
+        self.running    = False         # the run has started: it was set up, and the shaping it gets is no longer reset
+        self.done       = threading.Event()
+        self.listener   = Listener(daq, source, verbose=verbose)
+        self.started    = time.monotonic()
+        self.runs       = 0
+        self.latency    = []            # from the start command to the start of the run, seconds
+
+        daq.halt        = threading.Event()
+        daq.controller  = self
+
+    # ---
+    def open(self):
+        ''' Start listening to the control messages '''
+        self.listener.open()
+        print(f'''*** The DAQ daemon {self.daq.agent_name} is listening to the control messages from {self.source} ***''')
+
+    # ---
+    def close(self):
+        self.listener.close()
+
+    # ---
+    def handle(self, message, reply=None):
+        '''
+        Handle a control message, replying with the reply callable if given, or else via MQ.
+        Called from the threads receiving the messages, so the runs themselves are only queued here.
+        '''
+        t       = time.perf_counter()
+        command = message.get('command')
+        agent   = message.get('agent')
+        if agent and agent != self.daq.agent_name: return # for another agent
+        if self.verbose: print(f'''*** Control message: {message} ***''')
+
+        if command == 'status':
+            return self.reply(message, reply, status='OK', **self.stats())
+
+        if command == 'start':
+            run = {k: message[k] for k in RUN_KEYS if k in message}
+            try: # fail here rather than in the run, the compiled schedule is cached
+                self.check(run)
+            except Exception as e:
+                return self.reply(message, reply, status='error', error=str(e))
+            with self.lock:
+                if self.busy: return self.reply(message, reply, status='error', error='A run is already in progress')
+                self.busy = True
+                self.daq.halt.clear()
+                self.daq.aborted = False
+            self.commands.put((run, t, message, reply))
+            return
+
+        if command in ('stop', 'abort'):
+            with self.lock:
+                if not self.busy: return self.reply(message, reply, status='error', error='No run in progress')
+                if command == 'abort': self.daq.aborted = True
+                self.daq.halt.set()
+            return self.reply(message, reply, status='OK', run_id=self.daq.run_id)
+
+        if command == 'shape':
+            with self.lock:
+                if not self.busy: return self.reply(message, reply, status='error', error='No run in progress')
+                if not self.running: return self.reply(message, reply, status='error', error='The run has not started yet')
+            if self.daq.trace: return self.reply(message, reply, status='error', error='The load of a replayed trace can not be shaped')
+            changes = {k: message[k] for k in SHAPES if k in message}
+            if changes.get('factor') is not None and not self.daq.realtime:
+                return self.reply(message, reply, status='error', error='The time factor can not be changed in the virtual time mode')
+            try:
+                self.daq.shaper.stage(changes, self.daq.schedule)
+            except Exception as e:
+                return self.reply(message, reply, status='error', error=f'''Invalid shaping: {e}''')
+            return self.reply(message, reply, status='OK', run_id=self.daq.run_id, staged=changes) # applied at the next STF
+
+        if command == 'shutdown':
+            self.done.set()
+            return self.reply(message, reply, status='OK')
+
+        self.reply(message, reply, status='error', error=f'''Unknown command {command}, must be one of {COMMANDS}''')
+
+    # ---
+    def check(self, run):
+        '''
+        Validate the parameters of a start command: the schedule and its arrival and size models,
+        as the run would set them up (see DAQ.read_schedule). Raises ValueError if they are invalid.
+        '''
+        schedule_f  = run.get('schedule', self.campaign.base['schedule'])
+        low         = run.get('low',      self.campaign.base['low'])
+        high        = run.get('high',     self.campaign.base['high'])
+        try:
+            schedule = Schedule.compile(schedule_f)
+        except Exception as e:
+            raise ValueError(f'''Error in the schedule {schedule_f}: {e}''')
+        self.daq.check_models(schedule, low, high, schedule_f)
+
+    # ---
+    def reply(self, message, reply, **fields):
+        msg = {'msg_type': 'control_reply', 'req_id': message.get('req_id', 1), 'command': message.get('command'),
+               'agent': self.daq.agent_name, **fields}
+        if self.verbose: print(f'''*** Control reply: {msg} ***''')
+        if reply:
+            try:
+                reply(msg)
+            except Exception as e:
+                print(f'''Warning: failure replying to the control message: {e}''')
+        elif self.daq.mq_active():
+            self.daq.publish(self.daq.encoder.encode(msg))
+
+    # ---
+    def serve(self):
+        '''
+        Do the runs requested by the start commands, until the shutdown command or an interrupt.
+        The control messages are listened to from open(), called before.
+        '''
+        try:
+            while not self.done.is_set():
+                try:
+                    run, t, message, reply = self.commands.get(timeout=0.2)
+                except queue.Empty:
+                    continue
+
+                state = {'started': False}
+                def started():
+                    state['started'] = True
+                    with self.lock: self.running = True
+                    self.latency.append(time.perf_counter() - t)
+                    self.reply(message, reply, status='OK', run_id=self.daq.run_id, dataset=self.daq.dataset,
+                               latency=round(self.latency[-1], 6), startup=round(self.daq.startup_time, 6))
+                try:
+                    self.campaign.configure(run)
+                    self.daq.run(on_start=started)
+                    self.runs += 1
+                except (Exception, SystemExit) as e: # the daemon stays up, e.g. if the monitor did not give a run number or the run folder could not be created
+                    print(f'''Warning: the run failed: {e}''')
+                    if not state['started']: self.reply(message, reply, status='error', error=str(e))
+                finally:
+                    with self.lock: self.busy = self.running = False
+        except KeyboardInterrupt:
+            print("\nDaemon interrupted by user")
+        finally:
+            self.close()
+        if self.verbose: print(f'''*** The DAQ daemon is exiting: {self.stats()} ***''')
+
+    # ---
+    def stats(self):
+        latency = self.latency
+        stats = {
+            'state':            'running' if self.busy else 'idle',
+            'uptime':           round(time.monotonic() - self.started, 3),
+            'runs':             self.runs,
+            'start_latency':    round(latency[-1], 6) if latency else 0.0,
+            'start_latency_avg':round(sum(latency)/len(latency), 6) if latency else 0.0,
+            'start_latency_max':round(max(latency), 6) if latency else 0.0,
+            'startup':          round(self.daq.startup_time, 6),
+            'lease_wait':       round(self.daq.run_numbers.waited, 6),
+        }
+        if self.busy: stats['run'] = dict(self.daq.live_stats(), shaping=self.daq.shaper.profile())
+        return stats
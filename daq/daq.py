@@ -5,15 +5,34 @@
 # There are a number of utility functions as well.
 #
 # STF MQ mewssages are stubbed out, and then updated with the checksum and size of the generated STF file.
+# The checksum and size are accumulated while the file is being written, see integrity.py.
 
 
 import numpy as np
-import simpy, yaml, random, json, bisect, zlib, os, requests, random, urllib3
+import simpy, random, json, os, threading, time
 import datetime
 from   datetime import datetime as dt
 
-from rucio_comms.utils import calculate_adler32_from_file, get_file_size
-from api_utils import get_next_run_number, get_next_agent_id  # to get the next run number from the run monitor (common)
+from .integrity import ChecksumWriter, make_digest
+from .writer    import WriterPool
+from .publisher import Publisher
+from .schedule  import Schedule
+from .stream    import Stream, make_streams
+from .metrics   import Metrics, MetricsExporter
+from .pacing    import PacedEnvironment, CATCHUP
+from .trace     import TraceRecorder, Trace
+from .container import Container
+from .compress  import Codec
+from .encoding  import make_encoder, Timestamps
+from .transport import make_sender
+from .monitor   import MonitorClient, HEARTBEAT, RUN_NUMBER
+from .shaping   import Shaper
+from .backpressure import Backpressure, FEEDBACK
+from .layout    import Storage
+from .ring      import RingBuffer
+from .profiling import Profiler
+from .payload   import Payload
+from .arrival   import Arrival
 # ---
 timeformat = "%Y%m%d%H%M%S%f"  # Format for the STF start and end times in metadata
 
@@ -33,8 +52,12 @@ class DAQ:
         at random intervals within the specified limits optionally writing them to filea
         and/or sending a message to a message queue (MQ) for further processing.
         The class uses SimPy for event simulation and can be configured to run in real-time or accelerated time.
+        With realtime=False the same processes are driven by a plain SimPy environment, as fast as possible,
+        and all timestamps are derived from the simulated time rather than the wall clock.
     
         Note that the sended is initialized externally, so that the DAQ can send messages to a message queue (MQ) if needed.  
+        A sender may also be given to the constructor (any object with the send/connect/disconnect methods
+        of mq_comms.Sender), in which case it is used even in the test mode, e.g. for offline benchmarks.
     '''
     def __init__(self,
                  schedule_f=None,
@@ -45,24 +68,63 @@ class DAQ:
                  low=1.0,
                  high=2.0,
                  verbose=False,
-                 test=False):
+                 test=False,
+                 realtime=True,
+                 payload=None,
+                 digests=(),
+                 writers=0,
+                 queue_depth=64,
+                 queue_policy='block',
+                 async_mq=False,
+                 mq_depth=1024,
+                 seed=None,
+                 streams=1,
+                 sender=None,
+                 metrics_file=None,
+                 metrics_interval=10.0,
+                 catchup='burst',
+                 tolerance=0.01,
+                 resolution=1e-4,
+                 record=None,
+                 replay=None,
+                 pack=0,
+                 compress=None,
+                 encoding='json',
+                 transport='stomp',
+                 heartbeat=30.0,
+                 backpressure=0,
+                 resume=None,
+                 bp_mode='pause',
+                 layout='flat',
+                 max_files=0,
+                 durability=None,
+                 ring=None,
+                 ring_size=256<<20,
+                 ring_slots=4096,
+                 profile=None,
+                 profile_dir='.',
+                 profile_interval=0.005):
         
         self.state      = None          # current state of the DAQ, undergoes changes in time
         self.substate   = None          # current substate of the DAQ, undergoes changes in time
         self.schedule_f = schedule_f    # filename, of the YAML definition of the schefule
         self.destination= destination   # container folder for the output data folders, if empty do not write
         self.folder     = ''            # the actual folder for the current run, to be created later
-        self.schedule   = None          # the actual schedule (a dictionary), to be filled later
-        self.index      = 0             # current index into the schedule (currently a list of points)
+        self.schedule   = None          # the compiled schedule (a table of transitions), to be filled later
+        self.index      = 0             # current index into the schedule (the segment we are in)
         self.verbose    = verbose       #
         self.until      = until         # total duration of the sim
-        self.clock      = clock         # scheduler clock
+        self.duration   = until         # the duration as given, None for the end of the schedule ("until" is resolved from it)
+        self.clock      = clock         # scheduler clock (the state transitions themselves are event-driven)
         self.factor     = factor        # real-time scaling factor
         self.low        = low           # low limit on the STF prod time
-        self.high       = high          # high limit on same
+        self.high       = high          # high limit on same, these two apply where the schedule defines no arrival model
+        self.streams    = []            # the readout streams, each with its own STF generator process
+        self.rng        = np.random.default_rng(seed) # the source of the STF arrival times
         self.points     = []            # state switch points on the time axis, to be filled later
         self.end        = 0.0           # will be updated -- the last of the points
-        self.Nstf       = 0             # the counter of the generated STFs
+        self.Nstf       = 0             # the counter of the generated STFs, in all streams
+        self.Ndropped   = 0             # the STFs counted above but dropped once compressed, too large for the ring
         self.env        = None          # the SimPy environment, to be created later
         self.run_id     = ''            # to be filled later, the run name/number etc
         self.dataset    = ''            # to be filled later, based on the run number
@@ -71,6 +133,136 @@ class DAQ:
         self.run_start  = ''            # the start time of the run, to be used in the metadata
         self.run_stop   = ''            # the stop time of the run, to be used in the metadata
         self.test       = test          # test mode, if True get run number randomly, if False use API (not implemented yet)
+        self.realtime   = realtime      # if False, run in virtual time as fast as possible
+        self.t0         = None          # the wall clock datetime corresponding to 0.0 on the simulation time axis
+        self.payload    = payload       # the generator of binary STF bodies (a Payload), if None the metadata is written instead
+        self.digests    = tuple(digests)# extra digests (e.g. crc32, xxh64) computed along with Adler-32 while writing
+
+        self.writers    = writers       # number of background writer threads, if 0 write in the generator itself
+        self.durable    = writers > 0   # by default, sync the output before announcing it when the writer pool is asked for
+        self.queue_depth= queue_depth   # the bound on the writer queue
+        self.queue_policy=queue_policy  # what to do when the writer queue is full: block, drop or spill
+        self.writer     = None          # the writer pool, created for each run if needed
+        self.mq_lock    = threading.Lock() # the MQ sender may be used from the writer threads
+        self.async_mq   = async_mq      # if True, MQ messages are sent from a background publisher thread
+        self.mq_depth   = mq_depth      # the bound on the publisher queue
+        self.publisher  = None          # the asynchronous publisher, created with the sender
+        self.sender     = sender        # the MQ sender, created in init_mq unless given here
+        self.transport  = transport     # the transport backend of the messages (see transport.py), unless a sender is given
+        self.sender_given = sender is not None or transport.partition(':')[0] != 'stomp' # used in the test mode too
+        self.bytes_written = 0          # the total size of the STF files written
+        self.checksum_time = 0.0        # the total time spent on the checksums, seconds
+        self.stats_lock = threading.Lock() # the counters above are updated from the writer threads
+        self.metrics    = Metrics()     # stage latency histograms, counters and gauges, see metrics.py
+        self.metrics_file = metrics_file # where to export the metrics (.prom: Prometheus textfile, else JSON), if set
+        self.metrics_interval = metrics_interval # seconds between the exports
+        self.exporter   = None          # the periodic exporter of the metrics, started with the run
+        self.catchup    = catchup       # what to do when the real-time pacing falls behind: burst, skip or stretch
+        self.tolerance  = tolerance     # the lag beyond which the catch-up policy applies, seconds
+        self.resolution = resolution    # the STFs due within this time of each other are produced in one wakeup, seconds
+        self.record     = record        # the trace file to record the STF arrivals of the run to, if set
+        self.recorder   = None          # the trace recorder, created for each run if needed
+        self.trace      = None          # the trace being replayed (a Trace), instead of the STF generators
+        self.stop       = None          # the event ending the simulation early, e.g. the end of the replay
+        self.pack       = pack          # the size of the container files in the packed output mode, if 0 write a file per STF
+        self.container  = None          # the containers and the index of the run, in the packed mode
+        self.codec      = None          # the compression of the STF bodies (a Codec), if None they are stored as is
+        self.raw_bytes  = 0             # the total size of the STF bodies before the compression
+        self.compress_time = 0.0        # the total time spent compressing, seconds
+        self.timestamps = Timestamps()  # the formatting of the STF start and end times, see encoding.py
+        self.heartbeat  = heartbeat     # the interval between the heartbeats to the monitor during the run, seconds
+        self.monitor    = None          # the client of the run monitor, outside of the test mode
+        self.beat_mark  = (0.0, 0)      # the wall clock time and the number of STFs at the last heartbeat, for the rates
+        self.run_numbers= None          # the lease of run numbers (see campaign.py), if None they are requested one by one
+        self.startup_time = 0.0         # the time it took to start the last run, seconds
+        self.halt       = None          # a threading.Event ending the run early when set, in the daemon mode (see control.py)
+        self.aborted    = False         # if True, the run was aborted, which the end of run message says
+        self.controller = None          # the handler of the control messages, in the daemon mode
+        self.shaper     = Shaper()      # the live shaping of the load by the control messages, see shaping.py
+        self.backpressure = None        # the throttling on the lag of the consumers (see backpressure.py), if enabled
+        self.storage    = None          # the layout of the STF files in the run folder and their durability, see layout.py
+        self.ring       = None          # the shared-memory ring buffer the STFs are handed off in (see ring.py), instead of files
+        self.profiler   = None          # the profiling of the hot path of the runs (see profiling.py), if enabled
+        self.conditions = {             # the run conditions, sent with the "run imminent" message
+                "beam_energy": "5 GeV",
+                "magnetic_field": "1.5T",
+                "detector_config": "physics",
+                "bunch_structure": "216x216"
+            }
+
+        for d in self.digests: make_digest(d) # fail early on unknown or unavailable digests
+
+        try:
+            self.encoder = make_encoder(encoding) # the encoding of the MQ messages
+        except Exception as e:
+            print(f'''*** Error in the message encoding {encoding}: {e}, exiting... ***''')
+            exit(-1)
+        self.mq_headers = {'persistent': 'true'}
+        if self.encoder.name != 'json': self.mq_headers['content-type'] = self.encoder.content_type
+
+        if compress:
+            try:
+                self.codec = Codec.parse(compress)
+            except Exception as e:
+                print(f'''*** Error in the compression codec {compress}: {e}, exiting... ***''')
+                exit(-1)
+            if self.writers == 0: # the compression is done off the event loop, by the writer pool
+                self.writers = min(4, os.cpu_count() or 1)
+                if self.verbose: print(f'''*** Compressing with {self.codec}, using {self.writers} writer threads ***''')
+
+        # By default, the files written by the writer pool are synced, so that they are durable when announced;
+        # not so if the pool was only started for the compression
+        try:
+            self.storage = Storage(layout, max_files, durability or ('each' if self.durable else 'none'), verbose=self.verbose)
+        except Exception as e:
+            print(f'''*** Error in the output layout or durability: {e}, exiting... ***''')
+            exit(-1)
+
+        if ring:
+            try:
+                self.ring = RingBuffer(ring, ring_size, ring_slots)
+            except Exception as e:
+                print(f'''*** Error creating the ring buffer {ring}: {e}, exiting... ***''')
+                exit(-1)
+            if self.verbose: print(f'''*** Handing off the STFs in the {self.ring} ***''')
+
+        if profile:
+            try:
+                self.profiler = Profiler(profile, profile_dir, interval=profile_interval, verbose=self.verbose)
+            except Exception as e:
+                print(f'''*** Error in the profiling settings: {e}, exiting... ***''')
+                exit(-1)
+            if self.verbose: print(f'''*** The runs are profiled: {self.profiler} ***''')
+
+        if backpressure > 0:
+            try:
+                self.backpressure = Backpressure(backpressure, resume, mode=bp_mode, verbose=self.verbose)
+            except Exception as e:
+                print(f'''*** Error in the backpressure settings: {e}, exiting... ***''')
+                exit(-1)
+
+        if self.catchup not in CATCHUP:
+            print(f'''*** Unknown catch-up policy "{self.catchup}", expected one of {CATCHUP}, exiting... ***''')
+            exit(-1)
+
+        try:
+            self.streams = make_streams(streams)
+        except Exception as e:
+            print(f'''*** Error in the definition of the streams {streams}: {e}, exiting... ***''')
+            exit(-1)
+        self.multistream = len(self.streams) > 1 # if True, the stream ID goes into the filenames and metadata
+
+        if replay:
+            try:
+                self.trace = Trace(replay)
+            except Exception as e:
+                print(f'''*** Error opening the trace {replay}: {e}, exiting... ***''')
+                exit(-1)
+            if self.verbose: print(f'''*** Replaying {self.trace} ***''')
+            # The streams, the presence of a payload and by default the duration (see read_schedule) come from the trace
+            self.streams        = [Stream(i) for i in self.trace.header['streams']]
+            self.multistream    = self.trace.header['multistream']
+            if self.trace.header['payload'] and self.payload is None: self.payload = Payload()
 
         self.agent_name = 'daq-simulator'
         self.agent_type = 'daqsim'
@@ -81,16 +273,9 @@ class DAQ:
             if self.verbose:
                 print(f'''*** The SWF_MONITOR_URL is set to {self.monitor_url} ***''')
                 print(f'''*** The access token is set to {self.api_token} ***''')
-            self.api_session = requests.Session()
-            
-            if self.api_token:
-                self.api_session.headers.update({'Authorization': f'Token {self.api_token}'})
-
-            self.api_session.verify = False
-            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-            # Send initial registration/heartbeat: self.send_heartbeat()        
-        
-            agent_id = self.get_next_agent_id()
+            # The requests to the monitor go through a pooled session, the heartbeats from a background thread
+            self.monitor     = MonitorClient(self.monitor_url, self.api_token, interval=self.heartbeat, verbose=self.verbose)
+            self.api_session = self.monitor.session
         
             import getpass
             username = getpass.getuser()
@@ -99,35 +284,42 @@ class DAQ:
                 
             print(f'''*** The agent name is {self.agent_name} ***''')
         
-        self.read_schedule()            # read the schedule from the YAML file
+        try:
+            self.read_schedule()        # read the schedule from the YAML file
+        except Exception as e:
+            print(f'''*** {e}, exiting... ***''')
+            exit(-1)
         self.init_mq()                  # initialize the MQ sender and receiver
 
     # ---
     def init_mq(self):
         ''' Initialize the MQ receiver to get messages from the DAQ simulator.
         '''
-        try:
-            from mq_comms import Sender, Receiver
-        except:
-            if self.verbose: print('*** Failed to import the Sender and Receiver from comms, exiting...***')
-            exit(-1)
+        if self.sender is not None:
+            if self.verbose: print(f'''*** Using the sender given to the DAQ: {type(self.sender).__name__} ***''')
+        else:
+            try:
+                self.sender = make_sender(self.transport, verbose=self.verbose)
+                if self.verbose: print(f'''*** Successfully instantiated the {self.transport} sender ***''')
+            except ImportError:
+                if self.verbose: print('*** Failed to import the Sender and Receiver from comms, exiting...***')
+                exit(-1)
+            except Exception as e:
+                print(f'''*** Failed to instantiate the {self.transport} sender: {e}, exiting...***''')
+                exit(-1)
 
-        try:
-            self.sender = Sender(verbose=self.verbose)
-            if self.verbose: print(f'''*** Successfully instantiated the Sender ***''')
-            self.sender.connect()
-            if self.verbose: print(f'''*** Successfully connected the Sender to MQ ***''')
-        except:
-            print('*** Failed to instantiate the Sender, exiting...***')
-            exit(-1)
+            try:
+                self.sender.connect()
+                if self.verbose: print(f'''*** Successfully connected the Sender to {self.transport} ***''')
+            except Exception as e:
+                print(f'''*** Failed to connect the Sender to {self.transport}: {e}, exiting...***''')
+                exit(-1)
 
-        try:
-            # self.receiver = Receiver(verbose=self.verbose, client_id="daq", processor=self.on_message) # a function to process received messages
-            # self.receiver.connect()
-            if self.verbose: print(f'''*** Successfully instantiated and connected the Receiver, will receive messages from MQ ***''')
-        except:
-            print('*** Failed to instantiate the Receiver, exiting...***')
-            exit(-1)
+        if self.async_mq:
+            self.publisher = Publisher(self.sender, destination='epictopic', depth=self.mq_depth, verbose=self.verbose, metrics=self.metrics)
+            if self.verbose: print(f'''*** Started the asynchronous MQ publisher, queue depth {self.mq_depth} ***''')
+
+        # The Receiver of the control messages (see on_message) is created by the Controller in the daemon mode, see control.py
 
     # ---
     def on_message(self, msg):
@@ -137,59 +329,135 @@ class DAQ:
 
         try:
             message_data = json.loads(msg)
-            # Will add later -
-            # msg_type = message_data.get('msg_type')
-            # print(f'=============================> {msg_type}')
-            # if msg_type == 'control':
-            #     self.handle_control_message(message_data)
-            # else:
-            #     print("Ignoring unknown message type", msg_type)
+            self.dispatch(message_data)
         except Exception as e:
             print(f"CRITICAL: Message processing failed - {str(e)}")
 
+    # ---
+    def dispatch(self, message, reply=None):
+        '''
+        Hand an incoming message to its handler by type: the control messages of the daemon mode
+        (see control.py), and the feedback of the consumers (see backpressure.py). The reply callable
+        is given by the local socket, the replies are sent over MQ otherwise.
+        '''
+        msg_type = message.get('msg_type')
+        if msg_type == 'control' and self.controller:
+            self.controller.handle(message, reply)
+        elif msg_type in FEEDBACK and self.backpressure:
+            self.backpressure.feedback(message)
+        elif self.verbose and msg_type != 'control_reply':
+            print("Ignoring unknown message type", msg_type)
+
+    # ---
+    def mq_active(self):
+        '''
+        Messages are sent outside of the test mode, or whenever the sender was given explicitly.
+        '''
+        return self.sender is not None and (not self.test or self.sender_given)
+
+    # ---
+    def publish(self, body):
+        '''
+        Send a message to MQ, either directly or via the asynchronous publisher.
+        '''
+        if self.publisher:
+            self.publisher.publish(body, self.mq_headers)
+        else:
+            with self.mq_lock:
+                self.sender.send(destination='epictopic', body=body, headers=self.mq_headers)
+
     # ---
     def get_next_agent_id(self):
         """Get the next agent ID from persistent state API."""
+        from api_utils import get_next_agent_id # from the common library, only needed outside of the test mode
         return get_next_agent_id(self.monitor_url, self.api_session, logger=None)
     
     # ---
     def read_schedule(self):
+        '''
+        Read the schedule from the YAML file and compile it into a table of transitions,
+        see schedule.py. Repeat blocks are unrolled, and the compiled table is cached.
+        Raises ValueError if the schedule or its models are invalid, nothing is changed then.
+        Without a duration, the run ends with the schedule, or with the trace when replaying one.
+        '''
+        if not os.path.exists(self.schedule_f):
+            raise ValueError(f'''Error opening the schedule file {self.schedule_f}''')
+
         try:
-            f = open(self.schedule_f, 'r') # to read YAML from
-        except:
-            print(f'''Error opening the schedule file {self.schedule_f}, exiting...''')
-            exit(-1)
+            schedule = Schedule.compile(self.schedule_f)
+        except Exception as e:
+            raise ValueError(f'''Error in the schedule file {self.schedule_f}: {e}''')
+        self.check_models(schedule, self.low, self.high)
+        self.schedule   = schedule
 
-        self.schedule = yaml.safe_load(f)
-        
-        current = 0.0 # the time origin: start populating the array of scheduling points
-        self.points.append(current)
+        # The state switch points on the time axis, including the end of the schedule
+        self.points     = np.append(self.schedule.starts, self.schedule.end)
 
-        for point in self.schedule: # span example: 0,0,0,1,0 - weeks, days, hours, minutes, seconds
-            x = [int(p) for p in point['span'].split(',')] # parse the span into a list of integers
-            if len(x) != 5:
-                print(f'''Error in the schedule file {self.schedule_f}, span must be a comma-separated list of 5 integers, got {point['span']}''')
-                exit(-1)
-            
-            # Create a timedelta object from the parsed span and convert it to seconds to update the current time
-            # e.g. 0,0,0,1,0 -> 60 seconds
-            
-            interval = datetime.timedelta(weeks=x[0], days=x[1], hours=x[2], minutes=x[3], seconds=x[4])
-            if self.verbose: print(f'''*** {point['state']}, {interval.total_seconds()}s ***''')
-            current+=interval.total_seconds()
-            self.points.append(current)
+        # The arrival and size models: the streams and the schedule entries may define their own,
+        # the default arrival model is uniform between low and high. Sizes defined in the schedule
+        # imply binary payloads, so a default payload generator is attached if there is none.
+        for stream in self.streams: stream.setup(self.schedule, self.low, self.high)
+        if self.sizes(self.schedule) and self.payload is None: self.payload = Payload()
+
+        if self.verbose:
+            print(f'''*** {self.schedule} ***''')
+            for i in range(min(len(self.schedule), 10)):
+                print(f'''*** {self.schedule.states[i]}, {self.points[i+1]-self.points[i]}s ***''')
+            if len(self.schedule) > 10: print(f'''*** ... ***''')
 
-        self.state      = self.schedule[0]['state']
-        self.substate   = self.schedule[0]['substate']
-        self.end        = self.points[-1]
+        self.index      = 0
+        self.state      = self.schedule.states[0]
+        self.substate   = self.schedule.substates[0]
+        self.end        = self.schedule.end
 
         if self.verbose:        print(f'''*** The end of the defined schedule is at {self.end}s ***''')
-        if self.until is None:
+        if self.until is None and self.trace:
+            if self.verbose:    print(f'''*** Will stop simulation at the end of the replayed trace ***''')
+            self.until = self.trace.duration()
+        elif self.until is None:
             if self.verbose:    print(f'''*** Will stop simulation at the end of schedle defined in {self.schedule_f} ***''')
             self.until = self.end
         else:
             if self.verbose:    print(f'''*** Will run simulation until {self.until}s per command line options***''')
 
+    # ---
+    def sizes(self, schedule):
+        ''' The size models of the schedule and of the streams '''
+        sizes  = [schedule.models[i] for i in set(schedule.size.tolist()) if i >= 0]
+        sizes += [stream.size for stream in self.streams if stream.size is not None]
+        return sizes
+
+    # ---
+    def check_models(self, schedule, low, high, schedule_f=None):
+        '''
+        Validate the arrival and size models of a compiled schedule and of the streams, as read_schedule()
+        would set them up, without touching the streams: e.g. for a start command during a run.
+        Raises ValueError if any of them is invalid.
+        '''
+        try:
+            for stream in self.streams:
+                if stream.arrival is not None:
+                    Arrival(stream.arrival)
+                else:
+                    Arrival.uniform(low, high)
+                    for i in set(schedule.arrival.tolist()):
+                        if i >= 0: Arrival(schedule.models[i])
+            payload = self.payload or Payload(fill='zero', chunk=1) # no template buffer needed to validate
+            for spec in self.sizes(schedule): payload.check(spec)
+        except Exception as e:
+            raise ValueError(f'''Error in the arrival or size models in the schedule file {schedule_f or self.schedule_f} or the streams: {e}''')
+
+    # ---
+    def sim_datetime(self):
+        '''
+        Returns the datetime corresponding to the current moment of the simulation.
+        In real-time mode this is just the wall clock, in virtual time it is the time
+        origin of the run shifted by the simulated time elapsed.
+        '''
+        if self.realtime or self.env is None:
+            return dt.now()
+        return self.t0 + datetime.timedelta(seconds=self.env.now)
+
     # ---
     def get_simpy_time(self):
         """Get the current simulation time, according to the SimPy environment, formatted"""
@@ -202,23 +470,58 @@ class DAQ:
     # Keep for reference, dataset --- f'run_{str(self.run_id)}_swf' -- old version
 
     # ---
-    def define_filename(self):
-        self.filename = f'''swf.{self.run_id:06d}.{self.Nstf:06d}.stf'''
+    def define_filename(self, stream=None):
+        '''
+        With more than one stream, the stream ID is a part of the filename, and the
+        sequence number is the one of the stream: swf.<run>.<stream>.<sequence>.stf
+        '''
+        if stream is None:
+            self.filename = self.stf_filename(self.Nstf)
+        else:
+            self.filename = self.stf_filename(stream.seq(), stream.id)
+        return self.filename
+
+    # ---
+    def stf_filename(self, seq, stream_id=None):
+        if stream_id is None or not self.multistream:
+            return f'''swf.{self.run_id:06d}.{seq:06d}.stf'''
+        return f'''swf.{self.run_id:06d}.{stream_id:03d}.{seq:06d}.stf'''
+
+    # ---
+    def container_prefix(self):
+        ''' The common part of the names of the containers and of the index of the run '''
+        return f'''swf.{self.run_id:06d}'''
+
+    # ---
+    def profile_tag(self):
+        ''' The part of the names of the profiling artifacts of the run '''
+        return str(self.run_id)
+
+    # ---
+    def record_path(self):
+        '''
+        The trace file of the run. When the DAQ does several runs (a campaign, the daemon mode),
+        the run number is added before the extension, so that each run has its own trace.
+        '''
+        if self.run_numbers is None: return self.record
+        root, ext = os.path.splitext(self.record)
+        return f'''{root}.{self.run_id}{ext}'''
 
     # ---
     def define_dataset(self):
         self.dataset = f'''swf.{self.run_id:06d}.run'''  # Dataset name based on the run number
     # ---
     
-    def metadata(self, start, end):
+    def metadata(self, start, end, stream=None):
         md ={
                 'run_id':       self.run_id,
                 'state':        self.state,
                 'substate':     self.substate,
                 'filename':     self.filename,
-                'start':        start.strftime(timeformat),
-                'end':          end.strftime(timeformat)
+                'start':        self.timestamps.format(start),  # as start.strftime(timeformat), but cheaper
+                'end':          self.timestamps.format(end)
             }
+        if stream is not None and self.multistream: md['stream'] = stream.id
         return md
 
 
@@ -237,13 +540,8 @@ class DAQ:
         msg['timestamp']    = self.run_start_ts
         msg['dataset']      = self.dataset
 
-        msg['run_conditions'] = {
-                "beam_energy": "5 GeV",
-                "magnetic_field": "1.5T",
-                "detector_config": "physics",
-                "bunch_structure": "216x216"
-            }        
-        return json.dumps(msg)
+        msg['run_conditions'] = self.conditions
+        return self.encoder.encode(msg)
 
 
     # ---
@@ -259,7 +557,7 @@ class DAQ:
         msg['run_id']       = self.run_id
         msg['ts']           = self.run_start_ts
         
-        return json.dumps(msg)
+        return self.encoder.encode(msg)
  
     # ---
     def mq_end_run_message(self):
@@ -268,24 +566,23 @@ class DAQ:
         This part will evolve as the development progresses, but for now it is a simple JSON message.
         '''
         msg = {}
-        ts = current_time()
+        ts = self.sim_datetime().strftime("%Y%m%d%H%M%S")
         self.run_end        = ts
         msg['msg_type']     = 'end_run'
         msg['req_id']       = 1
         msg['run_id']       = self.run_id
         msg['ts']           = self.run_end
+        if self.aborted: msg['status'] = 'aborted'
         
-        return json.dumps(msg)
+        return self.encoder.encode(msg)
     
     # ---
     def mq_stf_message(self, md):
         '''
-        Create a message to be sent to MQ about the STF creation.
-        This part will evolve as the development progresses, but for now it is a simple JSON message.
+        Create a message to be sent to MQ about the STF creation: the metadata, plus the static
+        fields (msg_type, req_id and the schema version) which the encoder serializes only once.
         '''
-        md['msg_type']  = 'stf_gen'
-        md['req_id']    = 1
-        return json.dumps(md)
+        return self.encoder.stf_message(md)
 
     # ---
     def get_run_number(self):
@@ -300,66 +597,80 @@ class DAQ:
         # In the past, we used self.run_start_ts but the size of the integer quickly becomes a problem
         # Could also use uuid.uuid1(), but for now this is not optimal.
         #
-        if self.test:
+        if self.run_numbers:
+            next_run_number = self.run_numbers.next() # leased ahead of time
+        elif self.test:
             next_run_number = random.randint(1, 1000)
         else:
-            try:
-                url = f"{self.monitor_url}/api/state/next-run-number/"
-                response = self.api_session.post(url, timeout=10)
-                response.raise_for_status()
-            except Exception as e:                
-                raise RuntimeError(f"Critical failure getting run number: {e}") from e
-            data = response.json()
-            if 'run_number' in data:
-                next_run_number = data['run_number']
-            else:
-                raise RuntimeError(f"Critical failure getting run number, no run_number in response: {data}")
+            next_run_number = self.fetch_run_number()
 
         return next_run_number
+
+    # ---
+    def fetch_run_number(self):
+        ''' Request the next run number from the monitor '''
+        try:
+            data = self.monitor.post(RUN_NUMBER) # with bounded retries, the run can not start without it
+        except Exception as e:                
+            raise RuntimeError(f"Critical failure getting run number: {e}") from e
+        if 'run_number' in data:
+            return data['run_number']
+        raise RuntimeError(f"Critical failure getting run number, no run_number in response: {data}")
     
     # ---
     def send_heartbeat(self, status="OK"):
         '''
-        Send a heartbeat message to the run monitor.
+        Send a heartbeat message to the run monitor. It is queued and posted by the background
+        thread of the monitor client, so this never blocks.
         '''
         
         if self.test: return
-        
-        try:
-            payload = {
-                "instance_name":    self.agent_name,
-                "agent_type":       self.agent_type,
-                "status":           status,
-                "description":      f"DAQSIMULATOR agent {self.agent_name} is running",
-                "workflow_enabled": False  # Enable this agent for workflow tracking
-            }
+        self.monitor.post_async(HEARTBEAT, self.heartbeat_payload(status))
 
-            # print(f"[HEARTBEAT] Sending heartbeat for {self.agent_name} to {self.monitor_url}/api/systemagents/heartbeat/")
-            # print(f"[HEARTBEAT] Payload: {payload}")
-            
-            url = f"{self.monitor_url}/api/systemagents/heartbeat/"
-            response = self.api_session.post(url, json=payload, timeout=10)
-            response.raise_for_status()
-            
-            if self.verbose:
-                print(f"*** [HEARTBEAT] SUCCESS: Status {response.status_code} ***")
-        except Exception as e:
-            print(f"Warning: failure sending heartbeat: {e}")
-            return
-        
-        data = response.json()
-        if 'status' in data and data['status'] == 'OK':
-            if self.verbose:
-                print(f"*** Heartbeat sent successfully for run {self.run_id} ***")
-        else:
-            print(f"Warning: unexpected response from heartbeat: {data}")
-            return
+    # ---
+    def heartbeat_payload(self, status="OK"):
+        '''
+        The payload of a heartbeat, with the live stats of the run: the STF rate since the previous
+        heartbeat (wall clock), the totals, and the backlogs of the writer pool and of the publisher.
+        '''
+        now, nstf   = time.monotonic(), self.Nstf
+        last, n0    = self.beat_mark
+        self.beat_mark = (now, nstf)
+        stats = dict(self.live_stats(), stf_rate=round((nstf - n0)/(now - last), 3) if last and now > last else 0.0)
+        return {
+            "instance_name":    self.agent_name,
+            "agent_type":       self.agent_type,
+            "status":           status,
+            "description":      f"DAQSIMULATOR agent {self.agent_name} is running",
+            "workflow_enabled": False,  # Enable this agent for workflow tracking
+            "stats":            stats,
+        }
+    
+    
+    # ---
+    def live_stats(self):
+        ''' The stats of the run in progress, for the heartbeats and the status replies of the daemon mode '''
+        stats = {
+            'run_id':           self.run_id,
+            'stfs':             self.Nstf,
+            'bytes_written':    self.bytes_written,
+            'sim_time':         round(self.env.now, 3) if self.env else 0.0,
+            'writer_backlog':   self.writer.backlog() if self.writer else 0,
+            'mq_backlog':       self.publisher.queue.qsize() if self.publisher else 0,
+        }
+        if self.backpressure:
+            stats['consumer_lag']   = self.backpressure.lag(self.announced())
+            stats['paused_time']    = round(self.backpressure.paused_time, 3)
+        if self.ring:
+            stats['ring_seq']       = self.ring.seq
+            stats['ring_oversize']  = self.ring.oversize
+        return stats
     
     
     ############################ For completeness ##############################
     # ---
     def __str__(self):
-        return f'''DAQ Simulation: state={self.state}, substate={self.substate}, until={self.until}, clock={self.clock}, factor={self.factor}, low={self.low}, high={self.high}'''
+        return f'''DAQ Simulation: state={self.state}, substate={self.substate}, until={self.until}, clock={self.clock}, factor={self.factor}, low={self.low}, high={self.high}, realtime={self.realtime}, streams={len(self.streams)}'''
 
     # ---
     def __repr__(self):
@@ -384,10 +695,30 @@ class DAQ:
         '''
         if self.verbose: print(f'''*** Starting the DAQ simulation run ***''')
 
-        self.run_start_ts   = current_time()
+        self.reset_run()
+        self.t0             = dt.now()
+        self.run_start_ts   = self.t0.strftime("%Y%m%d%H%M%S")
         
         self.run_id = self.get_run_number()
         self.define_dataset() # define the dataset name ('dataset' attribute) based on the run number
+        if self.backpressure: self.backpressure.reset(self.run_id) # the feedback of the previous run no longer counts
+
+        self.metrics.reset() # the metrics are labelled with the run, so they are those of this run only
+        self.metrics.labels.update({'agent': self.agent_name, 'run_id': self.run_id})
+
+        if self.record:
+            header = {'run_id': self.run_id, 'schedule': self.schedule_f, 'streams': [s.id for s in self.streams],
+                      'multistream': self.multistream, 'payload': self.payload is not None}
+            states, substates = sorted(set(self.schedule.states)), sorted(set(self.schedule.substates))
+            if self.trace: # the states of a replayed trace need not be in the schedule
+                states, substates = self.trace.states, self.trace.substates
+            record = self.record_path()
+            try:
+                self.recorder = TraceRecorder(record, states, substates, header)
+            except Exception as e:
+                print(f'''*** Error creating the trace file {record}: {e}, exiting... ***''')
+                exit(-1)
+            if self.verbose: print(f'''*** Recording the STF arrivals to {record} ***''')
         
         if self.destination: # Create the folder for the run, if it does not exist
             self.folder = f"{self.destination}/{self.dataset}"
@@ -399,75 +730,409 @@ class DAQ:
                 exit(-1)
             
             if self.verbose: print(f'''*** Created the output folder {self.folder} ***''')
-        
+            self.storage.start(self.folder)
+
+            # Optionally, the STFs are appended to rolling container files instead of a file each
+            if self.pack > 0:
+                self.container = Container(self.folder, self.container_prefix(), max_size=self.pack, sync=self.durable)
+                if self.verbose: print(f'''*** Packing the STFs into containers of {self.pack} bytes, index {self.container_prefix()}.index ***''')
 
-        if self.sender and not self.test:
-            self.sender.send(destination='epictopic', body=self.mq_run_imminent_message(), headers={'persistent': 'true'})
+
+        # Optionally, the files (or the ring buffer slots) are written off the event loop by a pool of threads
+        if self.writers > 0 and (self.destination or self.ring):
+            self.writer = WriterPool(self.write_and_send, workers=self.writers, depth=self.queue_depth,
+                                     policy=self.queue_policy, verbose=self.verbose)
+            if self.verbose: print(f'''*** Started {self.writers} writer threads, queue depth {self.queue_depth}, policy {self.queue_policy} ***''')
+
+        if self.mq_active():
+            self.publish(self.mq_run_imminent_message())
             if self.verbose: print(f'''*** Sent MQ message that run {str(self.run_id)} is imminent ***''')
 
         
-        # Create a real-time environment with the specified factor
-        self.env = simpy.rt.RealtimeEnvironment(factor=self.factor, strict=False)
-        
-        # Register the schedule minder and the STF generator processes with the environment
-        self.env.process(self.sched())          # the schedule minder
-        self.env.process(self.stf_generator())  # the DAQ payload to process in each step
+        self.setup_env()
+        self.setup_metrics()
         
-        if self.sender and not self.test:
-            self.sender.send(destination='epictopic', body=self.mq_start_run_message(), headers={'persistent': 'true'})
+        if self.mq_active():
+            self.publish(self.mq_start_run_message())
             if self.verbose: print(f'''*** Sent MQ message for start of run {str(self.run_id)} ***''')
     
         if not self.test:
-            # Send heartbeat
+            # Send heartbeat, and then periodically during the run
+            self.beat_mark = (time.monotonic(), 0)
             self.send_heartbeat()
+            self.monitor.start_heartbeats(self.heartbeat_payload, self.heartbeat)
     
+    # ---
+    def reset_run(self):
+        '''
+        Reset the counters and the state of the DAQ, so that the same instance can do another run.
+        '''
+        self.Nstf           = 0
+        self.Ndropped       = 0
+        self.bytes_written  = 0
+        self.checksum_time  = 0.0
+        self.raw_bytes      = 0
+        self.compress_time  = 0.0
+        self.stop           = None
+        self.index          = 0
+        self.state          = self.schedule.states[0]
+        self.substate       = self.schedule.substates[0]
+        self.shaper.reset()
+        for stream in self.streams: stream.Nstf = 0
+
+    # ---
+    def setup_env(self):
+        '''
+        Create the SimPy environment and register the processes with it.
+        '''
+        # Create a real-time (paced) environment with the specified factor, or a plain environment
+        # which runs in virtual time as fast as possible
+        if self.realtime:
+            self.env = PacedEnvironment(factor=self.factor, policy=self.catchup, tolerance=self.tolerance,
+                                        resolution=self.resolution, metrics=self.metrics)
+        else:
+            self.env = simpy.Environment()
+            if self.verbose: print(f'''*** Running in virtual time, as fast as possible ***''')
+        
+        # Register the schedule minder and the STF generator processes with the environment,
+        # or the replay of a trace which then drives both the states and the STFs
+        if self.trace:
+            self.stop = self.env.process(self.replayer())
+            return
+        self.env.process(self.sched())          # the schedule minder
+        for stream in self.streams:             # the DAQ payload to process in each step, one per stream
+            self.env.process(self.stf_generator(stream))
+
+    # ---
+    def setup_metrics(self):
+        '''
+        Register the gauges of the run and start the periodic export of the metrics, if requested.
+        '''
+        self.metrics.gauge('stf_count', lambda: self.Nstf)
+        self.metrics.gauge('sim_time',  lambda: self.env.now if self.env else 0.0)
+        if self.writer:     self.metrics.gauge('writer_backlog',    self.writer.backlog)
+        if self.publisher:  self.metrics.gauge('publisher_depth',   self.publisher.queue.qsize)
+        if self.backpressure: self.metrics.gauge('consumer_lag',    lambda: self.backpressure.lag(self.announced()))
+
+        if self.metrics_file and self.exporter is None:
+            self.exporter = MetricsExporter(self.metrics, self.metrics_file, self.metrics_interval, verbose=self.verbose)
+            if self.verbose: print(f'''*** Exporting the metrics to {self.metrics_file} every {self.metrics_interval}s ***''')
+
     # ---
     def end_run(self):
         '''
         End the simulation run, clean up resources and print the summary.
         This method is called to finalize the simulation and print the results.
+        The backlog of the writer pool, if any, is drained first, so that all STF
+        notifications precede the end of run message.
         '''
-        if self.sender and not self.test:
-            self.sender.send(destination='epictopic', body=self.mq_end_run_message(), headers={'persistent': 'true'})
+        if self.writer:
+            self.writer.close()
+
+        if self.backpressure:
+            self.backpressure.close(self.env.now)
+
+        if self.destination and not self.container:
+            self.storage.close() # the files left pending in the "every" policy
+
+        if self.container:
+            if self.verbose: print(f'''*** Containers: {self.container.stats()} ***''')
+            self.container.close()
+            self.container = None
+
+        if self.mq_active():
+            self.publish(self.mq_end_run_message())
             if self.verbose: print(f'''*** Sent MQ message for end of run {str(self.run_id)} ***''')
+
+        if self.publisher:
+            self.publisher.flush() # make sure everything is out before the run is declared finished
+
+        flush = getattr(self.sender, 'flush', None) # e.g. the file transport
+        if flush: flush()
+
+        if self.exporter:
+            self.exporter.stop() # the final state of the metrics
+            self.exporter = None
+
+        if self.recorder:
+            self.recorder.close()
+            if self.verbose: print(f'''*** Recorded {self.recorder.count} STFs to {self.record_path()} ***''')
+            self.recorder = None
     
         if self.verbose:
             print(f'''*** Ending the DAQ simulation run ***''')
             print(f'''*** Total number of STFs generated: {self.Nstf} ***''')
+            if len(self.streams) > 1:
+                for stream in self.streams: print(f'''*** Stream {stream.id}: {stream.Nstf} STFs ***''')
+            if self.writer: print(f'''*** Writer pool: {self.writer.stats()} ***''')
+            if self.codec: print(f'''*** Compression: {self.compression_stats()} ***''')
+            if self.publisher: print(f'''*** MQ publisher: {self.publisher.stats()} ***''')
+            if self.backpressure: print(f'''*** Backpressure: {self.backpressure.stats()} ***''')
+            if self.ring: print(f'''*** Ring buffer: {self.ring.stats()}, dropped once compressed: {self.Ndropped} ***''')
+            if self.destination and not self.container: print(f'''*** Storage: {self.storage.stats()} ***''')
+            if isinstance(self.env, PacedEnvironment): print(f'''*** Pacing: {self.env.stats()} ***''')
   
         if not self.test:
-            # Send heartbeat
+            # Send the final heartbeat of the run, and give it a bounded time to go out
+            self.monitor.stop_heartbeats()
             self.send_heartbeat()
+            if not self.monitor.flush(timeout=self.monitor.timeout):
+                print(f'''Warning: the monitor did not respond in time, {self.monitor.stats()}''')
     
     # ---
-    def run(self):
+    def close(self):
+        '''
+        Release what the DAQ holds across the runs, once it is done with them: the map of the ring buffer.
+        The file of the ring stays, for the consumers still reading it.
+        '''
+        if self.ring:
+            self.ring.close()
+            if self.verbose: print(f'''*** Closed the {self.ring} ***''')
+            self.ring = None
+
+    # ---
+    def compression_stats(self):
+        return {
+            'codec':        str(self.codec),
+            'raw_bytes':    self.raw_bytes,
+            'stored_bytes': self.bytes_written,
+            'ratio':        round(self.raw_bytes/self.bytes_written, 3) if self.bytes_written else 0.0,
+            'mb_per_s':     round(self.raw_bytes/self.compress_time/1e6, 3) if self.compress_time > 0 else 0.0, # per thread
+        }
+
+    # ---
+    def run(self, on_start=None):
+        '''
+        Do a run. The on_start callable, if given, is called once the run has started (the daemon mode replies with it).
+        In the profiling mode, only the event loop is profiled, the start and the end of the run are left out.
+        If the simulation fails, the run is still ended (writers drained, end of run message sent) before
+        the exception is passed on, so that the same instance can do another run, e.g. in the daemon mode.
+        '''
+        t = time.perf_counter()
         self.start_run()  # Initialize the simulation environment and processes
+        self.startup_time = time.perf_counter() - t
         try:
-            self.env.run(until=self.until)
+            if on_start: on_start()
+            if self.profiler: self.profiler.start()
+            if isinstance(self.env, PacedEnvironment): self.env.sync() # the run messages above took some time
+            if self.halt is None:
+                self.env.run(until=self.stop or self.until)
+            else:
+                self.run_until_halted(self.stop or self.until)
         except KeyboardInterrupt:
             print("\nSimulation interrupted by user")
-            
-        self.end_run()  # Finalize the simulation and print the results
+        finally:
+            try:
+                if self.profiler: self.profiler.stop(self.profile_tag()) # of a failed run too, it may show why
+            finally:
+                self.end_run()  # Finalize the simulation and print the results
+
+    # ---
+    def run_until_halted(self, end):
+        '''
+        Run the simulation in slices of the scheduler clock, until the end (a time or an event), or until
+        the halt event is set from another thread (the stop and abort control messages, see control.py).
+        SimPy is not thread-safe, so the halt is checked between the slices rather than injected as an event.
+        '''
+        while not self.halt.is_set():
+            if isinstance(end, simpy.Event):
+                if end.processed: return
+                self.env.run(until=self.env.any_of([end, self.env.timeout(self.clock)]))
+            else:
+                if self.env.now >= end: return
+                self.env.run(until=min(self.env.now + self.clock, end))
+
+    # ---
+    def pregenerate(self, stream, index):
+        '''
+        Draw the intervals between the STFs, and their sizes if there is a payload, for a whole
+        segment of the schedule at once, using the models of the stream or of the segment, unless
+        replaced by the load shaping. Returns the two arrays, the second one None without a payload,
+        and the mean interval of the arrival model.
+        '''
+        arrival     = self.shaper.arrival_model(stream) or stream.arrival_model(self.schedule, index)
+        n           = arrival.batch_size(self.schedule.duration(index))
+        intervals   = arrival.draw(self.rng, n)
+        if stream.stride > 1: intervals *= stream.stride # the stream is split between processes
+        sizes       = None
+        if self.payload is not None:
+            sizes   = self.payload.sizes(n, self.state, self.substate, self.shaper.size or stream.size_model(self.schedule, index))
+        return intervals, sizes, arrival.mean()*stream.stride
+
+    # ---
+    def write_stf(self, md, data=None, size=0):
+        '''
+        Write the STF file described by the metadata, either the given data or a payload of the given size.
+        The checksum and size are updated chunk by chunk as the data goes out, and are then added to
+        the metadata, so the file is never re-read. The file goes to the subdirectory of the layout,
+        and is synced and/or renamed in place per the durability policy, see layout.py. By default,
+        when running with the writer pool, the file is synced, so that it is durable when announced.
+
+        In the packed mode, the STF is appended to the current container instead, and its location
+        is added to the metadata ("container" and "offset") as well as to the index of the run.
+        With a ring buffer, the STF is copied into its next slot, and the metadata refers to the slot
+        ("ring", "seq" and the offset in the file) rather than to a file, see ring.py. The STFs larger
+        than the ring are normally left out by the generator already, see oversize(); one which only
+        turns out too large once compressed is dropped here, counted in Ndropped, and None is returned
+        instead of the metadata.
+
+        With a codec, the body is compressed first: the checksum and the size are those of the stored
+        (compressed) bytes, and the codec and the raw size are added to the metadata.
+        '''
+        if self.codec:
+            data, raw_size, elapsed = self.codec.compress([data] if data is not None else self.payload.chunks(size))
+            with self.stats_lock:
+                self.raw_bytes      += raw_size
+                self.compress_time  += elapsed
+            self.metrics.observe('compress', elapsed)
+            self.metrics.inc('raw_bytes', raw_size)
+            md['codec']     = self.codec.name
+            md['raw_size']  = raw_size
+
+        t = time.perf_counter()
+        if self.ring:
+            reserved = self.ring.reserve(len(data) if data is not None else size)
+            if reserved is None: # larger than the ring once compressed, dropped rather than failing the run
+                with self.stats_lock: self.Ndropped += 1
+                self.drop_oversize(md)
+                return None
+            seq, position, slot = reserved
+            w = self.write_body(slot, data, size)
+            self.ring.commit(seq, position, w.size, w.adler32, md['filename'], md.get('stream', 0))
+            md['ring']      = self.ring.path
+            md['seq']       = seq
+            md['offset']    = self.ring.offset + position % self.ring.capacity
+            dfilename       = f"{self.ring.path}#{seq}"
+        elif self.container:
+            k, offset, slot = self.container.reserve(len(data) if data is not None else size)
+            w = self.write_body(slot, data, size)
+            self.container.commit(md['filename'], k, offset, w.size, w.adler32)
+            md['container'] = self.container.container_name(k)
+            md['offset']    = offset
+            dfilename       = f"{self.folder}/{md['container']}@{offset}"
+        else:
+            dfilename = self.storage.path(md)
+            f = self.storage.create(dfilename)
+            try:
+                w = self.write_body(f, data, size)
+            except:
+                f.close()
+                raise
+            self.metrics.observe('sync', self.storage.commit(f, dfilename))
+
+        with self.stats_lock:
+            self.bytes_written += w.size
+            self.checksum_time += w.elapsed
+
+        self.metrics.observe('write',    time.perf_counter() - t - w.elapsed)
+        self.metrics.observe('checksum', w.elapsed)
+        self.metrics.inc('bytes_written', w.size)
+
+        md['checksum']  = f'''ad:{str(w.adler32)}'''  # Adler-32 checksum
+        md['size']      = w.size
+        if self.digests: md['digests'] = w.hexdigests()
+        if self.verbose: print(f'''*** Wrote STF to file {dfilename}, Adler-32 checksum: {w.adler32}, size: {w.size} ***''')
+        return md
+
+    # ---
+    def oversize(self, data=None, size=0):
+        '''
+        True if the STF can never fit in the ring buffer (it is then counted by the ring). Without a codec
+        the stored size is known before the STF is emitted, so it is left out of the counts and of the trace.
+        '''
+        return bool(self.ring) and not self.codec and not self.ring.fits(len(data) if data is not None else size)
+
+    # ---
+    def drop_oversize(self, md):
+        ''' Count an STF larger than the ring, which no consumer could ever read, see RingBuffer.fits() '''
+        self.metrics.inc('ring_oversize')
+        if self.verbose: print(f'''*** Dropped STF {md['filename']}, larger than the {self.ring} ***''')
+
+    # ---
+    def announced(self):
+        '''
+        The number of the STFs announced (or to be) to the consumers: those dropped by the ring,
+        and those dropped or failed in the writer pool, are left out, so the lag does not grow with them.
+        '''
+        lost = self.Ndropped
+        if self.writer: lost += self.writer.dropped + self.writer.failed
+        return self.Nstf - lost
+
+    # ---
+    def write_body(self, f, data=None, size=0):
+        ''' Write the data, or a payload of the given size, through a ChecksumWriter, which is returned '''
+        w = ChecksumWriter(f, self.digests)
+        if data is not None:
+            w.write(data)
+        else:
+            for chunk in self.payload.chunks(size): w.write(chunk)
+        return w
+
+    # ---
+    def send_stf(self, md):
+        '''
+        Notify the downstream agents via MQ that the STF has been created.
+        '''
+        if self.mq_active():
+            t0      = time.perf_counter()
+            body    = self.mq_stf_message(md)
+            t1      = time.perf_counter()
+            self.publish(body)
+            self.metrics.observe('encode',  t1 - t0)
+            self.metrics.observe('send',    time.perf_counter() - t1)
+            self.metrics.inc('messages')
+            if self.verbose: print(f'''*** Sent MQ message for STF {md['filename']} ***''')
+
+    # ---
+    def emit_stf(self, md, data=None, size=0):
+        '''
+        Write the STF (inline or via the writer pool) and announce it. If neither the destination nor a ring
+        buffer is specified, nothing is written and only the MQ message is sent, with placeholders for the
+        checksum and size.
+        '''
+        if not self.destination and not self.ring:
+            md['checksum']  = 'ad:0'    # Adler-32 checksum
+            md['size']      = size
+            self.send_stf(md)
+            return
+
+        if not self.container and not self.ring: # the subdirectory is chosen here, in the order of the STFs
+            subdir = self.storage.subdir(md['filename'], self.env.now)
+            if subdir: md['subdir'] = subdir
+        if self.writer:
+            self.writer.submit((md, data, size)) # written and announced by the writer pool
+        else:
+            self.write_and_send((md, data, size))
+
+    # ---
+    def write_and_send(self, job):
+        ''' Write the STF file and announce it, the job is a tuple of (metadata, data, size) '''
+        md, data, size = job
+        md = self.write_stf(md, data, size)
+        if md is not None: self.send_stf(md)
 
     # ---
     def sched(self): # keeps track of the state changes as defined in the schedule
-        while True:
-            myT     = int(self.env.now)
-            index = bisect.bisect_right(self.points, myT) - 1 # Find the index of the current schedule entry
-            if index!=self.index:
-                if index<len(self.schedule): # state/substateate transition
-                    self.index=index
-                    self.state=self.schedule[index]['state']
-                    self.substate=self.schedule[index]['substate']
-                else:
-                    pass # past the last point, just keep rolling in the same state
-            
-            yield self.env.timeout(self.clock)
+        '''
+        Walk the table of transitions, sleeping exactly until the next one.
+        Past the last point, the DAQ just keeps rolling in the same state.
+        '''
+        for index in range(self.index+1, len(self.schedule)):
+            delay = self.schedule.starts[index] - self.env.now
+            if delay > 0: yield self.env.timeout(delay)
+
+            t = time.perf_counter()
+            self.index      = index # state/substate transition
+            if self.shaper.forced is None:
+                self.state      = self.schedule.states[index]
+                self.substate   = self.schedule.substates[index]
+            self.metrics.observe('sched', time.perf_counter() - t)
+            self.metrics.inc('transitions')
     
     # ---
-    def stf_generator(self):
+    def stf_generator(self, stream):
         '''
-        - Generate STFs at random intervals.
+        - Generate STFs at random intervals, for one readout stream.
         - Notify the downstream agents via MQ and/or write to file, with the path specified in the destination.
         - The STF filename is generated based on the current date, time, state, and substate.
         - The filename template: swf.20250625.<integer>.<state>.<substate>.stf
@@ -479,60 +1144,146 @@ class DAQ:
         - end: the end time of the STF in YYYYMMDDHHMMSSffffff format
         - state: the current state of the DAQ
         - substate: the current substate of the DAQ
+        - stream: the ID of the stream, only if there is more than one
+
+        The time spent in each stage (metadata, file write, checksum, MQ encode and send, the whole STF)
+        is recorded in the stage histograms of the metrics.
 
         The last two fields are only present in the MQ messages, the preceding ones are written to the file.
+        If a payload generator is attached, a binary body of the size drawn for the current state is streamed
+        to the file in chunks instead of the metadata.
 
-        The STF generation is controlled by the low and high limits for the arrival time of the STF.
-        It is done in real-time, with the time axis controlled by the SimPy environment.
+        The STF generation is controlled by the arrival model of the stream or of the current schedule segment,
+        by default the low and high limits for the arrival time of the STF. The arrival times (and the sizes)
+        are drawn in batches for each segment up front, the loop below just walks these arrays.
+        The load shaping (see shaping.py) may replace the models and scale the intervals to a rate set
+        by the control messages, its changes take effect at the next STF. With the backpressure enabled
+        (see backpressure.py), the generator stops or slows down while the consumers lag behind.
+        It is done in real-time, with the time axis controlled by the SimPy environment,
+        or in virtual time as fast as possible if the realtime flag is off. In real time, the STFs
+        which are late beyond the tolerance are dropped under the "skip" catch-up policy (see pacing.py).
 
         '''
 
-        if self.verbose: print(f'''*** Starting the STF generator process ***''')
-        # If the destination is not specified, do not write to file, and only send messages to MQ
-        # If not writing files, these values will be placeholders in the MQ messages
-        adler = 0
-        size  = 0
+        if self.verbose: print(f'''*** Starting the STF generator process for stream {stream.id} ***''')
+        size    = 0
+        shaper  = self.shaper
+        bp      = self.backpressure
+        level   = 1.0 # the fraction of the nominal rate allowed by the backpressure
 
+        segment = -1 # the schedule segment the arrays below were drawn for
+        version = -1 # and the version of the load shaping
         while True:
-            self.define_filename() # define the filename for the current STF
+            if shaper.changed: shaper.apply(self) # the changes of the control messages, at the STF boundary
+            if segment != self.index or version != shaper.version or pos == len(intervals):
+                first = segment < 0
+                segment, version = self.index, shaper.version
+                intervals, sizes, mean = self.pregenerate(stream, segment)
+                pos = 0
+                if first and stream.offset % stream.stride: # the phase of this part of a split stream
+                    yield self.env.timeout((stream.offset % stream.stride)*mean/stream.stride)
+                    continue
 
-            build_start = dt.now() # .strftime("%Y%m%d%H%M%S")
-            stf_arrival = random.uniform(self.low, self.high)   # Time for next STF (random interval [low,high])
-            interval    = datetime.timedelta(seconds=stf_arrival)
-            build_end   = build_start+interval
+            if bp is not None: # the consumers are behind: stop, or slow down
+                level = bp.level(self.announced(), self.env.now)
+                if level <= 0.0:
+                    yield bp.wait(self.env, self.realtime)
+                    continue
 
-            md = self.metadata(build_start, build_end)
+            if self.realtime and self.env.skipping():
+                self.metrics.inc('skipped')
+                skip = float(intervals[pos])
+                pos += 1
+                yield self.env.timeout(shaper.interval(skip, mean, self.env.now) if shaper.active else skip)
+                continue
 
-            # This is provisionl until we have a real STF file to write. For now, we just create
-            # a JSON message with the metadata and send it to the message queue, if the sender is initialized
-            data = json.dumps(md)
-            
-            if self.destination:
-                dfilename = f"{self.folder}/{self.filename}"
-                # Here we would write the STF to the file, and send a notification to a message queue
-                with open(dfilename, 'w') as f:
-                    f.write(data)
-                    f.close()
-                adler = calculate_adler32_from_file(dfilename) # Calculate the Adler-32 checksum of the file
-                size  = get_file_size(dfilename)               # Get the size of the file in bytes
-                if self.verbose: print(f'''*** Wrote STF to file {dfilename}, Adler-32 checksum: {adler}, size: {size} ***''')
-
-            # Augment the metadata with the checksum and size, to be sent to MQ
-            # The reason we are doing it here is that we need to have the file written
-            # before we can calculate the checksum and size
-            
-            md['checksum']  = f'''ad:{str(adler)}'''  # Adler-32 checksum
-            md['size']      = size
-        
-            if self.sender and not self.test:
-                self.sender.send(destination='epictopic', body=self.mq_stf_message(md), headers={'persistent': 'true'})
-                if self.verbose: print(f'''*** Sent MQ message for STF {self.filename} ***''')
+            t_stf = time.perf_counter()
+            self.define_filename(stream) # define the filename for the current STF
+
+            build_start = self.sim_datetime() # wall clock, or simulated time in the virtual mode
+            stf_arrival = float(intervals[pos]) # Time for next STF, per the arrival model, scaled to the rate set by the load shaping
+            if shaper.active: stf_arrival = shaper.interval(stf_arrival, mean, self.env.now)
+            if level < 1.0:
+                bp.delayed  += stf_arrival*(1.0/level - 1.0)
+                stf_arrival /= level
+            duration    = stf_arrival/stream.stride # the interval of the whole stream, if it is split between processes
+            build_end   = build_start+datetime.timedelta(seconds=duration)
+
+            md = self.metadata(build_start, build_end, stream)
+            t_md = time.perf_counter()
+            self.metrics.observe('metadata', t_md - t_stf)
+
+            # Without a payload generator, the JSON metadata serves as the body of the STF file.
+            # Otherwise the size is drawn from the configured distribution for the current state.
+            data = None
+            if self.payload is None:
+                data = json.dumps(md).encode()
+                self.metrics.observe('body', time.perf_counter() - t_md)
+            else:
+                size = int(sizes[pos])
+            pos += 1
+
+            if self.oversize(data, size): # larger than the ring, not generated at all
+                self.drop_oversize(md)
+                yield self.env.timeout(stf_arrival)
+                continue
+
+            if self.recorder:
+                self.recorder.record(self.env.now, duration, size, stream.id, self.state, self.substate, stream.seq(), self.filename)
+            self.emit_stf(md, data, size)
 
             self.Nstf+=1
+            stream.Nstf+=1
+            self.metrics.observe('stf', time.perf_counter() - t_stf)
+            self.metrics.inc('stfs')
             yield self.env.timeout(stf_arrival)
 
 
 
+    # ---
+    def replayer(self):
+        '''
+        Re-emit the STFs of a recorded trace (see trace.py) at their recorded times, streams, states
+        and sizes, under the current run number. The speed is set by the time factor, or the trace
+        is replayed as fast as possible in the virtual time mode. The records are read from the
+        memory map in blocks, the simulation ends with the trace (or at the "until" limit).
+        '''
+        trace   = self.trace
+        streams = {stream.id: stream for stream in self.streams}
+        sized   = trace.header['payload'] # if False, the metadata was written as the body
+        block   = 4096
+        for lo in range(0, len(trace), block):
+            r = trace.records[lo:lo+block]
+            for t, interval, size, sid, state, substate, seq in zip(r['t'].tolist(), r['interval'].tolist(), r['size'].tolist(),
+                                                                    r['stream'].tolist(), r['state'].tolist(), r['substate'].tolist(), r['seq'].tolist()):
+                if t >= self.until: return
+                delay = t - self.env.now
+                if delay > 0: yield self.env.timeout(delay)
+                if self.realtime and self.env.skipping():
+                    self.metrics.inc('skipped')
+                    continue
+
+                stream          = streams[sid]
+                self.state      = trace.states[state]
+                self.substate   = trace.substates[substate]
+                self.filename   = self.stf_filename(seq, sid)
+
+                build_start     = self.sim_datetime()
+                md              = self.metadata(build_start, build_start+datetime.timedelta(seconds=interval), stream)
+                data            = None if sized else json.dumps(md).encode()
+                if self.oversize(data, size):
+                    self.drop_oversize(md)
+                    continue
+                if self.recorder:
+                    self.recorder.record(t, interval, size, sid, self.state, self.substate, seq, self.filename)
+                self.emit_stf(md, data, size)
+
+                self.Nstf+=1
+                stream.Nstf+=1
+                self.metrics.inc('stfs')
+
+
+
 ##################################################################################
 # --- ATTIC ---
 # Some code snippets kept here for reference, to be possibly used later
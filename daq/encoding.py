@@ -0,0 +1,157 @@
+#
+# daq/encoding.py
+#
+# Encoding of the MQ messages. At kHz STF rates the cost of building and serializing each
+# message matters, as does its size on the broker: the encoders serialize the static fields
+# of the STF messages (msg_type, req_id, the schema version) once, and the timestamps are
+# formatted with a per-second cache instead of a strftime call each.
+#
+# Codecs:
+#   - json:     the default, the same messages as before plus the "schema" field
+#   - msgpack:  the same content as a MessagePack map, needs the optional msgpack package
+#   - binary:   a compact fixed layout for the STF messages (see BinaryEncoder), other messages as JSON
+
+
+import json, struct
+
+try:
+    import msgpack # optional, only needed for the msgpack codec
+except ImportError:
+    msgpack = None
+
+# ---
+SCHEMA      = 1                 # the version of the layout of the messages, sent with every message
+ENCODINGS   = ('json', 'msgpack', 'binary')
+STF_STATIC  = {'msg_type': 'stf_gen', 'req_id': 1, 'schema': SCHEMA}
+
+
+###################################################################################
+class Timestamps:
+    ''' Formats datetimes as YYYYMMDDHHMMSSffffff (the "timeformat" of the metadata). The part up to
+        the seconds is cached, so for STFs within the same second only the microseconds are formatted.
+    '''
+    def __init__(self):
+        self.second = None
+        self.prefix = ''
+
+    # ---
+    def format(self, d):
+        second = (d.year, d.month, d.day, d.hour, d.minute, d.second)
+        if second != self.second:
+            self.second, self.prefix = second, f'''{d.year:04d}{d.month:02d}{d.day:02d}{d.hour:02d}{d.minute:02d}{d.second:02d}'''
+        return f'''{self.prefix}{d.microsecond:06d}'''
+
+
+###################################################################################
+class JsonEncoder:
+    ''' The JSON encoding. The static fields of the STF messages are serialized once, as the
+        closing fragment of the message, and appended to the serialized metadata.
+    '''
+    name            = 'json'
+    content_type    = 'application/json'
+
+    def __init__(self):
+        self.stf_tail = ', ' + json.dumps(STF_STATIC)[1:] # the static fields and the closing brace
+
+    # ---
+    def encode(self, msg):
+        ''' Encode any message, adding the schema version '''
+        return json.dumps(dict(msg, schema=SCHEMA))
+
+    # ---
+    def stf_message(self, md):
+        ''' Encode the STF message for the metadata, which is not modified '''
+        return json.dumps(md)[:-1] + self.stf_tail
+
+    # ---
+    def decode(self, body):
+        return json.loads(body)
+
+
+###################################################################################
+class MsgpackEncoder:
+    ''' The MessagePack encoding, with the static fields of the STF messages packed once '''
+    name            = 'msgpack'
+    content_type    = 'application/msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ValueError('The msgpack encoding requires the msgpack package, which is not installed')
+        self.packer     = msgpack.Packer()
+        self.stf_tail   = b''.join(self.packer.pack(k) + self.packer.pack(v) for k, v in STF_STATIC.items())
+
+    # ---
+    def encode(self, msg):
+        return msgpack.packb(dict(msg, schema=SCHEMA))
+
+    # ---
+    def stf_message(self, md):
+        pack = self.packer.pack
+        return self.packer.pack_map_header(len(md) + len(STF_STATIC)) + b''.join(pack(k) + pack(v) for k, v in md.items()) + self.stf_tail
+
+    # ---
+    def decode(self, body):
+        return msgpack.unpackb(body)
+
+
+###################################################################################
+class BinaryEncoder:
+    ''' A compact binary layout of the STF messages, little-endian:
+
+        - the fixed part (HEADER): magic "DQ", schema, message type (1: stf_gen), run_id,
+          stream (0xFFFF if none), size, Adler-32, start and end (the timestamps split into
+          YYYYMMDDHHMMSS and the microseconds)
+        - filename, state and substate, each as a 1-byte length and UTF-8 bytes
+        - the other fields of the metadata, if any (e.g. codec, container), as a 2-byte length and JSON
+
+        The other messages (run start/end etc.) are rare: they are sent as the magic, the schema,
+        the message type 0 and the JSON of the message.
+    '''
+    name            = 'binary'
+    content_type    = 'application/octet-stream'
+
+    MAGIC   = b'DQ'
+    HEADER  = struct.Struct('<2sBBIHQIQIQI')
+    FIXED   = frozenset(('run_id', 'stream', 'size', 'checksum', 'start', 'end', 'filename', 'state', 'substate'))
+
+    # ---
+    def encode(self, msg):
+        return self.MAGIC + bytes((SCHEMA, 0)) + json.dumps(msg).encode()
+
+    # ---
+    def stf_message(self, md):
+        start, end  = md['start'], md['end']
+        checksum    = md.get('checksum', 'ad:0')
+        head        = self.HEADER.pack(self.MAGIC, SCHEMA, 1, md['run_id'], md.get('stream', 0xFFFF), md.get('size', 0),
+                                       int(checksum[3:]), int(start[:14]), int(start[14:]), int(end[:14]), int(end[14:]))
+        f, s, ss    = md['filename'].encode(), md['state'].encode(), md['substate'].encode()
+        extra       = [k for k in md if k not in self.FIXED]
+        tail        = json.dumps({k: md[k] for k in extra}).encode() if extra else b''
+        return b''.join((head, bytes((len(f),)), f, bytes((len(s),)), s, bytes((len(ss),)), ss, struct.pack('<H', len(tail)), tail))
+
+    # ---
+    def decode(self, body):
+        if body[3] == 0: return dict(json.loads(body[4:]), schema=body[2])
+        _, schema, _, run_id, stream, size, adler, s1, s2, e1, e2 = self.HEADER.unpack_from(body)
+        msg, pos = {'run_id': run_id}, self.HEADER.size
+        for key in ('filename', 'state', 'substate'):
+            n = body[pos]
+            msg[key] = body[pos+1:pos+1+n].decode()
+            pos += 1 + n
+        msg.update({'start': f'''{s1:014d}{s2:06d}''', 'end': f'''{e1:014d}{e2:06d}''', 'checksum': f'''ad:{adler}''', 'size': size})
+        if stream != 0xFFFF: msg['stream'] = stream
+        n = struct.unpack_from('<H', body, pos)[0]
+        if n: msg.update(json.loads(body[pos+2:pos+2+n]))
+        msg.update(msg_type='stf_gen', req_id=1, schema=schema)
+        return msg
+
+
+# ---
+def make_encoder(name='json'):
+    '''
+    Create the encoder of the MQ messages by name, one of ENCODINGS.
+    '''
+    if name == 'json':      return JsonEncoder()
+    if name == 'msgpack':   return MsgpackEncoder()
+    if name == 'binary':    return BinaryEncoder()
+    raise ValueError(f'''Unknown encoding {name}, must be one of {ENCODINGS}''')
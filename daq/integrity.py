@@ -0,0 +1,75 @@
+#
+# daq/integrity.py
+#
+# Streaming integrity layer: the checksum and the size of an STF are accumulated chunk by chunk
+# as the data is written out, so the file never needs to be re-read to compute them.
+
+
+import zlib, hashlib, time
+
+try:
+    import xxhash # optional, only needed for the xxh* digests
+except ImportError:
+    xxhash = None
+
+# ---
+DIGESTS = ('crc32', 'md5', 'sha1', 'sha256', 'xxh32', 'xxh64', 'xxh3_64', 'xxh128')
+
+# ---
+class _CRC32:
+    ''' Minimal hashlib-like wrapper around zlib.crc32 '''
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f'''{self.value:08x}'''
+
+# ---
+def make_digest(name):
+    '''
+    Create an incremental digest object by name. The xxhash based digests require the
+    optional xxhash package.
+    '''
+    if name == 'crc32':
+        return _CRC32()
+    if name.startswith('xxh'):
+        if xxhash is None:
+            raise ValueError(f'''The digest {name} requires the xxhash package, which is not installed''')
+        return getattr(xxhash, name)()
+    if name in DIGESTS:
+        return hashlib.new(name)
+    raise ValueError(f'''Unknown digest {name}, must be one of {DIGESTS}''')
+
+
+###################################################################################
+class ChecksumWriter:
+    ''' A thin wrapper around a binary file object, which updates the Adler-32 checksum,
+        the size and optionally a set of extra digests with every chunk written.
+        The time spent in the checksum calculation is accumulated in the "elapsed" attribute.
+    '''
+    def __init__(self, f, digests=()):
+        self.f          = f
+        self.adler32    = 1     # the initial value of Adler-32, as in zlib
+        self.size       = 0
+        self.elapsed    = 0.0
+        self.digests    = {name: make_digest(name) for name in digests}
+
+    # ---
+    def write(self, data):
+        t = time.perf_counter()
+        self.adler32 = zlib.adler32(data, self.adler32)
+        for d in self.digests.values(): d.update(data)
+        self.elapsed += time.perf_counter() - t
+
+        self.size += len(data)
+        return self.f.write(data)
+
+    # ---
+    def hexdigests(self):
+        '''
+        Returns the extra digests as a dictionary of hex strings, keyed by the digest name.
+        '''
+        return {name: d.hexdigest() for name, d in self.digests.items()}
@@ -0,0 +1,188 @@
+#
+# daq/layout.py
+#
+# The layout of the STF files in the run folder, and their durability. On long runs at high rates
+# a flat run folder with hundreds of thousands of files slows down the directory operations of the
+# parallel filesystems, so the files can be spread over subdirectories:
+#
+#   - flat:             all the files in the run folder (the default)
+#   - time:SECONDS      a subdirectory per bucket of the simulated time, t000000, t000001, ...
+#   - hash:N            N subdirectories by a hash (CRC-32) of the filename, h00 ... hff for N=256
+#
+# and with a maximum number of files per directory, the overflow goes to the numbered siblings
+# (t000001.1, h3f.2, or 0001, 0002 ... in the flat layout). The subdirectory, relative to the run
+# folder, is added to the STF metadata ("subdir") unless the layout is flat.
+#
+# Durability policies of the written files:
+#   - none:             no fsync, the page cache decides
+#   - every:N           fsync the last N files (and their directories) in a batch, every N files
+#   - each:             fsync each file before it is announced (the default with the writer pool)
+#   - rename:           write to a hidden temporary file, fsync it and rename it in place, so the
+#                       consumers polling the directory never see a partially written file
+
+
+import threading, zlib, time, os
+
+# ---
+LAYOUTS     = ('flat', 'time', 'hash')
+DURABILITY  = ('none', 'every', 'each', 'rename')
+
+
+###################################################################################
+class Storage:
+    ''' Places the STF files in the run folder per the layout, and writes them per the durability
+        policy, measuring its cost. The subdirectories are chosen in the STF generator (subdir),
+        the files written in the generator or the writer threads (create and commit).
+    '''
+    def __init__(self, layout='flat', max_files=0, durability='none', verbose=False):
+        self.layout, _, arg = layout.partition(':')
+        if self.layout not in LAYOUTS:
+            raise ValueError(f'''Unknown layout {self.layout}, must be one of {LAYOUTS}''')
+        self.bucket     = float(arg or 60.0) if self.layout == 'time' else 0.0  # seconds per bucket of time
+        self.fanout     = int(arg or 256)    if self.layout == 'hash' else 0    # the number of hashed subdirectories
+        if (self.layout == 'time' and self.bucket <= 0.0) or (self.layout == 'hash' and self.fanout < 1):
+            raise ValueError(f'''Invalid parameter of the {self.layout} layout: {arg}''')
+        self.width      = len(f'''{self.fanout-1:x}''') if self.fanout else 0
+        self.max_files  = int(max_files)
+
+        self.durability, _, arg = durability.partition(':')
+        if self.durability not in DURABILITY:
+            raise ValueError(f'''Unknown durability policy {self.durability}, must be one of {DURABILITY}''')
+        self.batch      = int(arg or 100) if self.durability == 'every' else 0
+        if self.durability == 'every' and self.batch < 1:
+            raise ValueError('The "every" durability policy needs a positive number of files')
+
+        self.verbose    = verbose
+        self.lock       = threading.Lock()
+        self.start('')
+
+    # ---
+    def start(self, folder):
+        ''' Reset for a new run, writing to the given run folder '''
+        self.folder     = folder
+        self.counts     = {}            # the number of files per subdirectory, before the overflow
+        self.created    = set()         # the subdirectories created so far
+        self.pending    = []            # the files not yet synced, in the "every" policy
+        self.files      = 0
+        self.fsyncs     = 0
+        self.sync_time  = 0.0           # the time spent on the durability (fsyncs, renames), seconds
+        self.mkdir_time = 0.0           # the time spent creating the subdirectories, seconds
+
+    # ---
+    def subdir(self, filename, now):
+        '''
+        The subdirectory of the STF file, relative to the run folder, for the given simulated time.
+        '''
+        if self.layout == 'time':
+            base = f'''t{int(now // self.bucket):06d}'''
+        elif self.layout == 'hash':
+            base = f'''h{zlib.crc32(filename.encode()) % self.fanout:0{self.width}x}'''
+        else:
+            base = ''
+        if not self.max_files: return base
+
+        n = self.counts.get(base, 0)
+        self.counts[base] = n + 1
+        k = n // self.max_files
+        if k == 0: return base
+        return f'''{base}.{k}''' if base else f'''{k:04d}'''
+
+    # ---
+    def path(self, md):
+        ''' The full path of the STF file described by the metadata '''
+        subdir = md.get('subdir')
+        return os.path.join(self.folder, subdir, md['filename']) if subdir else os.path.join(self.folder, md['filename'])
+
+    # ---
+    def temp(self, path):
+        head, tail = os.path.split(path)
+        return os.path.join(head, f'''.{tail}.tmp''')
+
+    # ---
+    def create(self, path):
+        '''
+        Open the file for writing (its temporary in the rename policy), creating the subdirectory if needed.
+        '''
+        folder = os.path.dirname(path)
+        if folder != self.folder and folder not in self.created:
+            t = time.perf_counter()
+            os.makedirs(folder, exist_ok=True)
+            with self.lock:
+                self.created.add(folder)
+                self.mkdir_time += time.perf_counter() - t
+        return open(self.temp(path) if self.durability == 'rename' else path, 'wb')
+
+    # ---
+    def commit(self, f, path):
+        '''
+        Close the written file per the durability policy. Returns the time it took, seconds.
+        '''
+        t = time.perf_counter()
+        synced, batch = 0, None
+        if self.durability in ('each', 'rename'):
+            f.flush()
+            os.fsync(f.fileno())
+            synced = 1
+        f.close()
+        if self.durability == 'rename':
+            os.rename(self.temp(path), path)
+        elif self.durability == 'every':
+            with self.lock:
+                self.pending.append(path)
+                if len(self.pending) >= self.batch: batch, self.pending = self.pending, []
+            if batch: synced = self.sync(batch)
+
+        elapsed = time.perf_counter() - t
+        with self.lock:
+            self.files     += 1
+            self.fsyncs    += synced
+            self.sync_time += elapsed
+        return elapsed
+
+    # ---
+    def sync(self, paths):
+        '''
+        Sync the given files, and then their directories, returns the number of fsyncs.
+        On Linux, fsync of a file opened read-only flushes its data as well.
+        '''
+        n = 0
+        for path in paths + sorted({os.path.dirname(p) for p in paths}): # the directories last, for the new entries
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            n += 1
+        return n
+
+    # ---
+    def close(self):
+        ''' Sync the files left pending in the "every" policy, at the end of the run '''
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if not batch: return
+        t = time.perf_counter()
+        synced = self.sync(batch)
+        with self.lock:
+            self.fsyncs    += synced
+            self.sync_time += time.perf_counter() - t
+
+    # ---
+    def __str__(self):
+        if self.layout == 'time': return f'''time:{self.bucket:g}'''
+        if self.layout == 'hash': return f'''hash:{self.fanout}'''
+        return self.layout
+
+    # ---
+    def stats(self):
+        return {
+            'layout':           str(self),
+            'max_files':        self.max_files,
+            'durability':       f'''every:{self.batch}''' if self.batch else self.durability,
+            'files':            self.files,
+            'dirs':             len(self.created),
+            'fsyncs':           self.fsyncs,
+            'sync_time':        round(self.sync_time, 6),
+            'sync_per_file_ms': round(1e3*self.sync_time/self.files, 4) if self.files else 0.0,
+            'mkdir_time':       round(self.mkdir_time, 6),
+        }
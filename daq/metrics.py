@@ -0,0 +1,202 @@
+#
+# daq/metrics.py
+#
+# Built-in instrumentation of the simulator: fixed-bucket histograms of the time spent in each
+# stage of the STF pipeline, counters, and gauges polled at the time of export. The results are
+# exported periodically as a Prometheus textfile (for the node exporter) or a JSON snapshot.
+
+
+import threading, bisect, time, json, os
+
+# ---
+PREFIX  = 'daqsim'
+BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+           1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # seconds
+
+
+###################################################################################
+class Histogram:
+    ''' A histogram with fixed bucket boundaries, cumulative on export, as in Prometheus '''
+    def __init__(self, buckets=BUCKETS):
+        self.buckets    = tuple(buckets)
+        self.counts     = [0]*(len(self.buckets)+1) # the last one is the overflow (+Inf)
+        self.sum        = 0.0
+        self.count      = 0
+        self.max        = 0.0
+        self.lock       = threading.Lock()
+
+    # ---
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i]  += 1
+            self.sum        += value
+            self.count      += 1
+            if value > self.max: self.max = value
+
+    # ---
+    def quantile(self, q):
+        ''' An estimate of the quantile: the upper boundary of the bucket it falls into '''
+        if self.count == 0: return 0.0
+        target, total = q*self.count, 0
+        for i, c in enumerate(self.counts):
+            total += c
+            if total >= target: return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    # ---
+    def snapshot(self):
+        with self.lock:
+            return {
+                'count':    self.count,
+                'sum':      self.sum,
+                'mean':     self.sum/self.count if self.count else 0.0,
+                'max':      self.max,
+                'p50':      self.quantile(0.5),
+                'p99':      self.quantile(0.99),
+                'buckets':  dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+            }
+
+
+###################################################################################
+class Metrics:
+    ''' The registry of the metrics of the simulator.
+
+        - stage histograms: the time spent in each stage of the pipeline (seconds), see observe()
+        - counters: monotonic totals, e.g. the number of STFs and bytes, see inc()
+        - gauges: callables polled at the time of the snapshot, e.g. the depth of a queue
+    '''
+    def __init__(self, buckets=BUCKETS, labels=None):
+        self.buckets    = buckets
+        self.labels     = dict(labels or {})    # constant labels added to every exported sample
+        self.stages     = {}
+        self.counters   = {}
+        self.gauges     = {}
+        self.lock       = threading.Lock()
+        self.t_start    = time.time()
+
+    # ---
+    def stage(self, name):
+        h = self.stages.get(name)
+        if h is None:
+            with self.lock: h = self.stages.setdefault(name, Histogram(self.buckets))
+        return h
+
+    # ---
+    def observe(self, name, seconds):
+        ''' Record the time spent in a stage '''
+        self.stage(name).observe(seconds)
+
+    # ---
+    def inc(self, name, value=1):
+        with self.lock: self.counters[name] = self.counters.get(name, 0) + value
+
+    # ---
+    def reset(self):
+        ''' Start over, at the start of a run: the histograms, the counters and the uptime are those of the run '''
+        with self.lock:
+            self.stages     = {}
+            self.counters   = {}
+            self.t_start    = time.time()
+
+    # ---
+    def gauge(self, name, func):
+        ''' Register a callable returning the current value of a gauge '''
+        self.gauges[name] = func
+
+    # ---
+    def snapshot(self):
+        '''
+        All the metrics as a dictionary, suitable for JSON.
+        '''
+        gauges = {}
+        for name, func in list(self.gauges.items()):
+            try:
+                gauges[name] = func()
+            except Exception:
+                pass # e.g. the object behind the gauge is gone
+        with self.lock:
+            counters = dict(self.counters)
+        return {
+            'timestamp':    time.time(),
+            'uptime':       time.time() - self.t_start,
+            'labels':       self.labels,
+            'counters':     counters,
+            'gauges':       gauges,
+            'stages':       {name: h.snapshot() for name, h in list(self.stages.items())},
+        }
+
+    # ---
+    def prometheus(self):
+        '''
+        All the metrics in the Prometheus text exposition format.
+        '''
+        snap    = self.snapshot()
+        base    = ','.join(f'''{k}="{v}"''' for k, v in self.labels.items())
+        def labels(**extra):
+            items = ([base] if base else []) + [f'''{k}="{v}"''' for k, v in extra.items()]
+            return '{' + ','.join(items) + '}' if items else ''
+
+        lines = [f'''# HELP {PREFIX}_stage_seconds Time spent in each stage of the STF pipeline''',
+                 f'''# TYPE {PREFIX}_stage_seconds histogram''']
+        for name, h in snap['stages'].items():
+            total = 0
+            for le, c in h['buckets'].items():
+                total += c
+                lines.append(f'''{PREFIX}_stage_seconds_bucket{labels(stage=name, le=le)} {total}''')
+            lines.append(f'''{PREFIX}_stage_seconds_sum{labels(stage=name)} {h['sum']}''')
+            lines.append(f'''{PREFIX}_stage_seconds_count{labels(stage=name)} {h['count']}''')
+
+        for name, value in snap['counters'].items():
+            lines.append(f'''# TYPE {PREFIX}_{name}_total counter''')
+            lines.append(f'''{PREFIX}_{name}_total{labels()} {value}''')
+
+        for name, value in snap['gauges'].items():
+            lines.append(f'''# TYPE {PREFIX}_{name} gauge''')
+            lines.append(f'''{PREFIX}_{name}{labels()} {value}''')
+
+        return '\n'.join(lines) + '\n'
+
+    # ---
+    def export(self, filename):
+        '''
+        Write the metrics to the file, in the Prometheus format if the extension is .prom,
+        as JSON otherwise. The file is replaced atomically, so readers never see a partial one.
+        '''
+        text = self.prometheus() if filename.endswith('.prom') else json.dumps(self.snapshot(), indent=1)
+        tmp  = f'''{filename}.{os.getpid()}.tmp'''
+        with open(tmp, 'w') as f: f.write(text)
+        os.replace(tmp, filename)
+
+
+###################################################################################
+class MetricsExporter:
+    ''' Exports the metrics to a file periodically (wall clock), from a background thread '''
+    def __init__(self, metrics, filename, interval=10.0, verbose=False):
+        self.metrics    = metrics
+        self.filename   = filename
+        self.interval   = interval
+        self.verbose    = verbose
+        self.stopped    = threading.Event()
+        self.thread     = threading.Thread(target=self.loop, name='metrics-exporter', daemon=True)
+        self.thread.start()
+
+    # ---
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    # ---
+    def write(self):
+        try:
+            self.metrics.export(self.filename)
+        except Exception as e:
+            print(f'''*** Warning: failed to export the metrics to {self.filename}: {e} ***''')
+
+    # ---
+    def stop(self):
+        ''' Stop the exporter, writing the final state of the metrics '''
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+        if self.verbose: print(f'''*** Exported the metrics to {self.filename} ***''')
@@ -0,0 +1,148 @@
+#
+# daq/monitor.py
+#
+# The client of the run monitor (the swf-monitor REST API). The calls whose result is needed
+# right away (the run number) are synchronous, with short timeouts and bounded retries.
+# Everything else (the heartbeats) is posted from a background thread, so a slow monitor never
+# delays the simulation: the heartbeats are sent periodically during the run, with live stats.
+
+
+import threading, queue, time
+import requests, urllib3
+from   requests.adapters import HTTPAdapter
+
+# ---
+HEARTBEAT   = '/api/systemagents/heartbeat/'
+RUN_NUMBER  = '/api/state/next-run-number/'
+
+
+###################################################################################
+class MonitorClient:
+    ''' A pooled HTTP session with the monitor, and a background thread posting the queued
+        requests and the periodic heartbeats. The queue is bounded: if the monitor can not
+        keep up, the oldest pending requests are dropped (and counted) rather than piling up.
+    '''
+    def __init__(self, url, token=None, timeout=5.0, retries=2, backoff=0.5, interval=30.0, depth=64, verbose=False):
+        self.url        = url
+        self.timeout    = timeout       # per request, seconds
+        self.retries    = retries       # the number of retries of a failed request
+        self.backoff    = backoff       # the pause before a retry, seconds, doubled on each attempt
+        self.interval   = interval      # between the periodic heartbeats, seconds
+        self.verbose    = verbose
+
+        self.session    = requests.Session()
+        self.session.mount('http://',  HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        self.session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        if token: self.session.headers.update({'Authorization': f'Token {token}'})
+        self.session.verify = False
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+        self.queue      = queue.Queue(maxsize=depth)
+        self.beat       = None          # the callable returning the payload of the periodic heartbeat
+        self.next_beat  = 0.0
+        self.sent       = 0             # counters, for the stats
+        self.failed     = 0
+        self.dropped    = 0
+        self.thread     = threading.Thread(target=self.worker, name='monitor-client', daemon=True)
+        self.thread.start()
+
+    # ---
+    def post(self, path, payload=None):
+        '''
+        Post to the monitor and return the decoded JSON response, retrying on failures.
+        Raises RuntimeError if all the attempts fail.
+        '''
+        for attempt in range(self.retries+1):
+            try:
+                response = self.session.post(f'''{self.url}{path}''', json=payload, timeout=self.timeout)
+                response.raise_for_status()
+                return response.json()
+            except Exception as e:
+                if attempt == self.retries:
+                    raise RuntimeError(f'''Failed to post to {path} after {self.retries+1} attempts: {e}''') from e
+                if self.verbose: print(f'''*** Monitor request to {path} failed ({e}), retrying... ***''')
+                time.sleep(self.backoff*2**attempt)
+
+    # ---
+    def post_async(self, path, payload=None):
+        '''
+        Queue a request to be posted by the background thread, never blocks.
+        '''
+        while True:
+            try:
+                self.queue.put_nowait((path, payload))
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait() # drop the oldest pending request
+                    self.queue.task_done()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    # ---
+    def start_heartbeats(self, func, interval=None):
+        '''
+        Send a heartbeat with the payload returned by func every interval seconds, until stopped.
+        '''
+        if interval is not None: self.interval = interval
+        self.next_beat  = time.monotonic() + self.interval
+        self.beat       = func
+        try:
+            self.queue.put_nowait((None, None)) # wake up the thread, to pick up the schedule of the heartbeats
+        except queue.Full:
+            pass # the thread has requests pending, it wakes up anyway
+
+    # ---
+    def stop_heartbeats(self):
+        self.beat = None
+
+    # ---
+    def worker(self):
+        while True:
+            timeout = None if self.beat is None else max(0.0, self.next_beat - time.monotonic())
+            try:
+                path, payload = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                beat = self.beat
+                if beat is None: continue
+                self.next_beat = time.monotonic() + self.interval
+                try:
+                    self.send(HEARTBEAT, beat())
+                except Exception as e:
+                    print(f'''Warning: failure preparing the heartbeat: {e}''')
+                continue
+
+            if path is not None: self.send(path, payload)
+            self.queue.task_done()
+
+    # ---
+    def send(self, path, payload):
+        try:
+            data = self.post(path, payload)
+            self.sent += 1
+        except Exception as e:
+            self.failed += 1
+            print(f'''Warning: failure sending to the monitor: {e}''')
+            return
+
+        if path == HEARTBEAT:
+            if isinstance(data, dict) and data.get('status') == 'OK':
+                if self.verbose: print(f'''*** [HEARTBEAT] sent: {payload.get('status')} ***''')
+            else:
+                print(f'''Warning: unexpected response from heartbeat: {data}''')
+
+    # ---
+    def flush(self, timeout=None):
+        '''
+        Wait until the queued requests have been posted, at most timeout seconds. Returns True if they have.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline: return False
+            time.sleep(0.01)
+        return True
+
+    # ---
+    def stats(self):
+        return {'sent': self.sent, 'failed': self.failed, 'dropped': self.dropped, 'pending': self.queue.qsize()}
@@ -0,0 +1,137 @@
+#
+# daq/pacing.py
+#
+# Pacing of the simulation in real time. Unlike simpy.rt.RealtimeEnvironment(strict=False),
+# which silently falls behind when a step overruns its slot, the paced environment measures
+# the lag of every step against the wall clock, applies a catch-up policy when it exceeds
+# a tolerance, and handles the intervals shorter than the resolution of the OS timers.
+
+
+import simpy, math, time
+from   simpy.core import EmptySchedule
+
+# ---
+CATCHUP = ('burst', 'skip', 'stretch')
+
+
+###################################################################################
+class PacedEnvironment(simpy.Environment):
+    ''' A SimPy environment synchronized with the wall clock, scaled by the factor
+        (wall clock seconds per simulated second).
+
+        Each event is due at a wall clock time derived from its simulated time. The wait is
+        a sleep up to "spin" seconds before the due time, followed by a busy wait, since the
+        sleep alone overshoots by tens to hundreds of microseconds. Events due within the
+        "resolution" are processed without waiting at all, so that STFs at sub-millisecond
+        intervals are batched into a single wakeup instead of each paying the timer overhead.
+
+        The lag (how late an event is processed, negative if batched early) is recorded for
+        every step. When it exceeds the tolerance, the catch-up policy applies:
+        - burst:    process the late events back to back until real time is caught up (default)
+        - skip:     same, but the STF generators drop the STFs which are late, see skipping()
+        - stretch:  shift the time origin by the lag, so the simulated time slows down instead
+    '''
+    def __init__(self, initial_time=0, factor=1.0, policy='burst', tolerance=0.01, resolution=1e-4, spin=2e-4, metrics=None):
+        if policy not in CATCHUP:
+            raise ValueError(f'''Unknown catch-up policy "{policy}", expected one of {CATCHUP}''')
+
+        super().__init__(initial_time)
+        self.factor     = factor
+        self.policy     = policy
+        self.tolerance  = tolerance     # the lag beyond which the catch-up policy applies, seconds
+        self.resolution = resolution    # the events due within this time are processed at once, seconds
+        self.spin       = spin          # the final part of each wait which is a busy wait, seconds
+        self.metrics    = metrics       # if given, the lag goes into its "lag" histogram
+
+        self.env_start  = initial_time
+        self.real_start = time.perf_counter()
+
+        self.steps      = 0             # counters, for the stats
+        self.wakeups    = 0             # the number of actual waits, less than the steps if batched
+        self.late       = 0             # the number of steps late beyond the tolerance
+        self.skipped    = 0             # the number of STFs dropped under the skip policy
+        self.stretched  = 0.0           # the total shift of the time origin, seconds
+        self.lag        = 0.0           # the lag of the last step, seconds
+        self.max_lag    = 0.0
+        self.mean_lag   = 0.0           # running mean and variance (Welford) of the lag
+        self.m2_lag     = 0.0
+
+    # ---
+    def sync(self):
+        ''' Synchronize the time origin with the wall clock, e.g. just before running '''
+        self.real_start = time.perf_counter()
+
+    # ---
+    def rescale(self, factor):
+        ''' Change the factor from now on, keeping the wall clock time the current simulated time is due at '''
+        self.real_start = self.due(self.now)
+        self.env_start  = self.now
+        self.factor     = factor
+
+    # ---
+    def due(self, t):
+        ''' The wall clock time (perf_counter) at which the simulated time t is due '''
+        return self.real_start + (t - self.env_start)*self.factor
+
+    # ---
+    def step(self):
+        evt_time = self.peek()
+        if evt_time == math.inf:
+            raise EmptySchedule()
+
+        target  = self.due(evt_time)
+        delay   = target - time.perf_counter()
+        if delay > self.resolution:
+            self.wakeups += 1
+            if delay > self.spin: time.sleep(delay - self.spin)
+            while time.perf_counter() < target: pass
+
+        lag = time.perf_counter() - target
+        self.record(lag)
+        if lag > self.tolerance:
+            self.late += 1
+            if self.policy == 'stretch':
+                self.real_start += lag
+                self.stretched  += lag
+
+        return super().step()
+
+    # ---
+    def record(self, lag):
+        self.steps     += 1
+        self.lag        = lag
+        if lag > self.max_lag: self.max_lag = lag
+        d               = lag - self.mean_lag
+        self.mean_lag  += d/self.steps
+        self.m2_lag    += d*(lag - self.mean_lag)
+        if self.metrics: self.metrics.observe('lag', max(lag, 0.0))
+
+    # ---
+    def skipping(self):
+        '''
+        True if the current step is late beyond the tolerance under the skip policy,
+        the STF generators then drop the STF instead of producing it.
+        '''
+        if self.policy != 'skip' or self.lag <= self.tolerance: return False
+        self.skipped += 1
+        return True
+
+    # ---
+    def drift(self):
+        ''' How far the wall clock is ahead of the simulated time right now, seconds '''
+        return time.perf_counter() - self.due(self.now)
+
+    # ---
+    def stats(self):
+        return {
+            'policy':       self.policy,
+            'steps':        self.steps,
+            'wakeups':      self.wakeups,
+            'late':         self.late,
+            'skipped':      self.skipped,
+            'stretched':    round(self.stretched, 6),
+            'lag_avg':      round(self.mean_lag, 6),
+            'lag_max':      round(self.max_lag, 6),
+            'jitter':       round(math.sqrt(self.m2_lag/self.steps), 6) if self.steps else 0.0,
+            'drift':        round(self.drift(), 6),
+        }
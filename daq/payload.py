@@ -0,0 +1,205 @@
+#
+# daq/payload.py
+#
+# Generation of the binary payload of the simulated STF files. The size of each STF is drawn
+# from a configurable distribution, and the body is produced in chunks so that large STFs
+# (hundreds of MB and more) can be streamed to disk without being built in memory.
+
+
+import numpy as np
+import yaml, re, threading
+
+# ---
+CHUNK_SIZE  = 4*1024*1024                   # default size of the chunks the payload is streamed in
+FILLS       = ('random', 'template', 'zero')  # ways to fill the body of the STF
+UNITS       = {'': 1, 'B': 1, 'KB': 1000, 'MB': 1000**2, 'GB': 1000**3, 'KIB': 1024, 'MIB': 1024**2, 'GIB': 1024**3}
+
+# ---
+def parse_size(value):
+    '''
+    Converts a size given either as a number of bytes or as a string with units
+    (e.g. "500MB", "1.5GiB") to an integer number of bytes.
+    '''
+    if isinstance(value, (int, float)): return int(value)
+
+    m = re.fullmatch(r'\s*([0-9.]+)\s*([A-Za-z]*)\s*', str(value))
+    if m is None or m.group(2).upper() not in UNITS:
+        raise ValueError(f'''Cannot parse the size {value}''')
+    return int(float(m.group(1))*UNITS[m.group(2).upper()])
+
+
+###################################################################################
+class Payload:
+    ''' The Payload class produces the binary bodies of the simulated STFs.
+
+        The size distribution is defined by a dictionary, one of:
+        - {'dist': 'fixed',     'size': 1000000}
+        - {'dist': 'uniform',   'low': '10MB', 'high': '20MB'}
+        - {'dist': 'lognormal', 'median': '100MB', 'sigma': 0.3}
+        - {'dist': 'state',     'states': {'run': {...}, 'run.physics': {...}}, 'default': {...}}
+
+        In the last case the size is drawn from the distribution attached to the current
+        state of the DAQ; "state.substate" keys take precedence over plain "state" keys.
+
+        The body is filled either with fresh random bytes generated by NumPy for every chunk,
+        from a pre-built template buffer (random data generated once, or the contents of a file),
+        or with zeros. The chunks may be requested from several writer threads at once,
+        each of them then gets its own random generator.
+    '''
+    def __init__(self, size=None, fill='template', chunk=CHUNK_SIZE, template=None, seed=None):
+        if fill not in FILLS:
+            raise ValueError(f'''Unknown fill {fill}, must be one of {FILLS}''')
+
+        self.size   = size if size is not None else {'dist': 'fixed', 'size': 0}
+        self.fill   = fill
+        self.chunk  = parse_size(chunk)
+        self.seed   = np.random.SeedSequence(seed)
+        self.rng    = np.random.default_rng(self.seed.spawn(1)[0]) # for the sizes, drawn in the generator
+        self.local  = threading.local()                             # per-thread generators for the random fill
+        self.lock   = threading.Lock()
+        self.buffer = None  # the template buffer, to be used for 'template' and 'zero' fills
+
+        self.check(self.size)
+
+        if fill == 'zero':
+            self.buffer = np.zeros(self.chunk, dtype=np.uint8)
+        elif fill == 'template':
+            if template:
+                with open(template, 'rb') as f: data = f.read(self.chunk)
+                if not data: raise ValueError(f'''The template file {template} is empty''')
+                reps = -(-self.chunk // len(data)) # ceiling division
+                self.buffer = np.frombuffer(data*reps, dtype=np.uint8)[:self.chunk]
+            else:
+                self.buffer = self.rng.integers(0, 256, self.chunk, dtype=np.uint8)
+
+    # ---
+    @classmethod
+    def from_yaml(cls, filename):
+        '''
+        Create the payload generator from a YAML file, see config/payload.yml for an example.
+        '''
+        with open(filename, 'r') as f:
+            cfg = yaml.safe_load(f) or {}
+        return cls(**cfg)
+
+    # ---
+    def check(self, spec):
+        '''
+        Validate the size distribution spec, recursively for the per-state case: the name of the
+        distribution, its required keys and their ranges. Raises ValueError if it is invalid.
+        '''
+        if not isinstance(spec, dict):
+            raise ValueError(f'''The size distribution must be a dictionary, got {spec}''')
+        dist = spec.get('dist', 'fixed')
+        if dist == 'state':
+            states = spec.get('states', {})
+            if not isinstance(states, dict):
+                raise ValueError(f'''The states of the size distribution must be a dictionary, got {states}''')
+            for s in list(states.values()) + [spec.get('default', {'dist': 'fixed', 'size': 0})]:
+                self.check(s)
+            return
+        if dist not in ('fixed', 'uniform', 'lognormal'):
+            raise ValueError(f'''Unknown size distribution {dist}''')
+
+        missing = [key for key in {'uniform': ('low', 'high'), 'lognormal': ('median',)}.get(dist, ()) if key not in spec]
+        if missing: raise ValueError(f'''The {dist} size distribution needs {missing}''')
+        if dist == 'fixed' and parse_size(spec.get('size', 0)) < 0:
+            raise ValueError(f'''The size must not be negative, got {spec['size']}''')
+        if dist == 'uniform' and not 0 <= parse_size(spec['low']) <= parse_size(spec['high']):
+            raise ValueError(f'''The uniform size distribution needs 0 <= low <= high, got {spec['low']} and {spec['high']}''')
+        if dist == 'lognormal':
+            if parse_size(spec['median']) <= 0:
+                raise ValueError(f'''The median of the lognormal size distribution must be positive, got {spec['median']}''')
+            if float(spec.get('sigma', 0.25)) < 0.0:
+                raise ValueError(f'''The sigma of the lognormal size distribution must not be negative, got {spec['sigma']}''')
+
+    # ---
+    def draw(self, spec, state=None, substate=None):
+        dist = spec.get('dist', 'fixed')
+
+        if dist == 'fixed':
+            return parse_size(spec.get('size', 0))
+        if dist == 'uniform':
+            return int(self.rng.uniform(parse_size(spec['low']), parse_size(spec['high'])))
+        if dist == 'lognormal':
+            return int(self.rng.lognormal(np.log(parse_size(spec['median'])), spec.get('sigma', 0.25)))
+
+        # dist == 'state'
+        return self.draw(self.resolve(spec, state, substate), state, substate)
+
+    # ---
+    def resolve(self, spec, state=None, substate=None):
+        ''' For the per-state distribution, pick the one for the given state and substate '''
+        while spec.get('dist', 'fixed') == 'state':
+            states  = spec.get('states', {})
+            spec    = states.get(f'''{state}.{substate}''', states.get(state, spec.get('default', {'dist': 'fixed', 'size': 0})))
+        return spec
+
+    # ---
+    def stf_size(self, state=None, substate=None):
+        '''
+        Draw the size of the next STF, in bytes, for the given state and substate of the DAQ.
+        '''
+        return max(0, self.draw(self.size, state, substate))
+
+    # ---
+    def sizes(self, n, state=None, substate=None, spec=None):
+        '''
+        Draw the sizes of the next n STFs at once, as a NumPy array. The distribution is
+        the one of the payload, unless another spec is given (e.g. by the schedule entry).
+        '''
+        spec = self.resolve(self.size if spec is None else spec, state, substate)
+        dist = spec.get('dist', 'fixed')
+
+        if dist == 'fixed':
+            x = np.full(n, parse_size(spec.get('size', 0)), dtype=np.int64)
+        elif dist == 'uniform':
+            x = self.rng.uniform(parse_size(spec['low']), parse_size(spec['high']), n).astype(np.int64)
+        else:
+            x = self.rng.lognormal(np.log(parse_size(spec['median'])), spec.get('sigma', 0.25), n).astype(np.int64)
+        return np.maximum(x, 0)
+
+    # ---
+    def chunk_rng(self):
+        ''' The random generator for the body of the STF, private to the calling thread '''
+        rng = getattr(self.local, 'rng', None)
+        if rng is None:
+            with self.lock: rng = self.local.rng = np.random.default_rng(self.seed.spawn(1)[0])
+        return rng
+
+    # ---
+    def chunks(self, size):
+        '''
+        Generator of the chunks which make up a body of the given size. The chunks
+        are memoryviews which are only valid until the next one is requested.
+        '''
+        remaining = size
+        rng = self.chunk_rng() if self.fill == 'random' else None
+        while remaining > 0:
+            n = min(remaining, self.chunk)
+            if rng is not None:
+                yield memoryview(rng.bytes(n))
+            else:
+                yield memoryview(self.buffer)[:n]
+            remaining -= n
+
+    # ---
+    def __getstate__(self):
+        ''' For pickling, e.g. to pass the payload to the worker processes of the sharded mode '''
+        state = self.__dict__.copy()
+        del state['local'], state['lock']
+        return state
+
+    # ---
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local  = threading.local()
+        self.lock   = threading.Lock()
+
+    # ---
+    def __str__(self):
+        return f'''Payload: size={self.size}, fill={self.fill}, chunk={self.chunk}'''
+
+    # ---
+    def __repr__(self):
+        return self.__str__()
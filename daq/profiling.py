@@ -0,0 +1,205 @@
+#
+# daq/profiling.py
+#
+# The profiling mode: the hot path of each run (the STF generators, the scheduler, the writes and the
+# MQ sends, i.e. the event loop of the simulation and the writer and publisher threads) is profiled,
+# leaving out the start and the end of the run. The profilers, any of (comma-separated, or "all"):
+#
+#   - cprofile:     the deterministic profiler of the standard library, in the simulation thread;
+#                   exact call counts, but it slows the hot path down several times
+#   - sample:       a sampling profiler, a thread taking the stacks of the simulation, writer and
+#                   publisher threads every "interval" seconds; low overhead, fit for real-time runs
+#   - memory:       tracemalloc, the allocations made during the run by the line of code, and the peak
+#
+# The artifacts of each run go to the profile folder, named after the run (and the shard):
+#   - profile.<run>.pstats          the cProfile data, for pstats, snakeviz etc.
+#   - profile.<run>.cprofile.txt    the top functions by the cumulative and by the own time
+#   - profile.<run>.collapsed       the sampled stacks, collapsed ("a;b;c count"), for flamegraph.pl or speedscope
+#   - profile.<run>.alloc.txt       the top allocators, by the line and with their tracebacks
+
+
+import threading, cProfile, pstats, tracemalloc, sys, time, os, io
+
+from collections import Counter
+
+# ---
+PROFILERS   = ('cprofile', 'sample', 'memory')
+HOT_THREADS = ('stf-writer', 'mq-publisher') # sampled along with the simulation thread
+
+
+###################################################################################
+class Sampler:
+    ''' The sampling profiler: a thread taking the stacks of the hot threads at a fixed interval,
+        and counting them by the collapsed stack, the root being the name of the thread.
+    '''
+    def __init__(self, interval=0.005):
+        self.interval   = interval
+        self.stacks     = Counter()
+        self.labels     = {}        # the labels of the code objects, cached
+        self.samples    = 0
+        self.elapsed    = 0.0       # the time spent sampling, seconds
+        self.stop_event = threading.Event()
+        self.thread     = None
+
+    # ---
+    def start(self, main):
+        ''' Start sampling, "main" is the ident of the simulation thread '''
+        self.main       = main
+        self.stop_event.clear()
+        self.thread     = threading.Thread(target=self.loop, name='profile-sampler', daemon=True)
+        self.thread.start()
+
+    # ---
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = f'''{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'''
+        return label
+
+    # ---
+    def loop(self):
+        while not self.stop_event.wait(self.interval):
+            t = time.perf_counter()
+            names = {th.ident: th.name for th in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = 'simulation' if ident == self.main else names.get(ident, '')
+                if name != 'simulation' and not name.startswith(HOT_THREADS): continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(name.rstrip('0123456789-') or name) # the writer threads together
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            self.elapsed += time.perf_counter() - t
+
+    # ---
+    def stop(self):
+        self.stop_event.set()
+        if self.thread: self.thread.join()
+        self.thread = None
+
+    # ---
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            for stack, n in self.stacks.most_common(): f.write(f'''{stack} {n}\n''')
+
+
+###################################################################################
+class Profiler:
+    ''' Profiles the hot path of the runs with the chosen profilers, see the header of this file.
+        start() and stop() are called around the event loop of each run, in the simulation thread;
+        stop() writes the artifacts of the run.
+    '''
+    def __init__(self, spec='cprofile', folder='.', interval=0.005, top=40, frames=16, verbose=False):
+        self.kinds      = PROFILERS if spec == 'all' else tuple(k.strip() for k in spec.split(',') if k.strip())
+        unknown = set(self.kinds) - set(PROFILERS)
+        if unknown or not self.kinds:
+            raise ValueError(f'''Unknown profilers {sorted(unknown)}, must be some of {PROFILERS} or all''')
+        if interval <= 0.0:
+            raise ValueError('The sampling interval must be positive')
+        self.folder     = folder
+        self.interval   = interval      # seconds between the samples
+        self.top        = top           # the number of the functions and of the allocators in the summaries
+        self.frames     = frames        # the depth of the tracebacks of the allocations
+        self.verbose    = verbose
+        self.profile    = None
+        self.sampler    = None
+        self.snapshot   = None          # the allocations at the start of the run
+        self.tracing    = False         # tracemalloc was started here, not by the environment
+        self.started    = 0.0
+        self.artifacts  = []            # the files written for the last run
+
+    # ---
+    def start(self):
+        ''' Start profiling, in the simulation thread, just before the event loop '''
+        self.halt() # the profilers left over by a run which failed before stop(), if any
+        if 'memory' in self.kinds:
+            self.tracing = not tracemalloc.is_tracing()
+            if self.tracing: tracemalloc.start(self.frames)
+            tracemalloc.reset_peak()
+            self.snapshot = tracemalloc.take_snapshot()
+        if 'sample' in self.kinds:
+            self.sampler = Sampler(self.interval)
+            self.sampler.start(threading.get_ident())
+        if 'cprofile' in self.kinds:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                self.profile = profile
+            except (RuntimeError, ValueError) as e: # another profiler is installed, e.g. cProfile around the whole process
+                print(f'''Warning: cProfile is not available for this run: {e}''')
+        self.started = time.perf_counter()
+
+    # ---
+    def halt(self):
+        '''
+        Stop the profilers of the run, if any, and forget them. Returns the cProfile, the sampler and
+        the allocations (the snapshots at the start and now, the traced memory and its peak), or None each.
+        '''
+        profile, sampler, memory = self.profile, self.sampler, None
+        if profile: profile.disable()
+        if sampler: sampler.stop()
+        if self.snapshot is not None:
+            memory = (self.snapshot, tracemalloc.take_snapshot(), *tracemalloc.get_traced_memory())
+            if self.tracing: tracemalloc.stop()
+        self.profile = self.sampler = self.snapshot = None
+        self.tracing = False
+        return profile, sampler, memory
+
+    # ---
+    def stop(self, tag):
+        '''
+        Stop profiling, and write the artifacts of the run, named after the tag. Returns their paths.
+        '''
+        elapsed = time.perf_counter() - self.started
+        profile, sampler, memory = self.halt()
+        self.artifacts = []
+        if not (profile or sampler or memory): return self.artifacts # not started
+
+        os.makedirs(self.folder, exist_ok=True)
+        base = os.path.join(self.folder, f'''profile.{tag}''')
+
+        if profile:
+            profile.dump_stats(f'''{base}.pstats''')
+            with open(f'''{base}.cprofile.txt''', 'w') as f:
+                f.write(f'''# The hot path of run {tag}, {elapsed:.3f}s\n''')
+                for key in ('cumulative', 'tottime'):
+                    stats = pstats.Stats(profile, stream=f).strip_dirs().sort_stats(key)
+                    stats.print_stats(self.top)
+            self.artifacts += [f'''{base}.pstats''', f'''{base}.cprofile.txt''']
+
+        if sampler:
+            sampler.write(f'''{base}.collapsed''')
+            self.artifacts.append(f'''{base}.collapsed''')
+            if self.verbose:
+                print(f'''*** Profile: {sampler.samples} samples every {self.interval}s, {len(sampler.stacks)} stacks, '''
+                      f'''sampling took {1e3*sampler.elapsed/max(1, sampler.samples):.3f}ms per sample ***''')
+
+        if memory:
+            self.write_allocations(f'''{base}.alloc.txt''', tag, *memory, elapsed)
+            self.artifacts.append(f'''{base}.alloc.txt''')
+
+        if self.verbose: print(f'''*** Profile of run {tag}: {', '.join(self.artifacts)} ***''')
+        return self.artifacts
+
+    # ---
+    def write_allocations(self, filename, tag, start, snapshot, current, peak, elapsed):
+        ''' The top allocators of the run: the growth by the line, then the largest ones with their tracebacks '''
+        ignore  = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__, all_frames=True), # not the profiling itself
+                   tracemalloc.Filter(False, '<frozen importlib._bootstrap>')]
+        after   = snapshot.filter_traces(ignore)
+        before  = start.filter_traces(ignore)
+        out     = io.StringIO()
+        out.write(f'''# The allocations during run {tag}, {elapsed:.3f}s: traced {current/1e6:.3f} MB at the end, peak {peak/1e6:.3f} MB\n''')
+        out.write(f'''\n# Top {self.top} by the growth, by the line\n''')
+        for diff in after.compare_to(before, 'lineno')[:self.top]: out.write(f'''{diff}\n''')
+        out.write(f'''\n# Top {min(self.top, 10)} by the size, with the tracebacks\n''')
+        for stat in after.statistics('traceback')[:min(self.top, 10)]:
+            out.write(f'''\n{stat.count} blocks, {stat.size/1e3:.1f} KB\n''')
+            for line in stat.traceback.format(): out.write(f'''{line}\n''')
+        with open(filename, 'w') as f: f.write(out.getvalue())
+
+    # ---
+    def __str__(self):
+        return f'''profiling with {', '.join(self.kinds)} to {self.folder}'''
@@ -0,0 +1,117 @@
+#
+# daq/publisher.py
+#
+# Asynchronous MQ publisher: a bounded queue between the DAQ and the MQ sender, drained
+# by a background thread, so that the round-trip to the broker does not happen on the
+# simulation thread. At high STF rates the broker, not the simulator, becomes the bottleneck.
+
+
+import threading, queue, time
+
+# ---
+PERSISTENT = {'persistent': 'true'}
+
+
+###################################################################################
+class Publisher:
+    ''' The Publisher takes the message bodies from the DAQ and sends them to the MQ destination
+        from a background thread, in the order they were published. If a send fails, the sender
+        is reconnected and the message retried, up to a bounded number of attempts.
+
+        The queue is bounded: when it is full, publish() blocks until there is room.
+        Publish latency (from the call to publish() to the completion of the send),
+        queue depth and message rate are available from the stats() method.
+    '''
+    def __init__(self, sender, destination='epictopic', depth=1024, retries=3, backoff=0.5, verbose=False, metrics=None):
+        self.sender     = sender
+        self.destination= destination
+        self.retries    = retries       # the number of reconnect attempts per message
+        self.backoff    = backoff       # the pause before a reconnect, seconds, doubled on each attempt
+        self.verbose    = verbose
+        self.metrics    = metrics       # if given, the publish latency goes into its "publish" histogram
+        self.queue      = queue.Queue(maxsize=depth)
+
+        self.sent       = 0             # counters, for the stats
+        self.failed     = 0
+        self.reconnects = 0
+        self.max_depth  = 0
+        self.latency    = 0.0           # total publish latency, seconds
+        self.max_latency= 0.0
+        self.blocked    = 0.0           # the time publish() spent waiting on a full queue, seconds
+        self.t_start    = time.perf_counter()
+
+        self.thread     = threading.Thread(target=self.worker, name='mq-publisher', daemon=True)
+        self.thread.start()
+
+    # ---
+    def publish(self, body, headers=PERSISTENT):
+        '''
+        Queue a message to be sent, blocks only if the queue is full.
+        '''
+        item = (time.perf_counter(), body, headers)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            t = time.perf_counter()
+            self.queue.put(item)
+            self.blocked += time.perf_counter() - t
+
+        depth = self.queue.qsize()
+        if depth > self.max_depth: self.max_depth = depth
+
+    # ---
+    def send(self, body, headers):
+        ''' Send a message, reconnecting and retrying on failure. Returns True on success. '''
+        for attempt in range(self.retries+1):
+            try:
+                self.sender.send(destination=self.destination, body=body, headers=headers)
+                return True
+            except Exception as e:
+                if attempt == self.retries:
+                    print(f'''*** Failed to send an MQ message after {self.retries} reconnects: {e} ***''')
+                    return False
+                if self.verbose: print(f'''*** MQ send failed ({e}), reconnecting... ***''')
+                time.sleep(self.backoff*2**attempt)
+                self.reconnects += 1
+                try:
+                    self.sender.connect()
+                except Exception as e:
+                    if self.verbose: print(f'''*** MQ reconnect failed: {e} ***''')
+        return False
+
+    # ---
+    def worker(self):
+        while True:
+            t, body, headers = self.queue.get()
+            if self.send(body, headers):
+                latency = time.perf_counter() - t
+                self.sent       += 1
+                self.latency    += latency
+                if latency > self.max_latency: self.max_latency = latency
+                if self.metrics: self.metrics.observe('publish', latency)
+            else:
+                self.failed += 1
+            self.queue.task_done()
+
+    # ---
+    def flush(self):
+        '''
+        Wait until all the queued messages have been sent (or have failed).
+        '''
+        self.queue.join()
+        if self.verbose: print(f'''*** MQ publisher flushed: {self.stats()} ***''')
+
+    # ---
+    def stats(self):
+        elapsed = time.perf_counter() - self.t_start
+        return {
+            'sent':         self.sent,
+            'failed':       self.failed,
+            'reconnects':   self.reconnects,
+            'depth':        self.queue.qsize(),
+            'max_depth':    self.max_depth,
+            'rate':         round(self.sent/elapsed, 3) if elapsed > 0 else 0.0,
+            'latency_avg':  round(self.latency/self.sent, 6) if self.sent else 0.0,
+            'latency_max':  round(self.max_latency, 6),
+            'blocked':      round(self.blocked, 6),
+        }
@@ -0,0 +1,282 @@
+#
+# daq/ring.py
+#
+# Shared-memory handoff to the consumers on the same node: instead of a file per STF, the STFs are
+# written into a ring buffer in a memory-mapped file (e.g. in /dev/shm), and the "stf_gen" messages
+# refer to their slots ("ring", "seq", "offset") instead of a path. The consumers map the same file
+# and read the STFs in place, with the RingReader below, so there is no filesystem in the loop.
+#
+# The file is laid out as:
+#   - the header (RING_HEADER), 64 bytes: the magic, the version, the geometry, the write cursor and
+#     the sequence number of the last STF written
+#   - the table of the slots (RING_SLOT), one record per STF, the slot of the STF "seq" is seq % slots
+#   - the data area, from the next page boundary on, "capacity" bytes used as a ring
+#
+# The positions in the data area are absolute (they grow forever), the offset in the file is
+# data + position % capacity, and an STF never wraps around: if it does not fit before the end,
+# it goes to the start. The writer does not wait for the consumers: the oldest STFs are overwritten
+# when the ring is full. The cursor is moved before the data is overwritten, so a reader can tell
+# whether an STF is still intact: its position is at most "capacity" behind the cursor.
+
+
+import numpy as np
+import threading, mmap, time, os
+
+# ---
+RING_MAGIC      = b'DAQRING\0'
+RING_VERSION    = 1
+PAGE            = 4096  # the data area starts at a page boundary
+RING_HEADER     = np.dtype([
+    ('magic',       'S8'),
+    ('version',     '<u4'),
+    ('slots',       '<u4'),     # the number of the slots in the table
+    ('capacity',    '<u8'),     # the size of the data area
+    ('data',        '<u8'),     # the offset of the data area in the file
+    ('cursor',      '<u8'),     # the absolute position of the end of the last reserved STF
+    ('seq',         '<u8'),     # the sequence number of the last STF written, 0 if none
+    ('created',     '<f8'),     # the creation time of the ring, seconds since the epoch
+    ('pid',         '<u4'),     # the process ID of the writer
+    ('pad',         '<u4'),
+])
+RING_SLOT       = np.dtype([
+    ('seq',         '<u8'),     # the sequence number of the STF, 0 while it is being written
+    ('position',    '<u8'),     # the absolute position of the STF in the data area
+    ('length',      '<u8'),     # the size of the STF
+    ('adler32',     '<u4'),     # the Adler-32 checksum of the STF
+    ('stream',      '<u4'),     # the stream ID
+    ('filename',    'S32'),     # the (logical) filename of the STF, as announced in the MQ messages
+])
+
+
+###################################################################################
+class RingSlot:
+    ''' A file-like object writing to a reserved range of the data area, see RingBuffer.reserve() '''
+    def __init__(self, data, offset):
+        self.data   = data
+        self.offset = offset
+
+    def write(self, chunk):
+        n = len(chunk)
+        self.data[self.offset:self.offset+n] = chunk
+        self.offset += n
+        return n
+
+
+###################################################################################
+class RingBuffer:
+    ''' The writer of the ring. The space of each STF is reserved under a lock, the data is copied
+        outside of it, so the threads of the writer pool still write in parallel, and the slot is
+        then committed: its sequence number is set last, when the record is complete.
+
+        The ring is created under a temporary name and renamed in place, so a consumer never maps
+        a half-initialized file, and the consumers of a previous ring keep their (still valid) map.
+    '''
+    def __init__(self, path, capacity=256<<20, slots=4096):
+        if capacity <= 0 or slots <= 0:
+            raise ValueError('The ring buffer needs a positive capacity and number of slots')
+        self.path       = path
+        self.capacity   = int(capacity)
+        self.slots      = int(slots)
+        self.offset     = -(-(RING_HEADER.itemsize + self.slots*RING_SLOT.itemsize)//PAGE)*PAGE # the data area, page-aligned
+        self.lock       = threading.Lock()
+        self.cursor     = 0
+        self.seq        = 0
+        self.count      = 0     # the number of STFs written
+        self.bytes      = 0     # their total size
+        self.wraps      = 0     # the number of times the cursor went back to the start of the data area
+        self.oversize   = 0     # the number of STFs dropped, larger than the data area
+
+        temp = f'''{path}.{os.getpid()}.tmp'''
+        fd = os.open(temp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.offset + self.capacity)
+            self.mm = mmap.mmap(fd, self.offset + self.capacity)
+        finally:
+            os.close(fd)
+
+        self.header     = np.frombuffer(self.mm, dtype=RING_HEADER, count=1)
+        self.table      = np.frombuffer(self.mm, dtype=RING_SLOT, count=self.slots, offset=RING_HEADER.itemsize)
+        self.data       = memoryview(self.mm)[self.offset:]
+        h = self.header
+        h['version'], h['slots'], h['capacity'], h['data'] = RING_VERSION, self.slots, self.capacity, self.offset
+        h['created'], h['pid'] = time.time(), os.getpid()
+        h['magic'] = RING_MAGIC # last, the header is complete
+        os.rename(temp, path)
+
+    # ---
+    def fits(self, length):
+        ''' True if an STF of the given length fits in the data area, otherwise it is counted in "oversize" '''
+        if length <= self.capacity: return True
+        with self.lock: self.oversize += 1
+        return False
+
+    # ---
+    def reserve(self, length):
+        '''
+        Reserve the space of an STF of the given length. Returns its sequence number, its absolute
+        position and a file-like object to write the data with, or None if the STF is larger than
+        the data area: it is then counted in "oversize", as the tail of a size model may well be.
+        '''
+        if not self.fits(length): return None
+        with self.lock:
+            position = self.cursor
+            offset   = position % self.capacity
+            if offset + length > self.capacity: # to the start of the data area
+                position += self.capacity - offset
+                offset    = 0
+                self.wraps += 1
+            self.cursor = position + length
+            self.seq   += 1
+            seq         = self.seq
+            self.table['seq'][seq % self.slots] = 0     # the slot is being reused
+            self.header['cursor'] = self.cursor         # before the data it overwrites
+        return seq, position, RingSlot(self.data, offset)
+
+    # ---
+    def commit(self, seq, position, length, adler32, filename, stream=0):
+        ''' Fill in the slot of the written STF, which makes it visible to the readers '''
+        k = seq % self.slots
+        t = self.table
+        t['position'][k], t['length'][k], t['adler32'][k] = position, length, adler32
+        t['stream'][k], t['filename'][k] = stream, filename.encode()
+        t['seq'][k] = seq # last, the slot is complete
+        with self.lock:
+            if seq > self.header['seq'][0]: self.header['seq'] = seq
+            self.count += 1
+            self.bytes += length
+
+    # ---
+    def close(self):
+        ''' Unmap the ring, the file stays for the consumers '''
+        self.header = self.table = None
+        self.data.release()
+        self.mm.close()
+
+    # ---
+    def __str__(self):
+        return f'''ring buffer {self.path}: {self.capacity} bytes, {self.slots} slots'''
+
+    # ---
+    def stats(self):
+        return {'path': self.path, 'capacity': self.capacity, 'slots': self.slots,
+                'stfs': self.count, 'bytes': self.bytes, 'wraps': self.wraps, 'oversize': self.oversize, 'seq': self.seq}
+
+
+###################################################################################
+class RingReader:
+    ''' The reader side, for the consumers: maps the ring read-only and gives zero-copy views of
+        the STFs, either those announced in the "stf_gen" messages (get) or all of them in order
+        (follow). A view is only valid as long as the STF is not overwritten: check it with valid()
+        once done with it, or use read(), which copies the data and then checks. The views pin the
+        map: release them (del, or memoryview.release()) before close().
+    '''
+    def __init__(self, path):
+        self.path   = path
+        with open(path, 'rb') as f:
+            self.inode  = os.fstat(f.fileno()).st_ino
+            self.mm     = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = np.frombuffer(self.mm, dtype=RING_HEADER, count=1)
+        h = self.header[0]
+        if h['magic'] != RING_MAGIC.rstrip(b'\0') or h['version'] != RING_VERSION:
+            self.close()
+            raise ValueError(f'''{path} is not a ring buffer of version {RING_VERSION}''')
+        self.slots      = int(h['slots'])
+        self.capacity   = int(h['capacity'])
+        self.offset     = int(h['data'])
+        self.table      = np.frombuffer(self.mm, dtype=RING_SLOT, count=self.slots, offset=RING_HEADER.itemsize)
+        self.data       = memoryview(self.mm)[self.offset:]
+        self.lost       = 0     # the STFs overwritten before they were read, in follow()
+
+    # ---
+    def latest(self):
+        ''' The sequence number of the last STF written '''
+        return int(self.header['seq'][0])
+
+    # ---
+    def entry(self, seq):
+        ''' The slot record of the STF (a copy), or None if the slot has been reused or is being written '''
+        e = self.table[seq % self.slots].copy()
+        return e if e['seq'] == seq else None
+
+    # ---
+    def valid(self, seq, position=None):
+        ''' True if the STF has not been overwritten, the position is that of its slot unless given '''
+        if position is None:
+            e = self.entry(seq)
+            if e is None: return False
+            position = int(e['position'])
+        return int(self.header['cursor'][0]) <= position + self.capacity
+
+    # ---
+    def view(self, seq):
+        '''
+        A zero-copy view (memoryview) of the STF, or None if it has been overwritten.
+        '''
+        e = self.entry(seq)
+        if e is None: return None
+        position, length = int(e['position']), int(e['length'])
+        if not self.valid(seq, position): return None
+        offset = position % self.capacity
+        return self.data[offset:offset+length]
+
+    # ---
+    def read(self, seq):
+        ''' A copy of the STF (bytes), or None if it has been overwritten, before or while copying '''
+        e = self.entry(seq)
+        v = self.view(seq)
+        if v is None: return None
+        data = bytes(v)
+        return data if self.valid(seq, int(e['position'])) else None
+
+    # ---
+    def get(self, md):
+        ''' The view of the STF announced by an "stf_gen" message (its metadata), see view() '''
+        return self.view(int(md['seq']))
+
+    # ---
+    def follow(self, start=None, poll=0.001, timeout=None):
+        '''
+        Generator of (seq, view) of the STFs in order, from the sequence number "start" on (by
+        default the next one written), polling for the new ones. The STFs overwritten before they
+        are reached are skipped and counted in "lost". Ends after "timeout" seconds without new STFs.
+        '''
+        seq     = self.latest() + 1 if start is None else start
+        idle    = time.monotonic()
+        while True:
+            latest = self.latest()
+            if seq > latest:
+                if timeout is not None and time.monotonic() - idle > timeout: return
+                time.sleep(poll)
+                continue
+            idle = time.monotonic()
+            if latest - seq >= self.slots: # the slots are reused already
+                self.lost  += latest - seq - self.slots + 1
+                seq         = latest - self.slots + 1
+            e = self.table[seq % self.slots]
+            if e['seq'] < seq: # being written, or committed out of order by the writer threads
+                time.sleep(poll)
+                continue
+            v = self.view(seq)
+            if v is None:
+                self.lost += 1
+            else:
+                yield seq, v
+            seq += 1
+
+    # ---
+    def stale(self):
+        ''' True if the ring has been re-created by a new writer, then open a new reader '''
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            return True
+
+    # ---
+    def close(self):
+        ''' Unmap the ring, raises BufferError if views of the STFs are still held '''
+        self.header = self.table = None
+        if hasattr(self, 'data'): self.data.release()
+        try:
+            self.mm.close()
+        except BufferError:
+            raise BufferError(f'''The ring buffer {self.path} is still in use: release the views of the STFs before closing it''')
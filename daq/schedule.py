@@ -0,0 +1,221 @@
+#
+# daq/schedule.py
+#
+# The schedule of the DAQ states, compiled from its YAML definition into a transition table:
+# the start time of each segment along with its state and substate. The scheduler in the DAQ
+# class can then sleep exactly until the next transition instead of polling on a clock.
+#
+# In addition to the plain list of entries, the YAML format supports repeat blocks, e.g.
+#
+# - repeat: 168
+#   steps:
+#     - state:    run
+#       substate: physics
+#       span:     0,0,1,0,0
+#     - state:    calib
+#       substate: calib
+#       span:     0,0,0,5,0
+#
+# Each entry may also carry its own arrival model and size model of the STFs (see arrival.py
+# and payload.py), which then apply to the segment this entry produces, e.g.
+#
+# - state:    run
+#   substate: physics
+#   span:     0,0,1,0,0
+#   arrival:  {model: poisson, rate: 100}
+#   size:     {dist: lognormal, median: 200MB, sigma: 0.2}
+#
+# The compiled table is cached next to the YAML file (with the .npz extension appended)
+# and reused as long as the YAML file is not modified. A compiled .npz file can also be
+# used as the schedule directly.
+
+
+import numpy as np
+import yaml, datetime, os, json, threading
+
+# ---
+COMPILED_EXT = '.npz'
+
+# ---
+def parse_span(span):
+    '''
+    Converts a span given as a string of 5 comma-separated integers: weeks, days, hours, minutes, seconds
+    (e.g. 0,0,0,1,0) to a number of seconds.
+    '''
+    x = [int(p) for p in str(span).split(',')]
+    if len(x) != 5:
+        raise ValueError(f'''The span must be a comma-separated list of 5 integers, got {span}''')
+    return datetime.timedelta(weeks=x[0], days=x[1], hours=x[2], minutes=x[3], seconds=x[4]).total_seconds()
+
+# ---
+def expand(entries):
+    '''
+    Flatten the list of schedule entries, unrolling the repeat blocks (which may be nested),
+    into a list of (state, substate, duration, arrival, size) tuples. The last two are the
+    arrival and size models of the entry, or None if it does not define them.
+    '''
+    flat = []
+    for entry in entries:
+        if 'repeat' in entry:
+            block = expand(entry.get('steps', []))
+            flat.extend(block*int(entry['repeat']))
+        else:
+            flat.append((entry['state'], entry['substate'], parse_span(entry['span']), entry.get('arrival'), entry.get('size')))
+    return flat
+
+
+###################################################################################
+class Schedule:
+    ''' The compiled schedule: a table of transitions, sorted by time.
+
+        - starts:    the start time of each segment, seconds from the beginning of the run
+        - states:    the state in each segment
+        - substates: the substate in each segment
+        - end:       the end of the last segment
+        - models:    the distinct arrival and size models (dictionaries) found in the schedule
+        - arrival:   for each segment, the index of its arrival model in the list above, or -1
+        - size:      same, for the size model
+    '''
+    def __init__(self, starts, states, substates, end, models=(), arrival=None, size=None):
+        self.starts     = np.asarray(starts, dtype=np.float64)
+        self.states     = list(states)
+        self.substates  = list(substates)
+        self.end        = float(end)
+        self.models     = list(models)
+        self.arrival    = np.full(len(self.starts), -1, dtype=np.int32) if arrival is None else np.asarray(arrival, dtype=np.int32)
+        self.size       = np.full(len(self.starts), -1, dtype=np.int32) if size    is None else np.asarray(size,    dtype=np.int32)
+        self.mtime      = 0.0   # the modification time of the YAML source, for the cache
+
+    # ---
+    @classmethod
+    def from_entries(cls, entries):
+        flat = expand(entries)
+        if not flat:
+            raise ValueError('The schedule is empty')
+
+        models  = []    # the distinct models, referred to by index from the segments
+        lookup  = {}
+        def index(model):
+            if model is None: return -1
+            key = json.dumps(model, sort_keys=True)
+            if key not in lookup:
+                lookup[key] = len(models)
+                models.append(model)
+            return lookup[key]
+
+        spans   = np.array([f[2] for f in flat], dtype=np.float64)
+        bounds  = np.concatenate(([0.0], np.cumsum(spans)))
+        return cls(bounds[:-1], [f[0] for f in flat], [f[1] for f in flat], bounds[-1],
+                   models, [index(f[3]) for f in flat], [index(f[4]) for f in flat])
+
+    # ---
+    @classmethod
+    def from_yaml(cls, filename):
+        with open(filename, 'r') as f:
+            entries = yaml.safe_load(f)
+        return cls.from_entries(entries)
+
+    # ---
+    @classmethod
+    def compile(cls, filename, cache=True):
+        '''
+        Get the compiled schedule for the YAML file, from the cache if it is up to date,
+        otherwise compile it and try to update the cache. If the file itself is a compiled
+        schedule, just load it.
+        '''
+        if filename.endswith(COMPILED_EXT):
+            return cls.load(filename)
+
+        compiled = filename + COMPILED_EXT
+        mtime    = os.path.getmtime(filename)
+
+        if cache and os.path.exists(compiled):
+            try:
+                schedule = cls.load(compiled)
+                if schedule.mtime == mtime: return schedule
+            except Exception:
+                pass # a stale or broken cache, just recompile
+
+        schedule = cls.from_yaml(filename)
+        if cache:
+            try:
+                schedule.save(compiled, mtime)
+            except OSError:
+                pass # e.g. a read-only config folder, the cache is optional
+        return schedule
+
+    # ---
+    def save(self, filename, mtime=0.0):
+        '''
+        Save the compiled schedule. The state and substate names are stored once,
+        the segments refer to them by index. The models are stored as JSON strings.
+        The file is replaced atomically, so a concurrent compile never loads a partial one.
+        '''
+        names   = sorted(set(self.states) | set(self.substates))
+        lookup  = {n: i for i, n in enumerate(names)}
+        tmp     = f'''{filename}.{os.getpid()}.{threading.get_ident()}.tmp'''
+        try:
+            with open(tmp, 'wb') as f:
+                np.savez(f,
+                         starts     = self.starts,
+                         states     = np.array([lookup[s] for s in self.states], dtype=np.int32),
+                         substates  = np.array([lookup[s] for s in self.substates], dtype=np.int32),
+                         names      = np.array(names, dtype=str),
+                         models     = np.array([json.dumps(m) for m in self.models], dtype=str),
+                         arrival    = self.arrival,
+                         size       = self.size,
+                         end        = np.float64(self.end),
+                         mtime      = np.float64(mtime))
+            os.replace(tmp, filename)
+        except BaseException:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+
+    # ---
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename, allow_pickle=False) as data:
+            names       = data['names'].tolist()
+            schedule    = cls(data['starts'],
+                              [names[i] for i in data['states']],
+                              [names[i] for i in data['substates']],
+                              data['end'],
+                              [json.loads(m) for m in data['models'].tolist()],
+                              data['arrival'],
+                              data['size'])
+            schedule.mtime = float(data['mtime'])
+        return schedule
+
+    # ---
+    def index_at(self, t):
+        ''' The index of the segment the time t falls into, the last one past the end '''
+        return max(0, int(np.searchsorted(self.starts, t, side='right')) - 1)
+
+    # ---
+    def arrival_model(self, index):
+        ''' The arrival model (a dictionary) of the segment, or None '''
+        i = self.arrival[index]
+        return self.models[i] if i >= 0 else None
+
+    # ---
+    def size_model(self, index):
+        ''' The size model (a dictionary) of the segment, or None '''
+        i = self.size[index]
+        return self.models[i] if i >= 0 else None
+
+    # ---
+    def duration(self, index):
+        ''' The duration of the segment, seconds '''
+        return (self.starts[index+1] if index+1 < len(self.starts) else self.end) - self.starts[index]
+
+    # ---
+    def __len__(self):
+        return len(self.starts)
+
+    # ---
+    def __str__(self):
+        return f'''Schedule: {len(self)} segments, end={self.end}s'''
+
+    # ---
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,181 @@
+#
+# daq/shaping.py
+#
+# Live load shaping: the STF rate, the arrival and size models, the time factor and the state
+# of the DAQ can be changed during a run, by the "shape" control messages of the daemon mode
+# (see control.py), e.g. to walk a downstream chain up to its saturation point in one run:
+#
+#   {"msg_type": "control", "command": "shape", "rate": 200}                     STFs per second, per stream
+#   {"msg_type": "control", "command": "shape", "ramp": {"to": 2000, "over": 60}} linear ramp of the rate
+#   {"msg_type": "control", "command": "shape", "ramp": {"to": 2000, "over": 60, "kind": "step", "steps": 10}}
+#   {"msg_type": "control", "command": "shape", "arrival": {"model": "poisson", "rate": 500}}
+#   {"msg_type": "control", "command": "shape", "size": {"dist": "lognormal", "median": "50MB"}}
+#   {"msg_type": "control", "command": "shape", "factor": 0.5}
+#   {"msg_type": "control", "command": "shape", "state": "run", "substate": "physics"}
+#   {"msg_type": "control", "command": "shape", "reset": true}                   back to the schedule
+#
+# The changes are staged by the thread receiving the message and applied by the simulation itself,
+# at the next STF boundary, so the SimPy environment is neither restarted nor touched from another
+# thread. The shaping lasts until the end of the run.
+
+
+import threading, math
+
+from .arrival   import Arrival
+from .payload   import Payload
+from .pacing    import PacedEnvironment
+
+# ---
+RAMPS   = ('linear', 'step')
+SHAPES  = ('rate', 'ramp', 'arrival', 'size', 'factor', 'state', 'substate', 'reset')
+
+
+###################################################################################
+class Shaper:
+    ''' The live shaping of the load of a run. The rate (and its ramps) scales the intervals drawn
+        from the arrival model of each stream, keeping the shape of the distribution: an interval x
+        drawn from a model with the mean m becomes x/(rate*m). The arrival and size models replace
+        those of the schedule and of the streams, and the forced state those of the schedule.
+        As with the models of the streams, each stream gets its own copy of the arrival model,
+        so that e.g. the phase of the bursts stays independent between streams.
+
+        The STF generators check "changed" at each STF: apply() then takes in the staged changes,
+        and bumps the version, on which the generators redraw their batches of intervals and sizes.
+    '''
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.staged     = {}
+        self.changed    = False     # there are staged changes, checked by the STF generators
+        self.version    = 0         # bumped by each change of the models or the state
+        self.reset()
+
+    # ---
+    def reset(self):
+        ''' Back to the schedule, the staged changes dropped too, at the start of a run '''
+        with self.lock:
+            self.staged, self.changed = {}, False
+        self.clear()
+
+    # ---
+    def clear(self):
+        ''' Back to the schedule, keeping the changes staged since '''
+        self.rate       = None      # the STF rate per stream, Hz, or None to keep that of the arrival model
+        self.ramp       = None      # the ramp of the rate in progress: (start, from, to, over, kind, steps)
+        self.arrival    = None      # the arrival model (a dictionary) replacing those of the schedule, or None
+        self.arrivals   = {}        # its copies (Arrival), by stream, see arrival_model()
+        self.size       = None      # the size model (a dictionary) replacing those of the schedule, or None
+        self.forced     = None      # the forced (state, substate), or None to follow the schedule
+        self.active     = False     # True if the intervals are scaled, i.e. there is a rate or a ramp
+        self.version   += 1
+
+    # ---
+    def stage(self, changes, schedule=None):
+        '''
+        Validate the changes (a dictionary with the keys in SHAPES) and stage them,
+        to be applied at the next STF boundary. Raises ValueError if they are invalid.
+        A forced state and substate must be among those of the schedule, if given: e.g. the
+        recorder of the trace of the run only knows those.
+        '''
+        unknown = set(changes) - set(SHAPES)
+        if unknown: raise ValueError(f'''Unknown shaping parameters {sorted(unknown)}, expected some of {SHAPES}''')
+        if changes.get('rate') is not None and float(changes['rate']) <= 0.0:
+            raise ValueError('The rate must be positive')
+        if changes.get('factor') is not None and float(changes['factor']) <= 0.0:
+            raise ValueError('The time factor must be positive')
+        if changes.get('arrival'): Arrival(changes['arrival'])
+        if changes.get('size'):    Payload(fill='zero', chunk=1).check(changes['size']) # no template buffer needed to validate
+        if changes.get('ramp'):
+            ramp = changes['ramp']
+            if float(ramp['to']) <= 0.0 or float(ramp.get('over', 0.0)) < 0.0:
+                raise ValueError('The ramp needs a positive target rate ("to") and a non-negative duration ("over")')
+            if ramp.get('kind', 'linear') not in RAMPS:
+                raise ValueError(f'''Unknown kind of the ramp {ramp.get('kind')}, must be one of {RAMPS}''')
+            if int(ramp.get('steps', 10)) < 1:
+                raise ValueError('The step ramp needs at least one step')
+        if schedule is not None:
+            for key, known in (('state', schedule.states), ('substate', schedule.substates)):
+                if changes.get(key) is not None and changes[key] not in known:
+                    raise ValueError(f'''Unknown {key} {changes[key]}, must be one of those of the schedule: {sorted(set(known))}''')
+
+        with self.lock:
+            if changes.get('reset'): self.staged = {}
+            self.staged.update(changes)
+            self.changed = True
+
+    # ---
+    def apply(self, daq):
+        '''
+        Apply the staged changes to the DAQ, in the simulation (at an STF boundary).
+        '''
+        with self.lock:
+            changes, self.staged, self.changed = self.staged, {}, False
+        now = daq.env.now
+
+        if changes.pop('reset', False):
+            self.clear() # not reset(): the changes staged meanwhile by another thread stay staged
+            daq.state, daq.substate = daq.schedule.states[daq.index], daq.schedule.substates[daq.index]
+            if isinstance(daq.env, PacedEnvironment): daq.env.rescale(daq.factor)
+
+        if 'rate' in changes:
+            self.rate, self.ramp = (float(changes['rate']) if changes['rate'] is not None else None), None
+
+        if changes.get('ramp'):
+            ramp        = changes['ramp']
+            self.ramp   = (now, self.rate, float(ramp['to']), float(ramp.get('over', 0.0)), ramp.get('kind', 'linear'), int(ramp.get('steps', 10)))
+
+        if 'arrival' in changes:
+            self.arrival    = dict(changes['arrival']) if changes['arrival'] else None
+            self.arrivals   = {}
+
+        if 'size' in changes:
+            self.size = changes['size'] or None
+            if self.size and daq.payload is None: daq.payload = Payload() # sizes imply binary payloads, as in the schedule
+
+        if changes.get('factor') and isinstance(daq.env, PacedEnvironment): # no pacing in the virtual time mode
+            daq.env.rescale(float(changes['factor']))
+
+        if 'state' in changes or 'substate' in changes:
+            if changes.get('state') is None and 'state' in changes:
+                self.forced = None # back to the schedule
+                daq.state, daq.substate = daq.schedule.states[daq.index], daq.schedule.substates[daq.index]
+            else:
+                self.forced = (changes.get('state', daq.state), changes.get('substate', daq.substate))
+                daq.state, daq.substate = self.forced
+
+        self.active     = self.rate is not None or self.ramp is not None
+        self.version   += 1
+        daq.metrics.inc('reshaped')
+        if daq.verbose: print(f'''*** Load shaping at {now:.3f}s: {self.profile()} ***''')
+
+    # ---
+    def arrival_model(self, stream):
+        ''' The arrival model (an Arrival) replacing that of the stream, or None '''
+        if self.arrival is None: return None
+        arrival = self.arrivals.get(stream)
+        if arrival is None: arrival = self.arrivals[stream] = Arrival(self.arrival)
+        return arrival
+
+    # ---
+    def interval(self, x, mean, now):
+        '''
+        Scale the interval x drawn from an arrival model with the given mean to the current rate.
+        '''
+        if self.ramp is None: return x/(self.rate*mean)
+
+        start, r0, r1, over, kind, steps = self.ramp
+        f = min(1.0, (now - start)/over) if over > 0.0 else 1.0
+        if kind == 'step': f = math.floor(f*steps)/steps
+        if r0 is None: r0 = 1.0/mean # from the rate of the arrival model of the stream
+        if f >= 1.0: self.rate, self.ramp = r1, None # the ramp is done, the rate stays at the target
+        return x/((r0 + (r1 - r0)*f)*mean)
+
+    # ---
+    def profile(self):
+        ''' The current shaping, for the replies to the control messages '''
+        profile = {}
+        if self.rate is not None:       profile['rate']     = self.rate
+        if self.ramp is not None:       profile['ramp']     = dict(zip(('start', 'from', 'to', 'over', 'kind', 'steps'), self.ramp))
+        if self.arrival is not None:    profile['arrival']  = self.arrival
+        if self.size is not None:       profile['size']     = self.size
+        if self.forced is not None:     profile['state'], profile['substate'] = self.forced
+        return profile
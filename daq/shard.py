@@ -0,0 +1,205 @@
+#
+# daq/shard.py
+#
+# Sharded generation: the STFs of one run are produced by a pool of worker processes, each
+# running its own DAQ simulation (SimPy environment, STF generators, writers) and writing to
+# its own destination, so that the throughput scales with the number of cores and disks.
+# The coordinator owns the run: it gets the run number, sends the run messages, and forwards
+# the STF notifications of all the workers to MQ under the same run_id and dataset.
+
+
+import multiprocessing, threading, queue, time
+
+from .daq import DAQ
+
+
+###################################################################################
+class ShardWorker(DAQ):
+    ''' The DAQ running in a worker process of the sharded mode. It does not talk to MQ or
+        to the run monitor: the run number and the time origin come from the coordinator,
+        and the STF metadata is sent back to the coordinator in batches via the outbox queue.
+    '''
+    def __init__(self, outbox, shard, run_id, t0, multistream, batch=1, announce_folder=False, **kwargs):
+        self.outbox         = outbox
+        self.shard          = shard
+        self.shard_run_id   = run_id
+        self.shard_t0       = t0
+        self.batch          = batch             # the number of STFs per message to the coordinator
+        self.announce_folder= announce_folder   # if True, the folder goes into the metadata
+        self.pending        = []
+        self.pending_lock   = threading.Lock()  # the STFs may be sent from the writer threads
+
+        super().__init__(test=True, **kwargs)
+        self.multistream    = multistream       # as in the coordinator, which sees all the streams
+
+    # ---
+    def init_mq(self):
+        self.sender = None # the coordinator does the messaging
+
+    # ---
+    def get_run_number(self):
+        return self.shard_run_id
+
+    # ---
+    def start_run(self):
+        super().start_run()
+        self.t0             = self.shard_t0     # the same time origin in all the shards
+        self.run_start_ts   = self.t0.strftime("%Y%m%d%H%M%S")
+
+    # ---
+    def container_prefix(self):
+        return f'''{super().container_prefix()}.s{self.shard:03d}''' # the shards may share a destination
+
+    # ---
+    def profile_tag(self):
+        return f'''{super().profile_tag()}.s{self.shard:03d}''' # each shard profiles its own part of the run
+
+    # ---
+    def send_stf(self, md):
+        if self.announce_folder: md['folder'] = self.folder
+        with self.pending_lock:
+            self.pending.append(md)
+            if len(self.pending) < self.batch: return
+            items, self.pending = self.pending, []
+        self.outbox.put(('stf', self.shard, items))
+
+    # ---
+    def end_run(self):
+        super().end_run()
+        with self.pending_lock:
+            items, self.pending = self.pending, []
+        if items: self.outbox.put(('stf', self.shard, items))
+
+        stats = {'Nstf': self.Nstf, 'streams': {s.id: s.Nstf for s in self.streams},
+                 'bytes_written': self.bytes_written, 'checksum_time': self.checksum_time,
+                 'raw_bytes': self.raw_bytes, 'compress_time': self.compress_time}
+        if self.writer: stats['writer'] = self.writer.stats()
+        if self.destination and not self.pack: stats['storage'] = self.storage.stats()
+        self.outbox.put(('done', self.shard, stats))
+
+
+# ---
+def run_shard(outbox, shard, kwargs):
+    '''
+    The entry point of a worker process.
+    '''
+    try:
+        ShardWorker(outbox, shard, **kwargs).run()
+    except BaseException as e:
+        outbox.put(('error', shard, f'''{type(e).__name__}: {e}'''))
+
+
+###################################################################################
+class ShardedDAQ(DAQ):
+    ''' The coordinator of the sharded mode.
+
+        The work is split between the shards either by streams, if there are at least as many
+        streams as shards, or by the sequence of the STFs: each shard then runs all the streams,
+        taking every n-th sequence number, at 1/n of the rate. Shard k writes to the k-th of
+        the destinations (round robin, if there are fewer destinations than shards).
+        The STF counters of the shards are merged into those of the coordinator.
+    '''
+    def __init__(self, shards=2, destinations=(), **kwargs):
+        if shards < 1:
+            raise ValueError(f'''The number of shards must be positive, got {shards}''')
+
+        self.shards         = shards
+        self.destinations   = [d for d in destinations if d]
+        self.shard_kwargs   = dict(kwargs)
+        self.shard_stats    = {}
+
+        super().__init__(destination=None, **kwargs)
+
+    # ---
+    def setup_env(self):
+        pass # the simulation runs in the shards
+
+    # ---
+    def get_simpy_time(self):
+        return f"{self.until:.1f}s"
+
+    # ---
+    def partition(self):
+        '''
+        The stream definitions for each of the shards.
+        '''
+        streams = [s.spec() for s in self.streams]
+        if len(streams) >= self.shards:
+            return [streams[k::self.shards] for k in range(self.shards)]
+        return [[dict(s, stride=self.shards, offset=k) for s in streams] for k in range(self.shards)]
+
+    # ---
+    def worker_kwargs(self, k, streams):
+        kwargs = {key: value for key, value in self.shard_kwargs.items() if key not in ('test', 'async_mq', 'mq_depth', 'sender', 'metrics_file')}
+        seed   = kwargs.get('seed')
+        kwargs.update({
+            'run_id':           self.run_id,
+            't0':               self.t0,
+            'multistream':      self.multistream,
+            'batch':            1 if self.realtime else 256,
+            'announce_folder':  len(self.destinations) > 1,
+            'destination':      self.destinations[k % len(self.destinations)] if self.destinations else None,
+            'until':            self.until,
+            'schedule_f':       self.schedule_f,    # these three may change between the runs of a campaign
+            'low':              self.low,
+            'high':             self.high,
+            'streams':          streams,
+            'seed':             None if seed is None else [seed, k],
+        })
+        return kwargs
+
+    # ---
+    def run(self):
+        t = time.perf_counter()
+        self.start_run()
+        self.startup_time = time.perf_counter() - t
+
+        ctx     = multiprocessing.get_context('spawn') # no forking of the threads of this process
+        outbox  = ctx.Queue()
+        procs   = [ctx.Process(target=run_shard, args=(outbox, k, self.worker_kwargs(k, streams)), name=f'daq-shard-{k}')
+                   for k, streams in enumerate(self.partition())]
+        counts  = [0]*self.shards
+        done    = set()
+
+        for p in procs: p.start()
+        if self.verbose: print(f'''*** Started {self.shards} shards for run {self.run_id} ***''')
+
+        try:
+            while len(done) < self.shards:
+                try:
+                    kind, shard, items = outbox.get(timeout=1.0)
+                except queue.Empty:
+                    for k, p in enumerate(procs): # a shard which died without reporting
+                        if k not in done and p.exitcode not in (None, 0):
+                            print(f'''*** Shard {k} exited with code {p.exitcode} ***''')
+                            done.add(k)
+                    continue
+
+                if kind == 'stf':
+                    for md in items: self.send_stf(md)
+                    counts[shard]   += len(items)
+                    self.Nstf       += len(items)
+                elif kind == 'done':
+                    self.shard_stats[shard] = items
+                    done.add(shard)
+                else:
+                    print(f'''*** Shard {shard} failed: {items} ***''')
+                    done.add(shard)
+        except KeyboardInterrupt:
+            print("\nSimulation interrupted by user")
+            for p in procs: p.terminate()
+
+        for p in procs: p.join()
+
+        # Merge the per-stream counters of the shards
+        for stats in self.shard_stats.values():
+            for stream in self.streams: stream.Nstf += stats['streams'].get(stream.id, 0)
+            self.bytes_written += stats['bytes_written']
+            self.checksum_time += stats['checksum_time']
+            self.raw_bytes     += stats['raw_bytes']
+            self.compress_time += stats['compress_time']
+
+        if self.verbose:
+            for k in range(self.shards): print(f'''*** Shard {k}: {counts[k]} STFs, {self.shard_stats.get(k)} ***''')
+
+        self.end_run()
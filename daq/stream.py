@@ -0,0 +1,99 @@
+#
+# daq/stream.py
+#
+# Readout streams of the DAQ. A run may have several streams producing STFs concurrently,
+# each with its own sequence counter and, optionally, its own arrival and size profile.
+
+
+import yaml
+
+from .arrival import Arrival
+
+
+###################################################################################
+class Stream:
+    ''' A readout stream, producing its own sequence of STFs.
+
+        If the stream defines an arrival model or a size model (same dictionaries as in
+        the schedule entries), it applies in all states of the DAQ. Otherwise the stream
+        follows the models of the schedule segments, and the low/high limits by default.
+        Each stream keeps its own copies of the arrival models, so that e.g. the phase
+        of the bursts is independent between streams.
+
+        A stream may also be split between several processes (see shard.py): each of them
+        then takes every "stride"-th sequence number starting from "offset", and stretches
+        the intervals between its STFs by the stride, so that the aggregate rate is preserved.
+    '''
+    def __init__(self, id=0, arrival=None, size=None, stride=1, offset=0):
+        self.id         = int(id)
+        self.arrival    = arrival   # the arrival model of the stream (a dictionary), or None
+        self.size       = size      # the size model of the stream (a dictionary), or None
+        self.stride     = int(stride)
+        self.offset     = int(offset)
+        self.Nstf       = 0         # the sequence counter of the STFs in this stream
+        self.default    = None      # the arrival model used where no other is defined
+        self.arrivals   = {}        # the arrival models of the schedule, by their index in the schedule
+
+    # ---
+    def setup(self, schedule, low, high):
+        '''
+        Build the arrival models for the given (compiled) schedule, and reset the counter.
+        '''
+        self.Nstf = 0
+        if self.arrival is not None:
+            self.default    = Arrival(self.arrival)
+            self.arrivals   = {}
+        else:
+            self.default    = Arrival.uniform(low, high)
+            self.arrivals   = {i: Arrival(schedule.models[i]) for i in set(schedule.arrival.tolist()) if i >= 0}
+
+    # ---
+    def seq(self):
+        ''' The sequence number of the current STF of the stream '''
+        return self.offset + self.Nstf*self.stride
+
+    # ---
+    def spec(self):
+        ''' The definition of the stream as a dictionary, as accepted by make_streams() '''
+        return {'id': self.id, 'arrival': self.arrival, 'size': self.size, 'stride': self.stride, 'offset': self.offset}
+
+    # ---
+    def arrival_model(self, schedule, index):
+        ''' The arrival model (an Arrival) to use in the given segment of the schedule '''
+        return self.arrivals.get(int(schedule.arrival[index]), self.default)
+
+    # ---
+    def size_model(self, schedule, index):
+        ''' The size model (a dictionary) to use in the given segment of the schedule, or None '''
+        return self.size if self.size is not None else schedule.size_model(index)
+
+    # ---
+    def __str__(self):
+        return f'''Stream {self.id}: arrival={self.arrival}, size={self.size}, Nstf={self.Nstf}'''
+
+    # ---
+    def __repr__(self):
+        return self.__str__()
+
+
+# ---
+def make_streams(spec):
+    '''
+    Create the list of streams from a number of identical streams, a list of dictionaries
+    with the "id", "arrival" and "size" (and optionally "stride", "offset") keys, or the name
+    of a YAML file containing such a list. The ids default to the position in the list.
+    '''
+    if spec is None: spec = 1
+    if isinstance(spec, str):
+        if spec.isdigit():
+            spec = int(spec)
+        else:
+            with open(spec, 'r') as f: spec = yaml.safe_load(f)
+    if isinstance(spec, int):
+        if spec < 1: raise ValueError(f'''The number of streams must be positive, got {spec}''')
+        return [Stream(i) for i in range(spec)]
+
+    streams = [Stream(s.get('id', i), s.get('arrival'), s.get('size'), s.get('stride', 1), s.get('offset', 0)) for i, s in enumerate(spec)]
+    if len(set((s.id, s.offset) for s in streams)) != len(streams):
+        raise ValueError('The stream ids must be unique')
+    return streams
@@ -0,0 +1,109 @@
+#
+# daq/trace.py
+#
+# Traces of the STF arrivals: the recorder writes the arrival time, state, size and filename
+# of every STF of a run to a compact binary file, so that exactly the same load can be replayed
+# later (see DAQ.replayer), at the original speed, scaled, or as fast as possible.
+#
+# The file is a short header followed by fixed-size records:
+#   - the magic string, the version and the length of the JSON header (16 bytes)
+#   - the JSON header, padded to a multiple of the record size: the run, the streams, the tables
+#     of the states and substates (the records hold indices into them), and whether there was a payload
+#   - the records, a NumPy structured array (RECORD), read back through a memory map
+
+
+import numpy as np
+import json, struct, os, time
+
+# ---
+MAGIC   = b'DAQTRACE'
+VERSION = 1
+RECORD  = np.dtype([
+    ('t',           '<f8'),     # the simulated time of the STF, seconds from the start of the run
+    ('interval',    '<f8'),     # the interval to the next STF of the stream, seconds
+    ('size',        '<i8'),     # the size of the payload, 0 if the metadata was written instead
+    ('stream',      '<u2'),     # the stream ID
+    ('state',       'u1'),      # index into the table of the states in the header
+    ('substate',    'u1'),      # index into the table of the substates in the header
+    ('seq',         '<u4'),     # the sequence number of the STF in its stream
+    ('filename',    'S32'),     # the original filename
+])
+
+
+###################################################################################
+class TraceRecorder:
+    ''' Writes the records of the STFs to a trace file, buffered in blocks of records '''
+    def __init__(self, filename, states, substates, header=None, block=4096):
+        self.filename   = filename
+        self.states     = {s: i for i, s in enumerate(states)}
+        self.substates  = {s: i for i, s in enumerate(substates)}
+        self.buffer     = np.zeros(block, dtype=RECORD)
+        self.n          = 0         # the number of records in the buffer
+        self.count      = 0         # the number of records written so far
+
+        header = dict(header or {}, states=list(states), substates=list(substates), created=time.time())
+        text   = json.dumps(header).encode()
+        text  += b' '*(-(len(text) + 16) % RECORD.itemsize) # the records are aligned
+        self.f = open(filename, 'wb')
+        self.f.write(MAGIC + struct.pack('<II', VERSION, len(text)) + text)
+
+    # ---
+    def record(self, t, interval, size, stream, state, substate, seq, filename):
+        r = self.buffer[self.n]
+        r['t'], r['interval'], r['size'], r['stream'], r['seq'] = t, interval, size, stream, seq
+        r['state']      = self.states[state]
+        r['substate']   = self.substates[substate]
+        r['filename']   = filename.encode()
+        self.n += 1
+        if self.n == len(self.buffer): self.flush()
+
+    # ---
+    def flush(self):
+        if self.n == 0: return
+        self.f.write(self.buffer[:self.n].tobytes())
+        self.count += self.n
+        self.n      = 0
+
+    # ---
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+###################################################################################
+class Trace:
+    ''' A trace file opened for reading, the records are memory-mapped '''
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f'''{filename} is not an STF trace file''')
+            version, length = struct.unpack('<II', f.read(8))
+            if version != VERSION:
+                raise ValueError(f'''Unsupported version {version} of the trace file {filename}''')
+            self.header = json.loads(f.read(length))
+
+        offset = len(MAGIC) + 8 + length
+        count  = (os.path.getsize(filename) - offset)//RECORD.itemsize
+        if count > 0:
+            self.records = np.memmap(filename, dtype=RECORD, mode='r', offset=offset, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=RECORD)
+
+        self.states     = self.header['states']
+        self.substates  = self.header['substates']
+
+    # ---
+    def duration(self):
+        ''' The simulated time until the last STF of the trace is complete, seconds '''
+        if len(self.records) == 0: return 0.0
+        return float(np.max(self.records['t'] + self.records['interval']))
+
+    # ---
+    def __len__(self):
+        return len(self.records)
+
+    # ---
+    def __str__(self):
+        return f'''Trace {self.filename}: {len(self)} STFs, {self.duration():.1f}s, run {self.header.get('run_id')}'''
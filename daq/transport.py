@@ -0,0 +1,135 @@
+#
+# daq/transport.py
+#
+# Transport backends for the messages of the simulator. All of them have the interface of
+# mq_comms.Sender (connect, disconnect, send), so the DAQ and the Publisher use them as is.
+#
+#   - stomp:                    the ActiveMQ broker, via mq_comms.Sender (the default)
+#   - queue:                    an in-process queue, for consumers running in the same process
+#   - file:PATH                 an append-only JSONL file, one message per line
+#   - socket:HOST:PORT          newline-delimited JSON over TCP, a local stand-in for the broker
+#   - socket:PATH               the same over a Unix domain socket
+#
+# The JSONL records (file and socket) are {"destination": ..., "headers": ..., "body": ...};
+# binary bodies (see encoding.py) are base64-encoded, with "base64": true in the record.
+
+
+import json, base64, queue, socket, threading
+
+# ---
+TRANSPORTS = ('stomp', 'queue', 'file', 'socket')
+
+
+# ---
+def jsonl(destination, body, headers):
+    ''' A message as a line of JSONL '''
+    record = {'destination': destination, 'headers': headers or {}}
+    if isinstance(body, (bytes, bytearray)):
+        record['body'], record['base64'] = base64.b64encode(body).decode(), True
+    else:
+        record['body'] = body
+    return json.dumps(record) + '\n'
+
+
+###################################################################################
+class QueueSender:
+    ''' Puts the messages into an in-process queue (the "queue" attribute), as tuples of
+        (destination, body, headers). If the queue is bounded, send() blocks when it is full.
+    '''
+    def __init__(self, maxsize=0, verbose=False):
+        self.queue      = queue.Queue(maxsize=maxsize)
+        self.verbose    = verbose
+        self.count      = 0
+
+    def connect(self):      pass
+    def disconnect(self):   pass
+
+    def send(self, destination=None, body=None, headers=None):
+        self.queue.put((destination, body, headers))
+        self.count += 1
+
+
+###################################################################################
+class FileSender:
+    ''' Appends the messages to a JSONL file. The file is flushed on disconnect. '''
+    def __init__(self, filename, verbose=False):
+        self.filename   = filename
+        self.verbose    = verbose
+        self.f          = None
+        self.lock       = threading.Lock()
+        self.count      = 0
+
+    def connect(self):
+        if self.f is None: self.f = open(self.filename, 'a')
+
+    def disconnect(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+    def send(self, destination=None, body=None, headers=None):
+        line = jsonl(destination, body, headers)
+        with self.lock:
+            self.f.write(line)
+            self.count += 1
+
+    def flush(self):
+        with self.lock: self.f.flush()
+
+
+###################################################################################
+class SocketSender:
+    ''' Sends the messages as JSONL over a TCP or Unix domain socket, to a local consumer
+        listening on it (e.g. "nc -lk 61613"). connect() (re)opens the connection, so the
+        reconnects of the Publisher work as with the broker.
+    '''
+    def __init__(self, address, verbose=False):
+        self.address    = address
+        self.verbose    = verbose
+        self.sock       = None
+        self.lock       = threading.Lock()
+        self.count      = 0
+
+    def connect(self):
+        self.disconnect()
+        if ':' in self.address:
+            host, port  = self.address.rsplit(':', 1)
+            self.sock   = socket.create_connection((host or 'localhost', int(port)))
+        else:
+            self.sock   = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.address)
+
+    def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+
+    def send(self, destination=None, body=None, headers=None):
+        data = jsonl(destination, body, headers).encode()
+        with self.lock:
+            if self.sock is None: raise ConnectionError(f'''Not connected to {self.address}''')
+            self.sock.sendall(data)
+            self.count += 1
+
+
+# ---
+def make_sender(spec='stomp', verbose=False):
+    '''
+    Create the (not yet connected) sender for a transport specification, see the header of this file.
+    '''
+    kind, _, arg = spec.partition(':')
+    if kind == 'stomp':
+        from mq_comms import Sender # the broker is only needed for this transport
+        return Sender(verbose=verbose)
+    if kind == 'queue':
+        return QueueSender(maxsize=int(arg or 0), verbose=verbose)
+    if kind == 'file':
+        if not arg: raise ValueError('The file transport needs a filename, e.g. file:messages.jsonl')
+        return FileSender(arg, verbose=verbose)
+    if kind == 'socket':
+        if not arg: raise ValueError('The socket transport needs an address, e.g. socket:localhost:61613 or socket:/tmp/daq.sock')
+        return SocketSender(arg, verbose=verbose)
+    raise ValueError(f'''Unknown transport {kind}, must be one of {TRANSPORTS}''')
@@ -0,0 +1,188 @@
+#
+# daq/writer.py
+#
+# Background I/O stage for the STF files. A bounded pool of threads takes the write jobs
+# from the STF generator, so that a slow disk or network mount does not delay the SimPy clock.
+# Writing and checksumming release the GIL for large buffers, so threads are sufficient here.
+
+
+import threading, queue, collections, time
+
+# ---
+POLICIES    = ('block', 'drop', 'spill') # what to do with a new job when the queue is full
+SPILL_RATIO = 16                         # the default capacity of the spill area, in units of the queue depth
+
+
+###################################################################################
+class WriterPool:
+    ''' A bounded pool of writer threads.
+
+        Jobs are handed to the "task" callable (which writes the file and then notifies
+        the downstream agents) in one of the worker threads. When the queue is full,
+        the policy decides what happens to a new job:
+        - block: the submitter waits until there is room in the queue (the simulation clock stalls)
+        - drop:  the job is discarded and counted as dropped
+        - spill: the job is put on an overflow list, which holds up to "spill" jobs
+                 (by default 16 times the depth of the queue); when that is full too, the
+                 submitter waits as with "block"
+
+        The jobs are started in the order they were submitted, with all the policies: once
+        a job has spilled, the new ones go to the overflow list as well until it has drained,
+        and the workers take the jobs from the main queue (which only holds older ones) before
+        the overflow list. With several workers, the jobs started in order may still complete
+        out of order.
+
+        The depth of the queue and the backlog of outstanding jobs can be polled at any time,
+        see the stats() method.
+    '''
+    def __init__(self, task, workers=2, depth=64, policy='block', spill=None, verbose=False):
+        if policy not in POLICIES:
+            raise ValueError(f'''Unknown queue policy {policy}, must be one of {POLICIES}''')
+        if workers < 1:
+            raise ValueError(f'''The writer pool needs at least one worker, got {workers}''')
+        if spill is not None and spill < 1:
+            raise ValueError(f'''The spill area needs room for at least one job, got {spill}''')
+
+        self.task       = task
+        self.policy     = policy
+        self.verbose    = verbose
+        self.queue      = queue.Queue(maxsize=depth)
+        self.overflow   = collections.deque()   # the spill area, used with the "spill" policy
+        self.spill      = spill if spill is not None else SPILL_RATIO*depth
+        self.lock       = threading.Lock()
+        self.room       = threading.Condition(self.lock) # signalled when a job leaves the spill area
+        self.closed     = False
+
+        self.submitted  = 0     # counters, for the stats
+        self.completed  = 0
+        self.dropped    = 0
+        self.spilled    = 0
+        self.failed     = 0
+        self.in_flight  = 0
+        self.max_depth  = 0
+        self.blocked    = 0.0   # the time the submitter spent waiting on a full queue, seconds
+
+        self.threads    = [threading.Thread(target=self.worker, name=f'stf-writer-{i}', daemon=True) for i in range(workers)]
+        for t in self.threads: t.start()
+
+    # ---
+    def submit(self, job):
+        '''
+        Put a job in the queue, subject to the policy. Returns False if the job was dropped.
+        '''
+        if self.closed:
+            raise RuntimeError('The writer pool is closed')
+
+        with self.lock: self.submitted += 1
+
+        if self.policy == 'spill':
+            self.spill_job(job)
+        else:
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                if self.policy == 'drop':
+                    with self.lock: self.dropped += 1
+                    return False
+                t = time.perf_counter()
+                self.queue.put(job)
+                self.blocked += time.perf_counter() - t
+
+        depth = self.depth()
+        if depth > self.max_depth: self.max_depth = depth
+        return True
+
+    # ---
+    def spill_job(self, job):
+        '''
+        Queue a job with the "spill" policy: to the main queue while nothing is spilled,
+        otherwise to the back of the spill area, so that the jobs keep their order.
+        '''
+        with self.lock:
+            if not self.overflow:
+                try:
+                    self.queue.put_nowait(job)
+                    return
+                except queue.Full:
+                    pass
+            if len(self.overflow) >= self.spill:
+                t = time.perf_counter()
+                while len(self.overflow) >= self.spill: self.room.wait()
+                self.blocked += time.perf_counter() - t
+            self.overflow.append(job)
+            self.spilled += 1
+
+    # ---
+    def next_job(self):
+        '''
+        The next job: from the main queue, then from the spill area. While anything is
+        spilled, the main queue only holds jobs submitted before it, so the order is kept.
+        '''
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.overflow:
+                job = self.overflow.popleft()
+                self.room.notify()
+                return job
+        try:
+            return self.queue.get(timeout=0.1)
+        except queue.Empty:
+            return None
+
+    # ---
+    def worker(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                if self.closed and self.queue.empty() and not self.overflow: return
+                continue
+
+            with self.lock: self.in_flight += 1
+            try:
+                self.task(job)
+                ok = True
+            except Exception as e:
+                print(f'''*** Error in the STF writer: {e} ***''')
+                ok = False
+            with self.lock:
+                self.in_flight -= 1
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    # ---
+    def depth(self):
+        ''' The number of jobs waiting in the queue, including the spill area '''
+        return self.queue.qsize() + len(self.overflow)
+
+    # ---
+    def backlog(self):
+        ''' The number of jobs not yet completed: waiting plus being written '''
+        return self.depth() + self.in_flight
+
+    # ---
+    def close(self):
+        '''
+        Stop accepting jobs, wait for the backlog to drain and the workers to exit.
+        '''
+        self.closed = True
+        for t in self.threads: t.join()
+        if self.verbose: print(f'''*** Writer pool closed: {self.stats()} ***''')
+
+    # ---
+    def stats(self):
+        return {
+            'submitted':    self.submitted,
+            'completed':    self.completed,
+            'dropped':      self.dropped,
+            'spilled':      self.spilled,
+            'failed':       self.failed,
+            'depth':        self.depth(),
+            'max_depth':    self.max_depth,
+            'backlog':      self.backlog(),
+            'blocked':      round(self.blocked, 6),
+        }
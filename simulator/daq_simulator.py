@@ -13,19 +13,61 @@ parser.add_argument("-M", "--monitor",  action='store_true',    help="Get run nu
 
 parser.add_argument("-S", "--send",     action='store_true',    help="Send messages to MQ",                     default=False)
 parser.add_argument("-R", "--receive",  action='store_true',    help="Receive messages from MQ",                default=False)
+parser.add_argument("-a", "--async-mq", action='store_true',    help="Send MQ messages from a background thread",default=False)
+parser.add_argument("-g", "--transport", type=str,              help="Transport of the messages: stomp, queue, file:PATH, socket:HOST:PORT or socket:PATH", default='stomp')
+parser.add_argument("-j", "--encoding", type=str,               help="Encoding of the MQ messages",             default='json', choices=['json', 'msgpack', 'binary'])
+parser.add_argument("-m", "--mq-depth", type=int,               help="Depth of the asynchronous MQ queue",      default=1024)
 
 parser.add_argument("-s", "--schedule", type=str,               help='Path to the schedule (YAML)',             default='')
 
 parser.add_argument("-f", "--factor",   type=float,             help='Time factor',                             default=1.0)
 parser.add_argument("-u", "--until",    type=float,             help='The limit, if undefined: end of schedule',default=None) #  required=False, nargs='?')
 parser.add_argument("-c", "--clock",    type=float,             help='Scheduler clock freq(seconds)',           default=1.0)
-
-parser.add_argument("-d", "--dest",     type=str,               help='Path to the destination folder, if empty do not output data',  default='')
+parser.add_argument("-A", "--asap",     action='store_true',    help='Virtual time, run as fast as possible',   default=False)
+
+parser.add_argument("-d", "--dest",     type=str,               help='Path to the destination folder, if empty do not output data; comma-separated list for shards',  default='')
+parser.add_argument("-k", "--shards",   type=int,               help='Number of worker processes generating the run, 0: no sharding', default=0)
+parser.add_argument("-D", "--digests",  type=str,               help='Extra digests of STF files, comma-separated (e.g. crc32,xxh64)', default='')
+parser.add_argument("-P", "--payload",  type=str,               help='Path to the STF payload definition (YAML), if empty write metadata', default='')
+
+parser.add_argument("-b", "--pack",     type=str,               help='Pack the STFs into container files of this size (e.g. 1GB), 0: a file per STF', default='0')
+parser.add_argument("-z", "--compress", type=str,               help='Compress the STF bodies: zlib, zstd or lz4, optionally with the level (e.g. zstd:3)', default='')
+parser.add_argument("-Y", "--layout",   type=str,               help='Layout of the STF files in the run folder: flat, time:SECONDS or hash:N', default='flat')
+parser.add_argument("-I", "--max-files", type=int,              help='Maximum number of STF files per directory, 0: no limit', default=0)
+parser.add_argument("-O", "--durability", type=str,             help='Durability of the STF files: none, every:N, each or rename (default: each with writer threads, else none)', default=None)
+parser.add_argument("-N", "--ring",     type=str,               help='Hand the STFs off in a shared-memory ring buffer at this path (e.g. /dev/shm/daq.ring) instead of files', default='')
+parser.add_argument("-Q", "--ring-size", type=str,              help='Size of the data area of the ring buffer (e.g. 256MB)', default='256MB')
+parser.add_argument("-J", "--ring-slots", type=int,             help='Number of the slots of the ring buffer, the STFs kept track of', default=4096)
+parser.add_argument("-w", "--writers",  type=int,               help='Number of background writer threads, 0: write inline', default=0)
+parser.add_argument("-q", "--queue",    type=int,               help='Depth of the writer queue',               default=64)
+parser.add_argument("-p", "--policy",   type=str,               help='Policy when the writer queue is full',    default='block', choices=['block', 'drop', 'spill'])
 
 parser.add_argument("-L", "--low",      type=float,             help='The "low" time limit on STF production',  default=1.0)
 parser.add_argument("-H", "--high",     type=float,             help='The "high" time limit on STF production', default=2.0)
+parser.add_argument("-n", "--streams",  type=str,               help='Number of readout streams, or a YAML file defining them', default='1')
+parser.add_argument("-x", "--metrics",  type=str,               help='Export the metrics to this file (.prom: Prometheus textfile, else JSON)', default='')
+parser.add_argument("-i", "--metrics-interval", type=float,     help='Seconds between the exports of the metrics', default=10.0)
+parser.add_argument("-C", "--catchup",  type=str,               help='Catch-up policy when the real-time pacing falls behind', default='burst', choices=['burst', 'skip', 'stretch'])
+parser.add_argument("-T", "--tolerance", type=float,            help='Lag (s) beyond which the catch-up policy applies',       default=0.01)
+parser.add_argument("-E", "--resolution", type=float,           help='STFs due within this time (s) are produced in one wakeup', default=1e-4)
+parser.add_argument("-o", "--record",   type=str,               help='Record the STF arrivals of the run to this trace file, with the run number added in the campaign and daemon modes', default='')
+parser.add_argument("-y", "--replay",   type=str,               help='Replay the STF arrivals from this trace file',           default='')
+parser.add_argument("-X", "--speed",    type=float,             help='Speed-up of the simulation, the time factor is divided by it', default=1.0)
+parser.add_argument("-B", "--heartbeat", type=float,            help='Seconds between the heartbeats to the monitor during the run', default=30.0)
+parser.add_argument("-K", "--campaign", type=str,               help='Run the campaign of runs defined in this file (YAML)',   default='')
+parser.add_argument("-l", "--lease",    type=int,               help='Number of run numbers to lease ahead in a campaign',    default=8)
+parser.add_argument("-Z", "--daemon",   type=str,               help='Daemon mode, runs on control messages from: stomp, socket:HOST:PORT or socket:PATH', default='')
+parser.add_argument("-G", "--backpressure", type=int,          help='Pause the STF generation when the consumers lag by this many STFs, 0: open loop', default=0)
+parser.add_argument("-U", "--resume",   type=int,               help='Resume when the lag is down to this many STFs, by default half of the above', default=None)
+parser.add_argument("-W", "--bp-mode",  type=str,               help='Backpressure mode: pause, or throttle (slow down from the resume threshold on)', default='pause', choices=['pause', 'throttle'])
+parser.add_argument("-F", "--feedback", type=str,               help='Source of the feedback of the consumers: stomp, socket:HOST:PORT or socket:PATH', default='stomp')
+parser.add_argument("-V", "--profile",  type=str,               help='Profile the hot path of the runs: cprofile, sample, memory, comma-separated, or all', default='')
+parser.add_argument("--profile-dir",    type=str,               help='Folder of the profiling artifacts of the runs', default='.')
+parser.add_argument("--profile-interval", type=float,           help='Seconds between the samples of the sampling profiler', default=0.005)
+parser.add_argument("-r", "--seed",     type=int,               help='Seed of the random generators',           default=None)
 
 args        = parser.parse_args()
+if args.speed <= 0.0: parser.error(f'''the speed must be positive, got {args.speed}''')
 verbose     = args.verbose
 tst         = args.tst
 envtest     = args.envtest
@@ -33,18 +75,48 @@ monitor     = args.monitor
 
 send        = args.send
 receive     = args.receive
+async_mq    = args.async_mq
+mq_depth    = args.mq_depth
+encoding    = args.encoding
+transport   = args.transport
+heartbeat   = args.heartbeat
+campaign    = args.campaign
+lease       = args.lease
+daemon      = args.daemon
+backpressure= args.backpressure
+feedback    = args.feedback
 
 if verbose: print(f'''*** Verbose: {verbose}, Test: {tst}, Send: {send}, Monitor: {monitor} ***''')
 
 schedule    = args.schedule
 dest        = args.dest
-
-factor      = args.factor
+payload     = args.payload
+shards      = args.shards
+digests     = [d for d in args.digests.split(',') if d]
+pack        = args.pack
+compress    = args.compress
+ring        = args.ring
+
+writers     = args.writers
+queue_depth = args.queue
+policy      = args.policy
+
+factor      = args.factor/args.speed
 until       = args.until
 clock       = args.clock
+asap        = args.asap
 
 low         = args.low
 high        = args.high
+seed        = args.seed
+streams     = args.streams
+metrics     = args.metrics
+metrics_interval = args.metrics_interval
+catchup     = args.catchup
+tolerance   = args.tolerance
+resolution  = args.resolution
+record      = args.record
+replay      = args.replay
 
 # ---
 
@@ -91,12 +163,14 @@ if verbose:
         print(f'''*** No output destination is set, will not write data ***''')
     else:  
         print(f'''*** Output destination is set to: {dest} ***''')
+    if payload!='': print(f'''*** STF payload definition file path: {payload} ***''')
 
     print(f'''*** Simulation time factor: {factor} ***''')
+    if asap: print(f'''*** Virtual time mode: the simulation will run as fast as possible ***''')
 
 # ---
 try:
-    from daq import *
+    from daq import DAQ, ShardedDAQ, Payload, Campaign, Controller, Listener, parse_size # not *, which would bring in the submodules, e.g. "schedule"
     if verbose:
         print(f'''*** Imported the daq package from PYTHONPATH ***''')
 except:
@@ -111,17 +185,116 @@ if envtest:
     exit(0) 
 
 # ---
-daq = DAQ(schedule_f    = schedule,
-          destination   = dest,
-          until         = until,
-          clock         = clock,
-          factor        = factor,
-          low           = low,
-          high          = high,
-          verbose       = verbose,
-          test          = tst)
-
-daq.run()
+stf_payload = None
+if payload!='':
+    try:
+        stf_payload = Payload.from_yaml(payload)
+        if verbose: print(f'''*** {stf_payload} ***''')
+    except Exception as e:
+        print(f'''*** Failed to read the payload definition {payload}: {e}, exiting...***''')
+        exit(-1)
+
+options = dict(schedule_f    = schedule,
+               until         = until,
+               clock         = clock,
+               factor        = factor,
+               low           = low,
+               high          = high,
+               verbose       = verbose,
+               test          = tst,
+               realtime      = not asap,
+               payload       = stf_payload,
+               digests       = digests,
+               writers       = writers,
+               queue_depth   = queue_depth,
+               queue_policy  = policy,
+               async_mq      = async_mq,
+               mq_depth      = mq_depth,
+               seed          = seed,
+               streams       = streams,
+               metrics_file  = metrics or None,
+               metrics_interval = metrics_interval,
+               catchup       = catchup,
+               tolerance     = tolerance,
+               resolution    = resolution,
+               record        = record or None,
+               replay        = replay or None,
+               pack          = parse_size(pack),
+               compress      = compress or None,
+               encoding      = encoding,
+               transport     = transport,
+               heartbeat     = heartbeat,
+               backpressure  = backpressure,
+               resume        = args.resume,
+               bp_mode       = args.bp_mode,
+               layout        = args.layout,
+               max_files     = args.max_files,
+               durability    = args.durability,
+               ring          = ring or None,
+               ring_size     = parse_size(args.ring_size),
+               ring_slots    = args.ring_slots,
+               profile       = args.profile or None,
+               profile_dir   = args.profile_dir,
+               profile_interval = args.profile_interval)
+
+if daemon and (shards > 0 or campaign):
+    print('*** The daemon mode can not be combined with the sharded or the campaign mode, exiting...***')
+    exit(-1)
+
+if ring and (dest or parse_size(pack) > 0 or shards > 0):
+    print('*** The ring buffer replaces the output files, it can not be combined with a destination, packing or sharding, exiting...***')
+    exit(-1)
+
+if shards > 0:
+    if record or replay:
+        print('*** Recording and replaying of traces are not supported in the sharded mode, exiting...***')
+        exit(-1)
+    if backpressure:
+        print('*** The backpressure is not supported in the sharded mode, exiting...***')
+        exit(-1)
+    if verbose: print(f'''*** Sharded mode: {shards} worker processes, destinations {dest} ***''')
+    daq = ShardedDAQ(shards=shards, destinations=dest.split(','), **options)
+else:
+    daq = DAQ(destination=dest, **options)
+
+listener = None
+if backpressure and feedback != daemon: # in the daemon mode, the feedback may come along with the control messages
+    try:
+        listener = Listener(daq, feedback, verbose=verbose)
+        listener.open()
+    except Exception as e:
+        print(f'''*** Failed to listen to the feedback of the consumers from {feedback}: {e}, exiting...***''')
+        exit(-1)
+    if verbose: print(f'''*** Backpressure: listening to the feedback of the consumers from {feedback} ***''')
+
+try:
+    if daemon:
+        try:
+            controller = Controller(daq, daemon, block=lease, verbose=verbose)
+            controller.open()
+        except Exception as e:
+            print(f'''*** Failed to set up the daemon mode: {e}, exiting...***''')
+            exit(-1)
+        controller.serve()
+        print(f'''*** The daemon has exited: {controller.stats()} ***''')
+    elif campaign:
+        try:
+            runs = Campaign.from_yaml(daq, campaign, block=lease, verbose=verbose)
+        except Exception as e:
+            print(f'''*** Failed to read the campaign {campaign}: {e}, exiting...***''')
+            exit(-1)
+        try:
+            runs.run()
+        except Exception as e:
+            print(f'''*** The campaign failed: {e}, exiting...***''')
+            exit(-1)
+        print(f'''*** Campaign completed: {runs.stats()} ***''')
+    else:
+        daq.run()
+finally:
+    daq.close() # the ring buffer, if any
+
+if listener: listener.close()
 
 if verbose:
     print(f'''*** Completed at {daq.get_simpy_time()}. Number of STFs generated: {daq.Nstf} ***''')
@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+'''
+A local stand-in for a downstream consumer agent, to test the backpressure of the DAQ simulator
+without the broker. It takes the messages of the socket transport of the simulator, "processes"
+the STFs at a limited rate, and acknowledges them to the feedback socket of the simulator, so
+the simulator holds back when the consumer falls behind.
+
+Example:
+./consumer_stub.py -l localhost:61613 -a /tmp/daq-feedback.sock -r 200
+../simulator/daq_simulator.py -g socket:localhost:61613 -G 500 -F socket:/tmp/daq-feedback.sock ...
+'''
+
+import argparse, json, queue, socket, socketserver, threading, time
+
+# ---
+class State:
+    stfs    = queue.Queue()     # the STF messages to process
+    run_id  = None
+
+
+###################################################################################
+class Handler(socketserver.StreamRequestHandler):
+    ''' Reads the JSONL messages of the socket transport of the simulator '''
+    def handle(self):
+        for line in self.rfile:
+            record = json.loads(line)
+            if record.get('base64'): continue # only the JSON encoding is understood here
+            msg = json.loads(record['body'])
+            if msg.get('msg_type') == 'stf_gen':
+                State.stfs.put(msg)
+            else:
+                print(f'''*** {msg.get('msg_type')}: run {msg.get('run_id')} ***''')
+
+
+# ---
+def connect(address):
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        return socket.create_connection((host or 'localhost', int(port)))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+# ---
+def consume(ack, rate, every, name):
+    ''' Process the STFs at the given rate, acknowledging the count every so many STFs '''
+    sock, count = None, 0
+    while True:
+        msg = State.stfs.get()
+        if msg['run_id'] != State.run_id: State.run_id, count = msg['run_id'], 0
+        if rate > 0: time.sleep(1.0/rate)
+        count += 1
+        if count % every: continue
+        try:
+            if sock is None: sock = connect(ack)
+            sock.sendall((json.dumps({'msg_type': 'stf_ack', 'agent': name, 'run_id': State.run_id, 'count': count}) + '\n').encode())
+        except OSError as e:
+            print(f'''*** Failed to acknowledge to {ack}: {e} ***''')
+            sock = None
+        if count % (every*100) == 0: print(f'''*** Run {State.run_id}: {count} STFs processed, {State.stfs.qsize()} queued ***''')
+
+
+###################### Main code
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l", "--listen",   type=str,   help='Address to take the messages on (HOST:PORT)',     default='localhost:61613')
+    parser.add_argument("-a", "--ack",      type=str,   help='Feedback address of the simulator (HOST:PORT or PATH)', default='/tmp/daq-feedback.sock')
+    parser.add_argument("-r", "--rate",     type=float, help='STFs processed per second, 0: no limit',          default=100.0)
+    parser.add_argument("-e", "--every",    type=int,   help='Acknowledge every so many STFs',                  default=10)
+    parser.add_argument("-n", "--name",     type=str,   help='Name of the consumer',                            default='consumer-stub')
+
+    args = parser.parse_args()
+    host, port = args.listen.rsplit(':', 1)
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer((host, int(port)), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=consume, args=(args.ack, args.rate, args.every, args.name), daemon=True).start()
+
+    print(f'''*** Consumer stub listening on {args.listen}, {args.rate} STFs/s, acknowledging to {args.ack} ***''')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
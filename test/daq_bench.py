@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+'''
+Offline throughput benchmark of the STF generator pipeline.
+
+The DAQ is driven in the test mode and in virtual time, with an in-memory fake sender
+instead of the MQ, writing to a temporary destination. For each combination of the STF
+size and rate in the matrix the benchmark reports the STFs/s and MB/s achieved, the cost
+of the checksums and of the publishing of each message, and separately the overhead of
+the scheduler. The results are written to a JSON file so that releases can be compared.
+
+Example:
+./daq_bench.py -z 0,64KB,1MB,16MB -r 100,1000,10000 -n 2000 -o bench.json
+'''
+
+import os, sys, argparse, json, time, tempfile, shutil, platform, subprocess
+from   pathlib import Path
+
+top_directory = Path(__file__).resolve().parent.parent
+if str(top_directory) not in sys.path: sys.path.append(str(top_directory))
+
+from daq import DAQ, Payload, parse_size
+
+# ---
+SCHEDULE = '''
+- state:    run
+  substate: physics
+  span:     0,1,0,0,0
+  arrival:  {{model: fixed, rate: {rate}}}
+'''
+
+###################################################################################
+class FakeSender:
+    ''' An in-memory stand-in for mq_comms.Sender, which only counts the messages '''
+    def __init__(self):
+        self.count  = 0
+        self.bytes  = 0
+
+    def connect(self):      pass
+    def disconnect(self):   pass
+
+    def send(self, destination=None, body=None, headers=None):
+        self.count += 1
+        self.bytes += len(body)
+
+
+###################################################################################
+class BenchDAQ(DAQ):
+    ''' The DAQ with the time spent on notifying each STF (encoding and sending) measured '''
+    def __init__(self, **kwargs):
+        self.publish_time   = 0.0
+        self.published      = 0
+        super().__init__(**kwargs)
+
+    def send_stf(self, md):
+        t = time.perf_counter()
+        super().send_stf(md)
+        self.publish_time   += time.perf_counter() - t
+        self.published      += 1
+
+
+# ---
+def run_case(schedule_f, size, rate, count, writers, folder):
+    ''' Run one point of the matrix, returns a dictionary of the results '''
+    sender  = FakeSender()
+    payload = Payload(size={'dist': 'fixed', 'size': size}) if size > 0 else None
+    daq     = BenchDAQ(schedule_f=schedule_f, destination=folder, until=count/rate, realtime=False,
+                       test=True, payload=payload, writers=writers, sender=sender, seed=1)
+
+    t = time.perf_counter()
+    daq.run()
+    elapsed = time.perf_counter() - t
+
+    return {
+        'size':             size,
+        'rate':             rate,
+        'writers':          writers,
+        'stfs':             daq.Nstf,
+        'elapsed':          round(elapsed, 6),
+        'stf_per_s':        round(daq.Nstf/elapsed, 3),
+        'mb_per_s':         round(daq.bytes_written/elapsed/1e6, 3),
+        'bytes_written':    daq.bytes_written,
+        'checksum_us':      round(1e6*daq.checksum_time/max(daq.Nstf, 1), 3),
+        'checksum_mb_per_s':round(daq.bytes_written/daq.checksum_time/1e6, 3) if daq.checksum_time > 0 else None,
+        'publish_us':       round(1e6*daq.publish_time/max(daq.published, 1), 3),
+        'messages':         sender.count,
+        'message_bytes':    sender.bytes,
+    }
+
+# ---
+def schedule_overhead(schedule_f):
+    ''' The cost of walking the schedule alone, without any STFs '''
+    import simpy
+    daq     = DAQ(schedule_f=schedule_f, realtime=False, test=True, sender=FakeSender())
+    daq.env = simpy.Environment()
+    daq.env.process(daq.sched())
+
+    t = time.perf_counter()
+    daq.env.run(until=daq.until)
+    elapsed = time.perf_counter() - t
+
+    return {
+        'schedule':         os.path.basename(schedule_f),
+        'transitions':      len(daq.schedule) - 1,
+        'simulated':        daq.until,
+        'elapsed':          round(elapsed, 6),
+        'transition_us':    round(1e6*elapsed/max(len(daq.schedule) - 1, 1), 3),
+    }
+
+# ---
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=top_directory, capture_output=True, text=True).stdout.strip()
+    except Exception:
+        return ''
+
+###################### Main code
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-z", "--sizes",    type=str,   help='STF sizes, comma-separated, 0: metadata only',   default='0,64KB,1MB,16MB')
+    parser.add_argument("-r", "--rates",    type=str,   help='STF rates (Hz), comma-separated',                default='100,1000,10000')
+    parser.add_argument("-n", "--count",    type=int,   help='Number of STFs per point of the matrix',         default=2000)
+    parser.add_argument("-w", "--writers",  type=int,   help='Number of background writer threads',            default=0)
+    parser.add_argument("-d", "--dest",     type=str,   help='Folder for the temporary output',                default=None)
+    parser.add_argument("-s", "--schedule", type=str,   help='Schedule for the scheduler overhead test',       default=str(top_directory/'config'/'schedule-week.yml'))
+    parser.add_argument("-o", "--output",   type=str,   help='Output file (JSON)',                             default='daq_bench.json')
+
+    args    = parser.parse_args()
+    sizes   = [parse_size(s) for s in args.sizes.split(',')]
+    rates   = [float(r) for r in args.rates.split(',')]
+    tmp     = tempfile.mkdtemp(prefix='daq_bench_', dir=args.dest)
+
+    results = []
+    try:
+        for rate in rates:
+            schedule_f = os.path.join(tmp, f'''schedule-{rate:g}.yml''')
+            with open(schedule_f, 'w') as f: f.write(SCHEDULE.format(rate=rate))
+
+            for size in sizes:
+                folder = os.path.join(tmp, 'out')
+                r = run_case(schedule_f, size, rate, args.count, args.writers, folder)
+                shutil.rmtree(folder, ignore_errors=True)
+                results.append(r)
+                print(f'''size={size:>10} rate={rate:>8g}: {r['stf_per_s']:>10.1f} STF/s {r['mb_per_s']:>9.1f} MB/s checksum {r['checksum_us']:>9.1f} us/STF publish {r['publish_us']:>7.1f} us/msg''')
+
+        sched = schedule_overhead(args.schedule)
+        print(f'''schedule {sched['schedule']}: {sched['transitions']} transitions, {sched['transition_us']:.1f} us/transition''')
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        'timestamp':    time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'commit':       git_commit(),
+        'python':       platform.python_version(),
+        'host':         platform.node(),
+        'count':        args.count,
+        'results':      results,
+        'schedule':     sched,
+    }
+    with open(args.output, 'w') as f: json.dump(report, f, indent=2)
+    print(f'''*** Results written to {args.output} ***''')
@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+'''
+A local stand-in for the run monitor (swf-monitor), to test the monitor client of the DAQ
+simulator without the real service. It hands out run numbers, accepts the heartbeats (and
+prints their stats), and can be made slow or unreliable to check that the simulation is not
+held up by the monitor.
+
+Example:
+./monitor_stub.py -p 8002 -d 2.0 -f 0.2
+SWF_MONITOR_URL=http://localhost:8002 ../simulator/daq_simulator.py -B 5 ...
+'''
+
+import argparse, json, random, time, threading
+from   http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# ---
+class State:
+    run_number  = 0
+    heartbeats  = 0
+    lock        = threading.Lock()
+
+###################################################################################
+class Handler(BaseHTTPRequestHandler):
+    ''' Answers the POST requests of the DAQ simulator '''
+    delay   = 0.0
+    failure = 0.0
+
+    def reply(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length  = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'null')
+        if self.delay > 0: time.sleep(self.delay)
+        if random.random() < self.failure:
+            return self.reply(503, {'error': 'injected failure'})
+
+        with State.lock:
+            if self.path.rstrip('/').endswith('next-run-number'):
+                State.run_number += 1
+                print(f'''*** Run number {State.run_number} ***''')
+                return self.reply(200, {'run_number': State.run_number})
+            if self.path.rstrip('/').endswith('heartbeat'):
+                State.heartbeats += 1
+                print(f'''*** Heartbeat {State.heartbeats} from {payload.get('instance_name')}: {payload.get('status')} {payload.get('stats')} ***''')
+                return self.reply(200, {'status': 'OK'})
+
+        print(f'''*** {self.path}: {payload} ***''')
+        return self.reply(200, {'status': 'OK'})
+
+    def log_message(self, format, *args):
+        pass # the requests are printed above
+
+
+###################### Main code
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port",     type=int,   help='Port to listen on',                       default=8002)
+    parser.add_argument("-d", "--delay",    type=float, help='Delay of each response (s)',              default=0.0)
+    parser.add_argument("-f", "--failure",  type=float, help='Fraction of the requests failing (503)',   default=0.0)
+    parser.add_argument("-r", "--run",      type=int,   help='The last run number handed out',          default=0)
+
+    args = parser.parse_args()
+    Handler.delay, Handler.failure, State.run_number = args.delay, args.failure, args.run
+
+    server = ThreadingHTTPServer(('localhost', args.port), Handler)
+    print(f'''*** Monitor stub listening on http://localhost:{args.port} ***''')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+'''
+An example consumer of the shared-memory ring buffer of the DAQ simulator (see daq/ring.py): it
+maps the ring, reads the STFs in place as they are written, verifies their Adler-32 checksums
+and reports the throughput and the STFs lost to overwriting. With -l, it reads the STFs announced
+in the messages of the socket transport instead of following the ring, and measures the latency
+from the end of the STF to its handoff.
+
+Example:
+./ring_reader.py -p /dev/shm/daq.ring
+../simulator/daq_simulator.py -N /dev/shm/daq.ring -P ../config/payload.yml ...
+'''
+
+import argparse, json, socketserver, time, zlib, os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from daq.ring import RingReader
+
+# ---
+class State:
+    reader  = None
+    count   = 0
+    bytes   = 0
+    errors  = 0     # the checksum mismatches
+    missed  = 0     # the STFs announced but overwritten before they were read
+    started = None
+
+
+# ---
+def check(seq, view, adler32):
+    ''' Verify the STF in place, and count it, unless it was overwritten in the meantime '''
+    if State.started is None: State.started = time.monotonic()
+    ok = zlib.adler32(view) == adler32
+    if not State.reader.valid(seq): # the view may have changed under us
+        State.missed += 1
+        return
+    if not ok: State.errors += 1
+    State.count += 1
+    State.bytes += len(view)
+    if State.count % 1000 == 0: report()
+
+
+# ---
+def report():
+    elapsed = time.monotonic() - State.started if State.started else 0.0
+    rate    = State.bytes/elapsed/1e6 if elapsed > 0 else 0.0
+    lost    = State.reader.lost if State.reader else 0
+    print(f'''*** {State.count} STFs, {State.bytes} bytes, {rate:.1f} MB/s, checksum errors {State.errors}, lost {lost + State.missed} ***''')
+
+
+###################################################################################
+class Handler(socketserver.StreamRequestHandler):
+    ''' Reads the JSONL messages of the socket transport of the simulator '''
+    def handle(self):
+        for line in self.rfile:
+            record = json.loads(line)
+            if record.get('base64'): continue # only the JSON encoding is understood here
+            msg = json.loads(record['body'])
+            if msg.get('msg_type') != 'stf_gen' or 'ring' not in msg: continue
+            if State.reader is None or State.reader.stale(): State.reader = RingReader(msg['ring'])
+            view = State.reader.get(msg)
+            if view is None:
+                State.missed += 1
+                continue
+            check(msg['seq'], view, int(msg['checksum'][3:]))
+            del view # let the ring be unmapped
+
+
+###################### Main code
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--path",     type=str,   help='Path of the ring buffer, followed directly', default='/dev/shm/daq.ring')
+    parser.add_argument("-l", "--listen",   type=str,   help='Take the STFs from the messages on this address (HOST:PORT) instead', default='')
+    parser.add_argument("-t", "--timeout",  type=float, help='Exit after this many seconds without new STFs', default=None)
+
+    args = parser.parse_args()
+    try:
+        if args.listen:
+            host, port = args.listen.rsplit(':', 1)
+            socketserver.ThreadingTCPServer.allow_reuse_address = True
+            server = socketserver.ThreadingTCPServer((host, int(port)), Handler)
+            print(f'''*** Ring reader listening on {args.listen} ***''')
+            server.serve_forever()
+        else:
+            while not os.path.exists(args.path): time.sleep(0.1)
+            State.reader = RingReader(args.path)
+            print(f'''*** Following the ring buffer {args.path}: {State.reader.capacity} bytes, {State.reader.slots} slots ***''')
+            start = max(1, State.reader.latest() - State.reader.slots + 1) # from the oldest STF in the ring
+            for seq, view in State.reader.follow(start, timeout=args.timeout):
+                e = State.reader.entry(seq)
+                if e is None:
+                    State.missed += 1
+                else:
+                    check(seq, view, int(e['adler32']))
+                del view
+    except KeyboardInterrupt:
+        pass
+    report()